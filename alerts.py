@@ -0,0 +1,169 @@
+import threading
+from dataclasses import asdict, dataclass, replace
+
+from cache import latest_cache
+from config import settings
+from events import bus
+from metrics import ALERT_DETECTIONS
+from model import add_exception, get_open_exception_episodes, update_exception_episode
+from timestamps import SECOND, now_ms
+
+# מצב ההתראות לכל (משתמש, סוג חריגה): זיהוי ראשון פותח אפיזודה (שורה אחת ב-exception),
+# זיהויים חוזרים רק מעדכנים אותה בזיכרון ונכתבים ל-DB פעם ב-alert_flush_seconds,
+# רמה גבוהה יותר מסלימה אותה מיד, ובדיקה שעוברת בלי חריגה סוגרת אותה.
+# זיהוי שמגיע בתוך alert_cooldown_seconds מהסגירה פותח מחדש את אותה אפיזודה במקום שורה חדשה.
+
+LEVELS = {"green": 0, "yellow": 1, "red": 2}
+
+
+@dataclass
+class Episode:
+    user_id: str
+    exception_type: str
+    exception_level: str
+    details: str
+    timestamp: int  # הפתיחה, מילישניות מ-1970
+    last_seen: int
+    occurrences: int = 1
+    resolved_at: int | None = None
+    id: int | None = None
+
+    def record(self) -> dict:
+        return asdict(self)
+
+
+def _seconds_between(earlier: int, later: int) -> float:
+    return (later - earlier) / SECOND
+
+
+def fold(episode: Episode | None, detection: Episode, cooldown_seconds: float) -> tuple[Episode, str]:
+    """
+    The state of a (user, type) after one more detection, and what happened to it:
+    "open" (a new episode), "reopen" (resolved less than the cooldown ago), "escalate" (higher level) or "repeat".
+    An open episode not detected for longer than the cooldown is stale, the detection opens a new one.
+    """
+    if episode is None:
+        return detection, "open"
+    if _seconds_between(episode.resolved_at or episode.last_seen, detection.last_seen) > cooldown_seconds:
+        return detection, "open"
+    escalated = LEVELS[detection.exception_level] > LEVELS[episode.exception_level]
+    action = "escalate" if escalated else "reopen" if episode.resolved_at else "repeat"
+    return replace(
+        episode,
+        exception_level=detection.exception_level if escalated else episode.exception_level,
+        details=detection.details if escalated else episode.details,
+        last_seen=max(episode.last_seen, detection.last_seen),
+        occurrences=episode.occurrences + 1,
+        resolved_at=None,
+    ), action
+
+
+def resolve(episode: Episode | None, timestamp: int) -> Episode | None:
+    """The episode closed at `timestamp`, None when there is no open episode to close."""
+    if episode is None or episode.resolved_at is not None:
+        return None
+    return replace(episode, resolved_at=timestamp)
+
+
+def superseded(episode: Episode | None) -> Episode | None:
+    """A stale episode as it is stored once a new one replaces it: closed at its last detection."""
+    if episode is None or episode.resolved_at is not None:
+        return None
+    return replace(episode, resolved_at=episode.last_seen)
+
+
+class AlertTracker:
+    """The live episodes of every (user, type), fed by the detectors through fire() and clear()."""
+
+    def __init__(self, cooldown_seconds: float, flush_seconds: float):
+        self.cooldown_seconds = cooldown_seconds
+        self.flush_seconds = flush_seconds
+        self._episodes: dict[tuple[str, str], Episode] = {}
+        self._flushed: dict[tuple[str, str], int] = {}  # ה-last_seen שכבר נכתב ל-DB
+        # _lock שומר רק על המילונים והסטטיסטיקה; הכתיבה ל-DB רצה תחת נעילה של ה-(משתמש, סוג) בלבד,
+        # כך שהכתיבות של אפיזודה אחת נשארות לפי הסדר וה-workers של משתמשים אחרים לא מחכים לה
+        self._lock = threading.Lock()
+        self._key_locks: dict[tuple[str, str], threading.Lock] = {}
+        self.stats = {"detections": 0, "open": 0, "reopen": 0, "escalate": 0, "repeat": 0, "resolve": 0, "writes": 0}
+
+    def load(self, now: int | None = None):
+        """Restore the episodes still open in the DB, so a restart does not open every one of them again."""
+        active_since = (now or now_ms()) - round(self.cooldown_seconds * SECOND)
+        with self._lock:
+            for record in get_open_exception_episodes(active_since):
+                key = (record["user_id"], record["exception_type"])
+                self._episodes[key] = Episode(**{field: record[field] for field in Episode.__dataclass_fields__})
+                self._flushed[key] = record["last_seen"]
+
+    def fire(self, user_id: str, exception_type: str, exception_level: str, details: str, timestamp: int) -> str:
+        """Record one detection; returns the action taken ("error" when the user does not exist)."""
+        key = (user_id, exception_type)
+        detection = Episode(user_id, exception_type, exception_level, details, timestamp, timestamp)
+        with self._key_lock(key):
+            with self._lock:
+                previous, flushed = self._episodes.get(key), self._flushed.get(key)
+            episode, action = fold(previous, detection, self.cooldown_seconds)
+            if action == "open":
+                stale = superseded(previous)
+                if stale:
+                    self._write(stale, event=None)
+                result = add_exception(user_id, exception_type, exception_level, details, timestamp)
+                if "error" in result:
+                    return "error"
+                episode.id = result["exception_id"]
+                self._written(key, timestamp)
+            elif action == "repeat" and _seconds_between(flushed, episode.last_seen) < self.flush_seconds:
+                latest_cache.put_exception(episode.record())  # /buzz ו-/test רואים את הזיהוי בלי כתיבה
+                bus.share("exception_seen", episode.record(), user_id)
+            else:
+                self._write(episode, event=None if action == "repeat" else "exception")
+            with self._lock:
+                self._episodes[key] = episode
+                self.stats["detections"] += 1
+                self.stats[action] += 1
+        ALERT_DETECTIONS.inc(1, exception_type, action)
+        return action
+
+    def clear(self, user_id: str, exception_type: str, timestamp: int):
+        """The detector ran and the condition no longer holds: close the open episode, if any."""
+        key = (user_id, exception_type)
+        with self._key_lock(key):
+            with self._lock:
+                episode = resolve(self._episodes.get(key), timestamp)
+            if episode is None:
+                return
+            self._write(episode, event="exception_resolved")
+            with self._lock:
+                self._episodes[key] = episode  # נשמרת לזמן ה-cooldown, לפתיחה מחדש
+                self.stats["resolve"] += 1
+        ALERT_DETECTIONS.inc(1, exception_type, "resolve")
+
+    def _key_lock(self, key: tuple[str, str]) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _write(self, episode: Episode, event: str | None):
+        update_exception_episode(episode.record(), event)
+        self._written((episode.user_id, episode.exception_type), episode.last_seen)
+
+    def _written(self, key: tuple[str, str], last_seen: int):
+        with self._lock:
+            self._flushed[key] = last_seen
+            self.stats["writes"] += 1
+
+    def drop_user(self, user_id: str):
+        with self._lock:
+            keys = {key for key in [*self._episodes, *self._key_locks] if key[0] == user_id}
+        for key in keys:
+            with self._key_lock(key), self._lock:
+                self._episodes.pop(key, None)
+                self._flushed.pop(key, None)
+                self._key_locks.pop(key, None)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            open_episodes = sum(1 for episode in self._episodes.values() if episode.resolved_at is None)
+            return {**self.stats, "open_episodes": open_episodes, "tracked": len(self._episodes)}
+
+
+alert_tracker = AlertTracker(settings.alert_cooldown_seconds, settings.alert_flush_seconds)
@@ -1,26 +1,75 @@
-from fastapi import FastAPI, HTTPException, Query
-import numpy as np
-from pydantic import BaseModel
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import Annotated
+from fastapi import Body, Depends, FastAPI, HTTPException, Query
+from pydantic import BaseModel, PlainSerializer
 import random
 from datetime import datetime, timedelta
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 from model import (
+    db_session,
+    session_scope,
+    warm_cache,
     add_user,
-    get_last_sensor_data_by_user,
-    get_last_exception_from_date,
-    get_user,
     delete_user,
     add_sensor_data,
+    add_sensor_data_batch,
+    add_sensor_data_bulk,
     delete_sensor_record,
-    get_latest_exception_timestamp,
-    get_all_users,
+    get_sensor_aggregates,
+    set_shared_value,
+    store,
 )
 
-from check import check_all_conditions
+from alerts import alert_tracker
+from async_model import (
+    dispose,
+    get_all_users,
+    get_fleet_snapshot,
+    get_last_exception_from_date,
+    get_last_sensor_data_by_user,
+    get_latest_exception_timestamp,
+    get_shared_value,
+    get_user,
+)
+from config import settings
+from events import bus
+from export import EXPORT_FORMATS, check_export, export_chunks
+from fleet_analysis import fleet_analyzer
+from frames import FRAME_MEDIA_TYPE, decode_frames, frame_count
+from metrics import Gauge, MetricsMiddleware, TimedRoute, registry
+from pipeline import pipeline
+from retention import retention
+from seed import SeedPlan, detect_seeded, seed
+from shared import relay
+from stream import drop_stream
+from timestamps import SECOND, format_ms, formatted, now_ms, to_ms
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    relay.start()  # לפני טעינת ה-cache, כדי שכתיבה של worker אחר באמצע הטעינה לא תפוספס
+    with session_scope():
+        warm_cache()
+        alert_tracker.load()
+    if settings.detection_async:
+        pipeline.start()
+    fleet_analyzer.start()
+    retention.start()
+    yield
+    retention.stop()
+    fleet_analyzer.stop()
+    pipeline.stop()
+    relay.stop()
+    await dispose()
+
+
+app = FastAPI(lifespan=lifespan, dependencies=[Depends(db_session)])
+app.router.route_class = TimedRoute
+app.add_middleware(MetricsMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,8 +81,13 @@ app.add_middleware(
 
 
 NUM_OF_RECORDS = 1000  # מספר רשומות לדוגמה
+EMERGENCY_SECONDS = 10  # כמה זמן לחיצה על לחצן המצוקה נחשבת פעילה
+STREAM_KEEPALIVE_SECONDS = 15
+MAX_BATCH_SIZE = 10_000  # מספר מדידות מקסימלי בבקשה אחת
+MAX_SEED_READINGS = 5_000_000  # מספר מדידות מקסימלי ליצירה בבקשת seed אחת
 USER_ID = "1"  # מזהה משתמש
-emergency: datetime | None = None
+EMERGENCY_KEY = "emergency"  # ב-shared_state: מתי הלחצן נלחץ, משותף לכל תהליכי ה-worker
+
 
 # ----------- MODELS FOR REQUESTS ----------- #
 class UserCreate(BaseModel):
@@ -51,35 +105,149 @@ class SensorDataCreate(BaseModel):
     sweat_level: float
 
 
-def emergency_on() -> bool:
+class SensorReading(SensorDataCreate):
+    timestamp: datetime | None = None
+
+
+class UserSensorReadings(BaseModel):
+    user_id: str
+    readings: list[SensorReading]
+
+
+# ----------- MODELS FOR RESPONSES ----------- #
+# נקודות הקריאה החמות מחזירות את הרשומות כמו שהן (dicts מ-model.py או מה-cache), ו-FastAPI מסדר אותן לפי
+# המודלים האלה ישר ל-JSON bytes של pydantic. זמנים (epoch ms) הופכים למחרוזת תצוגה בזמן הסידור, בלי עותק של הרשומה.
+DisplayTime = Annotated[int, PlainSerializer(format_ms, return_type=str)]
+
+
+class StatusResponse(BaseModel):
+    status: bool
+
+
+class UserResponse(BaseModel):
+    id: str
+    first_name: str
+    last_name: str
+
+
+class UserSummary(UserResponse):
+    sensor_data_count: int
+    exceptions_count: int
+    last_seen: DisplayTime | None = None  # רק עם include
+    open_red_alerts: int | None = None
+
+
+class UsersPage(BaseModel):
+    users: list[UserSummary]
+    next_cursor: str | None
+
+
+class SensorRecord(SensorDataCreate):
+    id: int
+    user_id: str
+    timestamp: DisplayTime
+
+
+class ExceptionRecord(BaseModel):
+    id: int
+    user_id: str
+    timestamp: DisplayTime
+    exception_type: str
+    exception_level: str
+    details: str
+    last_seen: DisplayTime
+    occurrences: int
+    resolved_at: DisplayTime | None
+
+
+class ExceptionWithUser(ExceptionRecord):
+    user: UserResponse | None = None
+
+
+class FleetUserState(BaseModel):
+    user_id: str
+    alert_level: str | None  # החמורה מבין האפיזודות הפתוחות, None = אין התראה פתוחה
+    reading: SensorRecord | None
+    last_exception: ExceptionRecord | None
+
+
+class FleetSnapshot(BaseModel):
+    as_of: DisplayTime  # לשלוח כ-since בבקשה הבאה
+    users: list[FleetUserState]
+
+
+class DateCheck(BaseModel):
+    res: str
+    new_data: ExceptionWithUser | None = None  # רק כשהתאריך לפני החריגה האחרונה
+
+
+def reading_to_record(reading: SensorReading) -> dict:
+    record = reading.model_dump(exclude={"timestamp"})
+    if reading.timestamp is not None:
+        record["timestamp"] = to_ms(reading.timestamp)
+    return record
+
+
+def emergency_on(pressed_at: int | None) -> bool:
     """
     Check if the emergency button is pressed.
     """
-    global emergency
-    if emergency is None:
-        return False
-    return emergency > datetime.now() - timedelta(seconds=10)
+    return pressed_at is not None and pressed_at > now_ms() - EMERGENCY_SECONDS * SECOND
+
 
+def emergency_event(pressed_at: int | None) -> dict:
+    """Emergency state for /stream clients, with the moment it expires on its own."""
+    if not emergency_on(pressed_at):
+        return {"status": False, "expires_at": None}
+    return {"status": True, "expires_at": format_ms(pressed_at + EMERGENCY_SECONDS * SECOND)}
 
 
 @app.delete("/emergency")
 def emergency_status():
-    global emergency
-    emergency = None
-    return {"status": emergency_on()}
+    set_shared_value(EMERGENCY_KEY, None)
+    bus.publish("emergency", emergency_event(None))
+    return {"status": False}
 
 
-@app.get("/emergency")
-def emergency_status():
-    global emergency
-    return {"status": emergency_on()}
+@app.get("/emergency", response_model=StatusResponse)
+async def emergency_status():
+    return {"status": emergency_on(await get_shared_value(EMERGENCY_KEY))}
 
 
 @app.post("/emergency")
 def emergency_status():
-    global emergency
-    emergency = datetime.now()
-    return {"status": emergency_on()}
+    pressed_at = now_ms()
+    set_shared_value(EMERGENCY_KEY, pressed_at)
+    bus.publish("emergency", emergency_event(pressed_at))
+    return {"status": True}
+
+
+# ----------- PUSH STREAM ----------- #
+# Server-Sent Events במקום polling: מדידות חדשות, חריגות חדשות ושינויי מצב חירום
+@app.get("/stream")
+async def stream_events(user_id: Annotated[list[str] | None, Query()] = None):
+    subscription = bus.subscribe(set(user_id) if user_id else None)
+    emergency = emergency_event(await get_shared_value(EMERGENCY_KEY))
+
+    async def events():
+        try:
+            yield f"event: emergency\ndata: {json.dumps(emergency)}\n\n"
+            # כשהלקוח מתנתק StreamingResponse מבטל את ה-generator
+            while True:
+                try:
+                    event_type, data = await asyncio.wait_for(
+                        subscription.queue.get(), timeout=STREAM_KEEPALIVE_SECONDS
+                    )
+                except TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event_type}\ndata: {json.dumps(formatted(data), default=str)}\n\n"
+        finally:
+            bus.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 # ----------- USER ENDPOINTS ----------- #
@@ -91,17 +259,21 @@ def create_user(user: UserCreate):
     return result
 
 
-@app.get("/users/{user_id}")
-def read_user(user_id: str):
-    user = get_user(user_id)
+@app.get("/users/{user_id}", response_model=UserResponse)
+async def read_user(user_id: str):
+    user = await get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return {"id": user.id, "first_name": user.first_name, "last_name": user.last_name}
+    return user
 
 
-@app.get("/users/")
-def all_users():
-    return get_all_users()
+@app.get("/users/", response_model=UsersPage, response_model_exclude_unset=True)
+async def all_users(
+    cursor: str | None = Query(default=None, description="The next_cursor of the previous page"),
+    limit: int = Query(default=100, ge=1, le=1000),
+    include: str = Query(default="", description="Comma separated optional fields: last_seen, open_red_alerts"),
+):
+    return await get_all_users(cursor, limit, {field.strip() for field in include.split(",") if field.strip()})
 
 
 @app.delete("/users/{user_id}")
@@ -109,6 +281,8 @@ def remove_user(user_id: str):
     result = delete_user(user_id)
     if "error" in result:
         raise HTTPException(status_code=404, detail=result["error"])
+    drop_stream(user_id)
+    alert_tracker.drop_user(user_id)
     return result
 
 
@@ -117,48 +291,124 @@ def remove_user(user_id: str):
 @app.post("/users/{user_id}/metrics")
 def create_sensor_data(user_id: str, data: SensorDataCreate):
     result = add_sensor_data(user_id, data.model_dump())
-    # Check exceptions for user id  check_for_user_id(user_id)
-    check_all_conditions(user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     # Wrtie to db exception with the current timestamp
     if "error" in result:
         raise HTTPException(status_code=404, detail=result["error"])
+    # Check exceptions for user id in the background, the reading is already stored
+    reading = {**data.model_dump(), "id": result["record_id"], "timestamp": result["timestamp"]}
+    pipeline.submit(user_id, result["timestamp"], [reading])
+    return formatted(result)
+
+
+def store_batch(user_id: str, records: list[dict]) -> dict:
+    result = add_sensor_data_batch(user_id, records)
+    if "error" in result:
+        raise HTTPException(status_code=404, detail=result["error"])
+    # בדיקת חריגות פעם אחת על החלון החדש במקום פעם לכל מדידה
+    records = result.pop("records")
+    if records:
+        pipeline.submit(user_id.strip(), result["last_timestamp"], records)
+    return formatted(result)
+
+
+@app.post("/users/{user_id}/metrics/batch")
+def create_sensor_data_batch(user_id: str, readings: list[SensorReading]):
+    if len(readings) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch too large, max {MAX_BATCH_SIZE} readings")
+    return store_batch(user_id, [reading_to_record(r) for r in readings])
+
+
+@app.post("/users/{user_id}/metrics/frames")
+def create_sensor_data_frames(user_id: str, body: Annotated[bytes, Body(media_type=FRAME_MEDIA_TYPE)]):
+    # גוף בינארי של frames בגודל קבוע (frames.py), עם Content-Type: application/vnd.hm.sensor-frames
+    if (frame_count(body) or 0) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch too large, max {MAX_BATCH_SIZE} readings")
+    decoded = decode_frames(body)
+    if "error" in decoded:
+        raise HTTPException(status_code=400, detail=decoded["error"])
+    return store_batch(user_id, decoded["records"])
+
+
+@app.post("/metrics/batch")
+def create_fleet_sensor_data_batch(batches: list[UserSensorReadings]):
+    if sum(len(batch.readings) for batch in batches) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch too large, max {MAX_BATCH_SIZE} readings")
+    grouped: dict[str, list[dict]] = {}
+    for batch in batches:
+        grouped.setdefault(batch.user_id, []).extend(reading_to_record(r) for r in batch.readings)
+    result = add_sensor_data_bulk(grouped)
+    for user_id, records in result.pop("records").items():
+        pipeline.submit(user_id, max(record["timestamp"] for record in records), records)
     return result
 
-@app.get("/buzz")
-def buzz():
-    reference_date = get_latest_exception_timestamp()
+
+@app.get("/internal/pipeline")
+def pipeline_metrics():
+    return pipeline.metrics()
+
+
+registry.register(Gauge("hm_detection_queue_depth", "Detection jobs waiting in the queues", pipeline.depth))
+registry.register(Gauge("hm_stream_subscribers", "Open /stream connections", lambda: bus.subscriber_count))
+
+
+@app.get("/internal/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/internal/alerts")
+def alert_metrics():
+    return alert_tracker.metrics()
+
+
+@app.get("/internal/storage")
+def storage_metrics():
+    return store.describe()
+
+
+@app.get("/internal/retention")
+def retention_metrics():
+    return retention.metrics()
+
+
+@app.get("/internal/shared")
+def shared_metrics():
+    return relay.metrics()
+
+
+@app.get("/buzz", response_model=StatusResponse)
+async def buzz():
+    reference_date = await get_latest_exception_timestamp()
     if reference_date is None:
         return {"status": False}
-    return {"status": reference_date > datetime.now() - timedelta(seconds=5)}
+    return {"status": reference_date > now_ms() - 5 * SECOND}
 
 
-@app.get("/test")
-def check_date(
-    date_str: str = Query(
-        default=None,
-        description="Date in format YYYY-MM-DDTHH:MM:SS (default: current time)"
-    )
+@app.get("/test", response_model=DateCheck, response_model_exclude_unset=True)
+async def check_date(
+    date_str: str = Query(default=None, description="Date in format YYYY-MM-DDTHH:MM:SS (default: current time)"),
 ):
     if not date_str:
         date_str = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-    reference_date = get_latest_exception_timestamp()
+    reference_date = await get_latest_exception_timestamp()
     if reference_date is None:
         return JSONResponse(status_code=201, content={"error": "No exceptions found on the system"})
 
     try:
         if isinstance(date_str, str) and "T" in date_str:
             date_str = date_str.replace("T", " ")  # תומך ב-T או רווח
-        input_date = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
+        input_date = to_ms(datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S"))
     except ValueError:
         return JSONResponse(
-            status_code=400, content={"error": f"Got '{date_str}', Invalid date format. Use YYYY-MM-DD HH:MM:SS or YYYY-MM-DDTHH:MM:SS"}
+            status_code=400,
+            content={"error": f"Got '{date_str}', Invalid date format. Use YYYY-MM-DD HH:MM:SS or YYYY-MM-DDTHH:MM:SS"},
         )
 
     if input_date < reference_date:
-        new = get_last_exception_from_date(date_str)  # השתמש בתאריך שנוקה
+        new = await get_last_exception_from_date(input_date)
         if new is not None and "user_id" in new:
             user_id = new["user_id"]
-            new["user"] = get_user(user_id)
+            new = {**new, "user": await get_user(user_id)}  # בלי לשנות את הרשומה שב-cache
         return {"res": "before", "new_data": new}
     return {"res": "after"}
 
@@ -170,14 +420,59 @@ def delete_metric_record(record_id: int):
         raise HTTPException(status_code=404, detail=result["error"])
     return result
 
-@app.get("/metrics/last/{user_id}")
-def get_last_metric(user_id: str):
-    result = get_last_sensor_data_by_user(user_id)
+
+@app.get("/users/{user_id}/metrics/aggregate")
+def get_metric_aggregates(
+    user_id: str,
+    from_date: Annotated[datetime, Query(alias="from", description="YYYY-MM-DD HH:MM:SS or YYYY-MM-DDTHH:MM:SS")],
+    bucket: str = Query(default="1m", description="Bucket size, e.g. 1m, 15m, 1h, 1d"),
+    to_date: Annotated[datetime | None, Query(alias="to", description="Default: now")] = None,
+):
+    result = get_sensor_aggregates(user_id, bucket, to_ms(from_date), to_ms(to_date) if to_date else now_ms())
+    if "error" in result:
+        raise HTTPException(status_code=400, detail=result["error"])
+    return {**result, "buckets": [formatted(bucket) for bucket in result["buckets"]]}
+
+
+@app.get("/metrics/export")
+def export_metrics(
+    from_date: Annotated[datetime, Query(alias="from", description="YYYY-MM-DD HH:MM:SS or YYYY-MM-DDTHH:MM:SS")],
+    to_date: Annotated[datetime | None, Query(alias="to", description="Default: now")] = None,
+    user_id: Annotated[list[str] | None, Query(description="Export only these users (repeatable)")] = None,
+    columns: str = Query(default="", description="Comma separated columns, default all"),
+    export_format: str = Query(default="ndjson", alias="format", description="ndjson or csv"),
+):
+    checked = check_export(export_format, [name.strip() for name in columns.split(",") if name.strip()])
+    if "error" in checked:
+        raise HTTPException(status_code=400, detail=checked["error"])
+    start_date = to_ms(from_date)
+    end_date = to_ms(to_date) if to_date else now_ms()
+    # הטווח נכתב ללקוח chunk אחרי chunk, הזיכרון לא תלוי בגודל הטווח
+    return StreamingResponse(
+        export_chunks((start_date, end_date), user_id, checked["columns"], export_format),
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="metrics.{export_format}"'},
+    )
+
+
+@app.get("/metrics/last/{user_id}", response_model=SensorRecord)
+async def get_last_metric(user_id: str):
+    result = await get_last_sensor_data_by_user(user_id)
     if not result:
         raise HTTPException(status_code=404, detail="No metrics found")
     return result
 
 
+@app.get("/fleet/snapshot", response_model=FleetSnapshot)
+async def fleet_snapshot(
+    since: Annotated[
+        datetime | None, Query(description="The as_of of the previous snapshot: only the users that changed since")
+    ] = None,
+):
+    # מסך של חדר הבקרה: שאילתה אחת לכל הצי במקום /metrics/last לכל משתמש
+    return await get_fleet_snapshot(to_ms(since) if since else None)
+
+
 # ----------- DEMO UTILITIES ----------- #
 def random_metric():
     return SensorDataCreate(
@@ -197,32 +492,41 @@ def random_datetime():
 
 @app.get("/demo")
 def generate_demo():
-    demo_user = UserCreate(id="1", first_name="Demo", last_name="User")
-    add_user(demo_user.id, demo_user.first_name, demo_user.last_name)
-
-    start_time = datetime.now()
-
-    for i in range(NUM_OF_RECORDS):
-        heart_rate = int(np.random.normal(loc=85, scale=15))
-        temperature = 30 + (12 * i / NUM_OF_RECORDS)  # Gradually increase temperature from 30 to 42
-        sweat_level = round(np.random.normal(loc=0.5, scale=0.2), 2)
-        movement_x = round(np.random.normal(loc=0.5, scale=0.2), 2)
-        movement_y = round(np.random.normal(loc=0.5, scale=0.2), 2)
-        movement_z = round(np.random.normal(loc=0.5, scale=0.2), 2)
-
-        timestamp = start_time + timedelta(seconds=i)  # Increment by 1 second for each record
-
-        data = {
-            "heart_rate": max(25, min(150, heart_rate)),
-            "temperature": temperature,
-            "movement_x": max(0, min(1, movement_x)),
-            "movement_y": max(0, min(1, movement_y)),
-            "movement_z": max(0, min(1, movement_z)),
-            "sweat_level": max(0, min(1, sweat_level)),
-            "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-        }
-
-        add_sensor_data(USER_ID, data)
-        check_all_conditions(USER_ID, timestamp.strftime("%Y-%m-%d %H:%M:%S"))
-
-    return {"info": f"Created {NUM_OF_RECORDS} demo records for user 1 with high temperature to trigger exceptions"}
+    plan = SeedPlan(user_ids=[USER_ID], scenario="heat_ramp", samples=NUM_OF_RECORDS)
+    result = seed(plan)
+    result["detection"] = detect_seeded(result, plan.user_ids)
+    return {
+        "info": f"Created {NUM_OF_RECORDS} demo records for user 1 with high temperature to trigger exceptions",
+        **formatted(result),
+    }
+
+
+class SeedRequest(BaseModel):
+    users: int = 10
+    user_prefix: str = "seed"
+    scenario: str = "mix"
+    samples: int = 1000
+    interval_seconds: float = 1.0
+    start: datetime | None = None
+    random_seed: int | None = None
+    detect: bool = False
+
+
+@app.post("/demo/seed")
+def seed_demo_data(request: SeedRequest):
+    if request.users * request.samples > MAX_SEED_READINGS:
+        raise HTTPException(status_code=413, detail=f"Too many readings, max {MAX_SEED_READINGS}")
+    plan = SeedPlan(
+        user_ids=[f"{request.user_prefix}-{index}" for index in range(request.users)],
+        scenario=request.scenario,
+        samples=request.samples,
+        interval_seconds=request.interval_seconds,
+        start=request.start,
+        random_seed=request.random_seed,
+    )
+    result = seed(plan)
+    if "error" in result:
+        raise HTTPException(status_code=400, detail=result["error"])
+    if request.detect:
+        result["detection"] = detect_seeded(result, plan.user_ids)
+    return formatted(result)
@@ -0,0 +1,158 @@
+import asyncio
+
+from sqlalchemy import event, make_url, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from cache import MISSING, latest_cache
+from config import settings
+from metrics import DB_SECONDS, timed
+from model import (
+    SharedState,
+    User,
+    fleet_snapshot,
+    fleet_snapshot_statement,
+    last_sensor_data_query,
+    latest_exception_query,
+    merge_newest_readings,
+    merge_sensor_counts,
+    newest_readings_statement,
+    sensor_counts_statement,
+    users_page,
+    users_page_statement,
+    store,
+)
+from timestamps import now_ms
+
+# גרסה אסינכרונית של פונקציות הקריאה של model.py, לנקודות הקצה של ה-polling (async def ב-app.py):
+# בקשה שמחכה ל-DB לא תופסת thread מה-threadpool, ותשובה מה-LatestCache לא נוגעת ב-DB בכלל.
+# על אותו קובץ SQLite דרך aiosqlite, כל קריאה על חיבור משלה מה-pool. הכתיבות נשארות ב-model.py.
+# מחיצות של המדידות (storage.py) הן engines סינכרוניים, הקריאה מהן רצה ב-thread.
+
+engine = create_async_engine(
+    make_url(settings.database_url).set(drivername="sqlite+aiosqlite"),
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    connect_args={"timeout": settings.sqlite_busy_timeout_ms / 1000},
+)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _configure_sqlite(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}")
+    cursor.execute("PRAGMA query_only=ON")  # רק קריאות עוברות כאן
+    cursor.close()
+
+
+async def _all(statement) -> list:
+    async with engine.connect() as conn:
+        return (await conn.execute(statement)).all()
+
+
+async def _first(statement):
+    async with engine.connect() as conn:
+        return (await conn.execute(statement)).first()
+
+
+async def _sensor_results(statement, period: tuple[int | None, int | None] | None = None, user_ids=None) -> list:
+    """Like model._sensor_results: one list of rows per partition that can hold the period and the users' readings."""
+    if not store.partitioned:
+        return [await _all(statement)]
+    return [await asyncio.to_thread(partition.read, statement) for partition in store.partitions(period, user_ids)]
+
+
+@timed(DB_SECONDS)
+async def get_user(user_id: str) -> dict | None:
+    row = await _first(select(User.id, User.first_name, User.last_name).where(User.id == user_id))
+    return dict(row._mapping) if row else None
+
+
+@timed(DB_SECONDS)
+async def get_all_users(cursor: str | None = None, limit: int = 100, include: set[str] = frozenset()) -> dict:
+    """
+    One page of users with their counts, ordered by id; pass the returned `next_cursor` to get the next page.
+    The counts come from GROUP BY queries limited to the page's users, instead of loading every related row.
+    Optional fields in `include`: "last_seen" (newest reading) and "open_red_alerts".
+    """
+    rows = [row._mapping for row in await _all(users_page_statement(cursor, limit))]
+    user_ids = [row["id"] for row in rows]
+    counts = merge_sensor_counts(await _sensor_results(sensor_counts_statement(user_ids), user_ids=user_ids))
+    return users_page(rows, counts, limit, include)
+
+
+@timed(DB_SECONDS)
+async def get_last_sensor_data_by_user(user_id: str) -> dict:
+    cached = latest_cache.get_reading(user_id)
+    if cached:
+        return cached
+    statement = last_sensor_data_query(user_id).limit(1)
+    if not store.partitioned:
+        record = await _first(statement)
+    else:
+        record = None
+        for partition in reversed(store.partitions(user_ids=[user_id])):  # היום החדש ביותר קודם
+            rows = await asyncio.to_thread(partition.read, statement)
+            if rows:
+                record = rows[0]
+                break
+    if not record:
+        return {}
+    latest = dict(record._mapping)
+    latest_cache.put_reading(latest)
+    return latest
+
+
+async def _latest_exception() -> dict | None:
+    latest = latest_cache.get_latest_exception()
+    if latest is MISSING:
+        record = await _first(latest_exception_query())
+        latest = dict(record._mapping) if record else None
+        latest_cache.load_latest_exception(latest)
+    return latest
+
+
+@timed(DB_SECONDS)
+async def get_latest_exception_timestamp() -> int | None:
+    latest = await _latest_exception()
+    return latest["last_seen"] if latest else None
+
+
+@timed(DB_SECONDS)
+async def get_last_exception_from_date(start_date: int) -> dict | None:
+    latest = await _latest_exception()
+    if latest is None or latest["last_seen"] < start_date:
+        return None
+    return latest
+
+
+@timed(DB_SECONDS)
+async def get_shared_value(key: str) -> int | None:
+    row = await _first(select(SharedState.value).where(SharedState.key == key))
+    return row[0] if row else None
+
+
+@timed(DB_SECONDS)
+async def get_fleet_snapshot(since: int | None = None) -> dict:
+    """
+    Every user's latest reading, last exception and open alert level, for the control room screens.
+    With `since` (the `as_of` of an earlier snapshot) only the users whose state changed from then on.
+    """
+    as_of = now_ms()
+    if not store.partitioned:
+        rows = [row._mapping for row in await _all(fleet_snapshot_statement(as_of, since))]
+        return fleet_snapshot(rows, None, as_of)
+    results = await _sensor_results(newest_readings_statement(since), (since, None) if since is not None else None)
+    readings = merge_newest_readings(results)
+    statement = fleet_snapshot_statement(as_of, since, with_readings=False, changed_users=list(readings))
+    rows = [row._mapping for row in await _all(statement)]
+    for row in rows if since is not None else ():
+        # משתמש שהשתנה רק בחריגות: המדידה האחרונה שלו קודמת ל-since
+        if row["user_id"] not in readings and (reading := await get_last_sensor_data_by_user(row["user_id"])):
+            readings[row["user_id"]] = reading
+    return fleet_snapshot(rows, readings, as_of)
+
+
+async def dispose():
+    """Close the pooled aiosqlite connections (each one runs on its own thread), on shutdown."""
+    await engine.dispose()
@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+import numpy as np
+
+from frames import FRAME_MEDIA_TYPE, encode_frames
+
+# מדמה צי של מכשירים מול שרת שרץ (uv run fastapi run app.py --port 3000) ומודד קליטה וזמן עד התראה:
+#   python bench.py --devices 200 --rate 1 --duration 60 --output results.json
+#   python bench.py --devices 200 --rate 1 --duration 60 --compare results.json
+# מדידות רגילות נשארות מתחת ל-34°C כדי שלא יקפיצו התראות, רק ה-probe שולח מדידות חמות.
+
+HEATSTROKE_SAMPLES = 3  # min_samples של כלל heatstroke ב-rules.py
+
+
+def random_reading(temperature: float | None = None) -> dict:
+    return {
+        "heart_rate": random.randint(60, 110),
+        "temperature": temperature if temperature is not None else round(random.uniform(31.0, 33.5), 1),
+        "movement_x": round(random.uniform(0.0, 1.0), 2),
+        "movement_y": round(random.uniform(0.0, 1.0), 2),
+        "movement_z": round(random.uniform(0.0, 1.0), 2),
+        "sweat_level": round(random.uniform(0.0, 1.0), 2),
+    }
+
+
+def latency_summary(seconds: list[float]) -> dict:
+    if not seconds:
+        return {"count": 0}
+    ms = np.array(seconds) * 1000
+    return {
+        "count": len(ms),
+        "mean": round(float(ms.mean()), 2),
+        "p50": round(float(np.percentile(ms, 50)), 2),
+        "p99": round(float(np.percentile(ms, 99)), 2),
+        "max": round(float(ms.max()), 2),
+    }
+
+
+async def create_user(client: httpx.AsyncClient, user_id: str):
+    # 400 = המשתמש כבר קיים מהרצה קודמת
+    await client.post("/users", json={"id": user_id, "first_name": "Bench", "last_name": "Device"})
+
+
+async def run_device(client: httpx.AsyncClient, user_id: str, args, stop_at: float, results: dict):
+    """Send `args.batch` readings (JSON or binary frames) every batch / rate seconds until stop_at."""
+    interval = args.batch / args.rate
+    next_send = time.monotonic() + random.uniform(0, interval)  # שלא כל המכשירים ישלחו באותו רגע
+    while True:
+        await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+        if time.monotonic() >= stop_at:
+            return
+        if args.frames:
+            now = datetime.now()
+            step = timedelta(seconds=1 / args.rate)
+            readings = [{**random_reading(), "timestamp": now - (args.batch - 1 - i) * step} for i in range(args.batch)]
+            url, request = (
+                f"/users/{user_id}/metrics/frames",
+                {
+                    "content": encode_frames(readings),
+                    "headers": {"Content-Type": FRAME_MEDIA_TYPE},
+                },
+            )
+        elif args.batch == 1:
+            url, request = f"/users/{user_id}/metrics", {"json": random_reading()}
+        else:
+            now = datetime.now()
+            url = f"/users/{user_id}/metrics/batch"
+            step = timedelta(seconds=1 / args.rate)
+            request = {
+                "json": [
+                    {**random_reading(), "timestamp": (now - (args.batch - 1 - i) * step).isoformat()}
+                    for i in range(args.batch)
+                ]
+            }
+        started = time.perf_counter()
+        try:
+            response = await client.post(url, **request)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        results["latencies"].append(time.perf_counter() - started)
+        if ok:
+            results["readings"] += args.batch
+        else:
+            results["errors"] += 1
+        next_send += interval
+
+
+async def buzzing(client: httpx.AsyncClient) -> bool:
+    return (await client.get("/buzz")).json()["status"]
+
+
+async def alert_probe(client: httpx.AsyncClient, user_id: str, timeout: float, poll: float) -> float | None:
+    """
+    Seconds from sending the reading that completes a heatstroke window to /buzz reporting it, None on timeout.
+    Every probe uses a fresh user, so its 1-minute window holds only the probe's hot readings.
+    """
+    await create_user(client, user_id)
+    for _ in range(HEATSTROKE_SAMPLES - 1):
+        await client.post(f"/users/{user_id}/metrics", json=random_reading(temperature=39.5))
+    started = time.perf_counter()
+    await client.post(f"/users/{user_id}/metrics", json=random_reading(temperature=39.5))
+    while time.perf_counter() - started < timeout:
+        if await buzzing(client):
+            return time.perf_counter() - started
+        await asyncio.sleep(poll)
+    return None
+
+
+async def run_probes(client: httpx.AsyncClient, args, stop_at: float, results: dict):
+    run_id = uuid.uuid4().hex[:8]
+    while time.monotonic() < stop_at:
+        # מחכים ש-/buzz ירגע מהחריגה הקודמת, אחרת אי אפשר לדעת מתי הגיעה החדשה
+        while await buzzing(client) and time.monotonic() < stop_at:
+            await asyncio.sleep(0.5)
+        if time.monotonic() >= stop_at:
+            return
+        user_id = f"bench-probe-{run_id}-{len(results['probe_users'])}"
+        results["probe_users"].append(user_id)
+        latency = await alert_probe(client, user_id, args.alert_timeout, args.poll_ms / 1000)
+        if latency is None:
+            results["missed"] += 1
+        else:
+            results["alert_latencies"].append(latency)
+        await asyncio.sleep(args.probe_interval)
+
+
+def git_commit() -> str | None:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return commit.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(args) -> dict:
+    started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.request_timeout) as client:
+        device_ids = [f"bench-device-{index}" for index in range(args.devices)]
+        for start in range(0, len(device_ids), args.connections):
+            chunk = device_ids[start : start + args.connections]
+            await asyncio.gather(*(create_user(client, user_id) for user_id in chunk))
+
+        results = {"latencies": [], "readings": 0, "errors": 0, "alert_latencies": [], "missed": 0, "probe_users": []}
+        started = time.monotonic()
+        stop_at = started + args.duration
+        tasks = [run_device(client, user_id, args, stop_at, results) for user_id in device_ids]
+        if args.probe_interval >= 0:
+            tasks.append(run_probes(client, args, stop_at, results))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+
+        pipeline = (await client.get("/internal/pipeline")).json()
+        for user_id in results["probe_users"]:
+            await client.delete(f"/users/{user_id}")
+
+    requests = len(results["latencies"])
+    return {
+        "started_at": started_at,
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "ingest": {
+            "seconds": round(elapsed, 2),
+            "requests": requests,
+            "errors": results["errors"],
+            "readings": results["readings"],
+            "requests_per_second": round(requests / elapsed, 2),
+            "readings_per_second": round(results["readings"] / elapsed, 2),
+            "latency_ms": latency_summary(results["latencies"]),
+        },
+        "alert": {
+            "probes": len(results["probe_users"]),
+            "missed": results["missed"],
+            "latency_ms": latency_summary(results["alert_latencies"]),
+        },
+        "pipeline": pipeline,
+    }
+
+
+# מדד -> האם ערך גבוה יותר טוב
+COMPARED = {
+    ("ingest", "readings_per_second"): True,
+    ("ingest", "latency_ms", "p50"): False,
+    ("ingest", "latency_ms", "p99"): False,
+    ("alert", "latency_ms", "p50"): False,
+    ("alert", "latency_ms", "p99"): False,
+}
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Lines describing every compared metric, marked REGRESSION when it got worse by more than `tolerance`."""
+    lines = []
+    for path, higher_is_better in COMPARED.items():
+        old, new = baseline, current
+        for key in path:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        mark = "REGRESSION" if worse > tolerance else "ok"
+        lines.append(f"{'.'.join(path)}: {old} -> {new} ({change:+.1%}) {mark}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of wearables against a running server")
+    parser.add_argument("--url", default="http://127.0.0.1:3000")
+    parser.add_argument("--devices", type=int, default=100, help="Number of simulated devices")
+    parser.add_argument("--rate", type=float, default=1.0, help="Readings per second per device")
+    parser.add_argument("--batch", type=int, default=1, help="Readings per request, >1 uses /metrics/batch")
+    parser.add_argument("--frames", action="store_true", help="Send the readings as binary frames (/metrics/frames)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load")
+    parser.add_argument("--connections", type=int, default=100, help="Max concurrent HTTP connections")
+    parser.add_argument("--request-timeout", type=float, default=10.0)
+    parser.add_argument("--probe-interval", type=float, default=2.0, help="Pause between alert probes, -1 = none")
+    parser.add_argument("--alert-timeout", type=float, default=10.0, help="Give up on a probe after this")
+    parser.add_argument("--poll-ms", type=float, default=10.0, help="How often a probe polls /buzz")
+    parser.add_argument("--output", help="Write the results JSON to this file")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        for line in compare(results, baseline, args.tolerance):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
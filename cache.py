@@ -0,0 +1,108 @@
+import threading
+
+# מטמון write-through של המדידה האחרונה והחריגה האחרונה: model.py מעדכן אותו בכל כתיבה,
+# ו-/metrics/last, /buzz ו-/test נענים מהזיכרון במקום ORDER BY על ה-DB
+
+SENSOR_FIELDS = (
+    "id",
+    "user_id",
+    "timestamp",
+    "heart_rate",
+    "temperature",
+    "movement_x",
+    "movement_y",
+    "movement_z",
+    "sweat_level",
+)
+EXCEPTION_FIELDS = (
+    "id",
+    "user_id",
+    "timestamp",
+    "exception_type",
+    "exception_level",
+    "details",
+    "last_seen",
+    "occurrences",
+    "resolved_at",
+)
+
+MISSING = object()  # עדיין לא ידוע (לא נטען מה-DB), שונה מ-None = ידוע שאין
+
+
+def _newer(candidate: dict, current: dict | None, field: str = "timestamp") -> bool:
+    if current is None:
+        return True
+    return (candidate[field], candidate["id"]) >= (current[field], current["id"])
+
+
+class LatestCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._readings: dict[str, dict] = {}
+        self._latest_exception: dict | None | object = MISSING
+
+    # --- readings ---
+
+    def get_reading(self, user_id: str) -> dict | None:
+        with self._lock:
+            reading = self._readings.get(user_id)
+            return dict(reading) if reading else None
+
+    def put_reading(self, record: dict):
+        """Keep the record if it is the newest known reading of its user (batches can arrive out of order)."""
+        reading = {field: record.get(field) for field in SENSOR_FIELDS}
+        with self._lock:
+            if _newer(reading, self._readings.get(reading["user_id"])):
+                self._readings[reading["user_id"]] = reading
+
+    def invalidate_reading(self, user_id: str, record_id: int | None = None):
+        """Forget the user's latest reading (only if it is `record_id`, when given); the next read reloads it."""
+        with self._lock:
+            reading = self._readings.get(user_id)
+            if reading and (record_id is None or reading["id"] == record_id):
+                del self._readings[user_id]
+
+    def drop_readings_before(self, timestamp: int):
+        """Forget the cached readings older than `timestamp` (their partition was dropped)."""
+        with self._lock:
+            for user_id in [user_id for user_id, reading in self._readings.items() if reading["timestamp"] < timestamp]:
+                del self._readings[user_id]
+
+    # --- exceptions ---
+
+    def get_latest_exception(self) -> dict | None | object:
+        with self._lock:
+            latest = self._latest_exception
+            return dict(latest) if isinstance(latest, dict) else latest
+
+    def put_exception(self, record: dict):
+        """Keep the episode if it is the most recently detected one (by last_seen), an update of it included."""
+        exception = {field: record.get(field) for field in EXCEPTION_FIELDS}
+        with self._lock:
+            latest = self._latest_exception
+            if latest is not MISSING and _newer(exception, latest, "last_seen"):
+                self._latest_exception = exception
+
+    def load_latest_exception(self, exception: dict | None):
+        """Fill the global latest from the DB, unless a newer write already got in meanwhile."""
+        with self._lock:
+            latest = self._latest_exception
+            if latest is MISSING or (exception is not None and _newer(exception, latest, "last_seen")):
+                self._latest_exception = exception
+
+    def invalidate_exceptions(self):
+        """Forget the global latest; the next read reloads it."""
+        with self._lock:
+            self._latest_exception = MISSING
+
+    def drop_user(self, user_id: str):
+        self.invalidate_reading(user_id)
+        self.invalidate_exceptions()
+
+    def clear(self):
+        with self._lock:
+            self._readings.clear()
+            self._latest_exception = MISSING
+
+
+latest_cache = LatestCache()
@@ -1,61 +1,67 @@
-from model import (
-    add_exception,
-    get_sensor_data_between_dates,
-)
+from contextlib import nullcontext
 
-from datetime import datetime, timedelta
+from alerts import alert_tracker
+from metrics import DETECTOR_SECONDS, timed
+from rules import RULES
+from stream import UserStream, get_stream
 
 
-def check_all_conditions(user_id: str, timestamp: str):
-    # detect_fall(user_id, timestamp)
-    # detect_heatstroke(user_id, timestamp)
-    # detect_hypothermia(user_id, timestamp)
-    # detect_dehydration(user_id, timestamp)
-    # detect_presyncope(user_id, timestamp)
-    analyze_high_temperature_short_window(user_id, timestamp)
-    pass
+def check_all_conditions(user_id: str, timestamp: int, readings: list[dict] | None = None):
+    """
+    Run the detection rules for a user. `readings` are the rows that were just stored (with their ids),
+    they are pushed into the user's in-memory windows so no window query is needed.
+    """
+    run_rules(user_id, timestamp, readings)
+
 
+def add_exception_helper(user_id: str, exception_type: str, exception_level: str, details: str, timestamp: int):
+    # עובר דרך מצב ההתראות: רק זיהוי שפותח אפיזודה מוסיף שורה.
+    # הזמן הוא של המדידה שהפעילה את הזיהוי, לא של השרת, כך שתור עמוס או מדידות מאוחרות לא מזיזים את האפיזודה
+    alert_tracker.fire(user_id, exception_type, exception_level, details, timestamp)
 
-def add_exception_helper(user_id: str, exception_type: str, exception_level: str, details: str):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    add_exception(user_id, exception_type, exception_level, details, timestamp)
 
+def clear_exception_helper(user_id: str, exception_type: str, timestamp: int):
+    alert_tracker.clear(user_id, exception_type, timestamp)
 
-# temperature_analysis.py\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+
+def detect_alerts(stream: UserStream, timed_rules: bool = False) -> dict[str, tuple[str, str] | None]:
+    """
+    Evaluate every rule of rules.py on a user's current windows, without touching the DB.
+    Returns exception_type -> (exception_level, details), or None when the rule ran and the condition
+    does not hold (which resolves an open episode); rules without enough samples in their window are left out.
+    Used by the live detection and by the replay of stored data.
+    With `timed_rules` each rule's evaluation is observed in hm_detector_seconds under the rule's name.
+    """
+    alerts = {}
+    for rule in RULES:
+        window = stream.windows[rule.window]
+        if window.count >= rule.min_samples:
+            with DETECTOR_SECONDS.time(rule.exception_type) if timed_rules else nullcontext():
+                alerts[rule.exception_type] = rule.evaluate(window)
+    return alerts
 
 
-def analyze_high_temperature_short_window(user_id: str, timestamp_str: str):
+@timed(DETECTOR_SECONDS)
+def run_rules(user_id: str, timestamp: int, readings: list[dict] | None = None):
     """
-    Checks if body temperature stayed within 28–34°C for 10 consecutive seconds (5 samples).
-    If so, logs a 'heatstroke' exception with level 'red'.
+    Push the new readings into the user's windows, once for all the rules, and evaluate every rule on the windows
+    ending at `timestamp` (epoch ms, the newest reading). A rule that holds logs its exception at `timestamp`
+    (a repeat only updates the open episode), one that ran and does not hold resolves the open episode at `timestamp`.
+    The windows live in memory: the DB is read only when the user's stream is first built.
     """
-    try:
-        ts = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-    except ValueError:
-        print("❌ Invalid timestamp format. Use YYYY-MM-DD HH:MM:SS")
-        return
-
-    from_ts = (ts - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M:%S")
-    to_ts = timestamp_str
-
-    # Get sensor data from the last 1 minute
-    rows = get_sensor_data_between_dates(from_ts, to_ts)
-
-    if not rows or len(rows) < 3:
-        print(f"There are {len(rows) if rows else 0} records in the database")
-        print("ℹ Not enough data for 1-minute temperature analysis")
-        return
-
-    # Check if all temperature values are in the critical range
-    print(f"Analyzing {len(rows)} records from {from_ts} to {to_ts}")
-    if all(34.0 <= float(r["temperature"]) for r in rows):
-        temp_values = [round(float(r["temperature"]), 1) for r in rows]
-        avg_temp = sum(temp_values) / len(temp_values)
-        timestamp = rows[-1]["timestamp"]  # timestamp of the most recent record
-
-        details = f"Abnormally consistent temperature ({avg_temp:.1f}°C) detected for 1 minute"
-        print(f"ALERT: {details} | User: {user_id} | Timestamp: {timestamp}")
-        add_exception_helper(user_id, "heatstroke", "red", details)
+    stream = get_stream(user_id, timestamp)
+    with stream.lock:
+        for reading in readings or []:
+            stream.add(reading)
+        stream.advance(timestamp)
+        alerts = detect_alerts(stream, timed_rules=True)
+
+    for exception_type, alert in alerts.items():
+        if alert is None:
+            clear_exception_helper(user_id, exception_type, timestamp)
+            continue
+        exception_level, details = alert
+        add_exception_helper(user_id, exception_type, exception_level, details, timestamp)
 
 
 #         # Call add_exception directly with valid values
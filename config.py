@@ -0,0 +1,71 @@
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+# הגדרות השרת, ניתנות לדריסה במשתני סביבה עם הקידומת HM_ או בקובץ .env
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="HM_", env_file=".env", extra="ignore")
+
+    # --- Database ---
+    database_url: str = "sqlite:///health_monitor.db"
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    db_pool_timeout: float = 30.0
+    sqlite_busy_timeout_ms: int = 5000
+    sqlite_synchronous: str = "NORMAL"
+
+    # --- Sensor storage: "none" = the main DB's sensor_data table, or partition files by "day", "shard", "day+shard"
+    sensor_partition_by: str = "none"
+    sensor_shards: int = 4
+    sensor_partition_dir: str = "sensor_partitions"
+
+    # --- Detection pipeline ---
+    detection_async: bool = True
+    detection_workers: int = 4
+    detection_queue_capacity: int = 1000
+    detection_latency_budget_ms: int = 1000
+
+    # --- Detection rules (rules.py): the windows are part of each rule, the thresholds are here ---
+    detection_rules: str = "heatstroke,coldshock,fall,dehydration,pre_syncope"
+    rule_heatstroke_temperature: float = 34.0  # טמפרטורת עור, כל המדידות של הדקה האחרונה
+    rule_coldshock_temperature: float = 29.5  # ממוצע 5 הדקות
+    rule_tremor_movement: float = 1.5  # עוצמת תנועה שנחשבת רעד
+    rule_coldshock_tremors: int = 2
+    rule_fall_impact_movement: float = 2.5
+    rule_fall_still_movement: float = 0.1
+    rule_dehydration_sweat_level: float = 0.1
+    rule_dehydration_heart_rate: float = 100
+    rule_presyncope_heart_rate: float = 45
+
+    # --- Alerts ---
+    open_alert_seconds: int = 300  # חריגה אדומה נחשבת פתוחה בחלון הזה
+    alert_cooldown_seconds: float = 120  # זיהוי בתוך הזמן הזה מהסגירה (או מהזיהוי הקודם) ממשיך את אותה אפיזודה
+    alert_flush_seconds: float = 10  # כל כמה זמן זיהויים חוזרים של אפיזודה פתוחה נכתבים ל-DB
+
+    # --- Several worker processes (uvicorn --workers N): events and cache updates relayed between them,
+    # 0 = 200 ms when the process is one of several workers, off in a single process
+    event_relay_interval_ms: int = 0
+    event_relay_keep_seconds: float = 60  # כמה זמן אירוע נשאר בטבלת shared_event
+
+    # --- Fleet analysis (Situation_analysis rules on the whole fleet), 0 = disabled ---
+    fleet_analysis_interval_seconds: float = 0
+    # הספים בסקאלות של החיישן: טמפרטורת עור (לא טמפרטורת גוף) ו-sweat_level בין 0 ל-1
+    fleet_warm_temperature: float = 34.0  # סימן מוקדם למכת חום, כמו rule_heatstroke_temperature
+    fleet_hot_temperature: float = 36.0  # סימן קריטי למכת חום
+    fleet_normal_temperature: float = 33.0  # התייבשות: חלון שמתחיל עד הטמפרטורה הזו ומגיע ל-fleet_warm_temperature
+    fleet_cold_temperature: float = 29.5  # היפותרמיה, כמו rule_coldshock_temperature
+    fleet_dry_sweat_level: float = 0.1  # עור יבש, כמו rule_dehydration_sweat_level
+    fleet_sweating_level: float = 0.5  # הזעה ניכרת
+
+    # --- Retention, 0 days = keep forever, 0 interval = only via `python retention.py` ---
+    retention_interval_seconds: float = 0
+    retention_raw_days: float = 30
+    retention_alert_window_minutes: int = 10  # מדידות סביב חריגה של המשתמש נשמרות עד retention_alert_days
+    retention_alert_days: float = 365
+    retention_rollup_1m_days: float = 90
+    retention_rollup_1h_days: float = 0
+    retention_batch_size: int = 2000
+    retention_batch_pause_ms: int = 50  # הפסקה בין batches כדי לתת לכתיבות של הקליטה להיכנס
+    retention_vacuum_pages: int = 5000
+
+
+settings = Settings()
@@ -28,8 +28,7 @@ type Exception = {
   details: string;
 };
 
-const METRICS_URL = 'http://51.17.183.152:3000/metrics/last/1';
-const EXCEPTION_URL = 'http://51.17.183.152:3000/test';
+const STREAM_URL = 'http://51.17.183.152:3000/stream?user_id=1';
 
 export default function App() {
   const [dataHistory, setDataHistory] = useState<Metric[]>([]);
@@ -43,6 +42,7 @@ export default function App() {
   const silenceLockUntil = useRef<number | null>(null);
   const userFirstSeenAt = useRef<{ [key: string]: number }>({});
   const panicButtonPressed = useRef(false);
+  const emergencyTimeout = useRef<ReturnType<typeof setTimeout> | null>(null);
   const [panicActive, setPanicActive] = useState(false); // 🆕 עוקב אם לחצן מצוקה נלחץ
 
 
@@ -115,122 +115,120 @@ async function triggerBuzzer() {
 //   }
 // }
 
-async function checkEmergencyButton() {
+// ✅ מצב לחצן המצוקה מגיע ב-/stream במקום polling ל-/emergency
+async function handleEmergency(status: boolean) {
   try {
-    const res = await fetch('http://51.17.183.152:3000/emergency');
-    const data = await res.json();
-
     // ✅ רק אם החומרה באמת שלחה לחיצה
-    if (data.status && !panicButtonPressed.current) {
+    if (status && !panicButtonPressed.current) {
       panicButtonPressed.current = true; // זוכר שהלחצן נלחץ
       setPanicActive(true); // מציג עיגול אדום ליד היוזר
       await triggerBuzzer();
       await sendEmergencyOn();
-    } else if (!data.status) {
+    } else if (!status) {
       panicButtonPressed.current = false; // מאפס כשהלחצן לא נלחץ
       setPanicActive(false); // מעלים את העיגול האדום
     }
   } catch (err) {
-    console.error('Failed to check emergency button:', err);
+    console.error('Failed to handle emergency button:', err);
   }
 }
 
+function handleMetric(data: ServerMetric) {
+  setLatest(data);
+  setServerHistory(prev => [...prev, data].slice(-300));
+  if (!panicMode && exception?.exception_level === 'red') {
+    const isNowNormal = !analyzeMetrics(dataHistory, false, false);
+    if (isNowNormal) {
+      setException(null); // חזר למצב תקין
+    }
+  }
 
+  if (!userFirstSeenAt.current[data.user_id]) {
+    userFirstSeenAt.current[data.user_id] = Date.now(); // נרשם זמן כניסה של חייל חדש
+  }
 
-  useEffect(() => {
-    const interval = setInterval(async () => {
-      try {
-        const response = await fetch(METRICS_URL);
-        if (response.ok) {
-          const data: ServerMetric = await response.json();
-          setLatest(data);
-          setServerHistory(prev => [...prev, data].slice(-300));
-          await checkEmergencyButton();
-          if (!panicMode && exception?.exception_level === 'red') {
-             const isNowNormal = !analyzeMetrics(dataHistory, false, false);
-           if (isNowNormal) {
-         setException(null); // חזר למצב תקין
-        }
-}
-
-          if (!userFirstSeenAt.current[data.user_id]) {
-               userFirstSeenAt.current[data.user_id] = Date.now(); // נרשם זמן כניסה של חייל חדש
-              }
-
-
-          // שמירה של עד 10 דקות אחרונות (300 נקודות × 2 שניות)
-          setDataHistory(prev => {
-            const entry = {
-             time: new Date(data.timestamp).getTime(),
-              pulse: data.heart_rate,
-              temperature: data.temperature,
-             sweat: data.sweat_level,
-            };
-           const trimmed = [...prev, entry].slice(-300);
-
-            const now = Date.now();
-            const silenced = !!(silenceLockUntil.current && now < silenceLockUntil.current);
-            const localEx = analyzeMetrics(trimmed, silenced, panicMode);
-
-
-//             const advancedEx = analyzeAdvancedMetrics([...serverHistory, data].slice(-150));
-//             if (advancedEx) {
-//                 setException(advancedEx);
-//                 setIsSilenced(false);
-//                 silenceTime.current = null;
-// }
+  // שמירה של עד 10 דקות אחרונות (300 נקודות × 2 שניות)
+  setDataHistory(prev => {
+    const entry = {
+      time: new Date(data.timestamp).getTime(),
+      pulse: data.heart_rate,
+      temperature: data.temperature,
+      sweat: data.sweat_level,
+    };
+    const trimmed = [...prev, entry].slice(-300);
 
-            if (localEx) {
-              setException(localEx);
-              sendEmergencyOn();
-              triggerBuzzer();
-              setIsSilenced(false);
-              silenceTime.current = null;
-            }
+    const now = Date.now();
+    const silenced = !!(silenceLockUntil.current && now < silenceLockUntil.current);
+    const localEx = analyzeMetrics(trimmed, silenced, panicMode);
 
-            return trimmed;
-        });
+    if (localEx) {
+      setException(localEx);
+      sendEmergencyOn();
+      triggerBuzzer();
+      setIsSilenced(false);
+      silenceTime.current = null;
+    }
 
-        }
-      } catch (err) {
-        console.error('Metrics error:', err);
-      }
+    return trimmed;
+  });
+}
 
-     try {
-  const res = await fetch(`${EXCEPTION_URL}?date_str=${lastExceptionDate.current}`);
-  const data = await res.json();
+function handleException(newData: Exception) {
   const now = Date.now();
 
-  if (data && data.new_data && data.new_data.user_id === latest?.user_id) {
-    const details = data.new_data.details ?? '';
-
-    // ✅ אם מדובר בחריגה שאנחנו רוצים להתעלם ממנה – דלג
-    if (details.includes('Abnormally consistent temperature')) {
-      console.log('התעלמות מחריגה: Abnormally consistent temperature');
-      return; // לא נציג את החריגה הזו
-    }
+  if (newData.user_id !== latest?.user_id) {
+    return;
+  }
 
-    const newTimestamp = data.new_data.timestamp;
+  // ✅ אם מדובר בחריגה שאנחנו רוצים להתעלם ממנה – דלג
+  if (newData.details.includes('Abnormally consistent temperature')) {
+    console.log('התעלמות מחריגה: Abnormally consistent temperature');
+    return; // לא נציג את החריגה הזו
+  }
 
-    if (isSilenced && silenceTime.current && now - silenceTime.current > 10000) {
-      lastExceptionDate.current = newTimestamp;
-      setException(data.new_data);
-      setIsSilenced(false);
-      silenceTime.current = null;
-    } else if (!isSilenced) {
-      lastExceptionDate.current = newTimestamp;
-      setException(data.new_data);
-    }
-  } else if (isSilenced && silenceTime.current && now - silenceTime.current > 15000) {
-    setException(null);
+  if (isSilenced && silenceTime.current && now - silenceTime.current > 10000) {
+    lastExceptionDate.current = newData.timestamp;
+    setException(newData);
+    setIsSilenced(false);
+    silenceTime.current = null;
+  } else if (!isSilenced) {
+    lastExceptionDate.current = newData.timestamp;
+    setException(newData);
   }
-} catch (err) {
-  console.error('Exception error:', err);
 }
 
+  useEffect(() => {
+    // ✅ חיבור אחד ל-/stream במקום polling כל 2 שניות
+    const source = new EventSource(STREAM_URL);
+    const parse = (event: Event) => JSON.parse((event as MessageEvent).data);
+
+    source.addEventListener('metric', event => handleMetric(parse(event)));
+    source.addEventListener('exception', event => handleException(parse(event)));
+    source.addEventListener('emergency', event => {
+      const data = parse(event);
+      handleEmergency(data.status);
+
+      // השרת מכבה את מצב החירום לבד אחרי זמן קצוב, בלי לשלוח אירוע
+      if (emergencyTimeout.current) clearTimeout(emergencyTimeout.current);
+      if (data.status && data.expires_at) {
+        const expiresIn = new Date(data.expires_at.replace(' ', 'T')).getTime() - Date.now();
+        emergencyTimeout.current = setTimeout(() => handleEmergency(false), Math.max(0, expiresIn));
+      }
+    });
+    source.onerror = err => console.error('Stream error:', err); // EventSource מתחבר מחדש לבד
+
+    // ניקוי מקומי בלבד, בלי פניות לשרת
+    const interval = setInterval(() => {
+      if (isSilenced && silenceTime.current && Date.now() - silenceTime.current > 15000) {
+        setException(null);
+      }
     }, 2000);
 
-    return () => clearInterval(interval);
+    return () => {
+      source.close();
+      clearInterval(interval);
+      if (emergencyTimeout.current) clearTimeout(emergencyTimeout.current);
+    };
   }, [latest?.user_id]);
 
  const handleSilence = async () => {
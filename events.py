@@ -0,0 +1,75 @@
+import asyncio
+import threading
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+# pub/sub בתוך התהליך: הכתיבות ל-DB מפרסמות אירועים, וחיבורי /stream מקבלים רק את מה שנרשמו אליו.
+# כשרצים כמה תהליכי worker, shared.py מציב relay שמעביר כל אירוע גם לשאר ה-workers
+
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+@dataclass(eq=False)
+class Subscription:
+    loop: asyncio.AbstractEventLoop
+    user_ids: set[str] | None  # None = כל המשתמשים
+    queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE))
+    dropped: int = 0
+
+    def wants(self, user_id: str | None) -> bool:
+        return user_id is None or self.user_ids is None or user_id in self.user_ids
+
+
+class EventBus:
+    def __init__(self):
+        self._subscriptions: set[Subscription] = set()
+        self._lock = threading.Lock()
+        self.relay: Callable[[str, dict, str | None], None] | None = None
+
+    def subscribe(self, user_ids: set[str] | None = None) -> Subscription:
+        """Must be called from the event loop that will consume the subscription."""
+        subscription = Subscription(loop=asyncio.get_running_loop(), user_ids=user_ids)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscriptions)
+
+    def publish(self, event_type: str, data: dict, user_id: str | None = None):
+        """Thread safe, can be called from the sync handlers, the detection workers or the loop itself."""
+        self.share(event_type, data, user_id)
+        self.deliver(event_type, data, user_id)
+
+    def share(self, event_type: str, data: dict, user_id: str | None = None):
+        """Send to the other worker processes only: state changes they apply (cache updates), not for /stream."""
+        if self.relay is not None:
+            self.relay(event_type, data, user_id)
+
+    def deliver(self, event_type: str, data: dict, user_id: str | None = None):
+        """Send to this process's subscribers only (an event that came from another worker)."""
+        if not self._subscriptions:
+            return
+        with self._lock:
+            targets = [subscription for subscription in self._subscriptions if subscription.wants(user_id)]
+        for subscription in targets:
+            try:
+                subscription.loop.call_soon_threadsafe(self._deliver, subscription, (event_type, data))
+            except RuntimeError:  # the subscriber's loop is already closed
+                self.unsubscribe(subscription)
+
+    @staticmethod
+    def _deliver(subscription: Subscription, event: tuple[str, dict]):
+        # לקוח איטי לא מעכב אף אחד, אירועים שלא נכנסים לתור שלו נזרקים ונספרים
+        try:
+            subscription.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            subscription.dropped += 1
+
+
+bus = EventBus()
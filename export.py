@@ -0,0 +1,87 @@
+import argparse
+import csv
+import io
+import json
+import sys
+
+from cache import SENSOR_FIELDS
+from model import Session, iter_sensor_data
+from timestamps import format_ms, to_ms
+
+# ייצוא מדידות בטווח זמנים כ-NDJSON או CSV, chunk אחרי chunk מה-cursor, בלי לבנות את כל הטווח בזיכרון:
+#   python export.py --from "2025-06-01 00:00:00" --to "2025-06-02 00:00:00" --format csv --output day.csv
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def check_export(export_format: str, columns: list[str] | None) -> dict:
+    if export_format not in EXPORT_FORMATS:
+        return {"error": f"Unknown format '{export_format}', use one of: {', '.join(EXPORT_FORMATS)}"}
+    unknown = [name for name in columns or [] if name not in SENSOR_FIELDS]
+    if unknown:
+        return {"error": f"Unknown columns: {', '.join(unknown)}"}
+    return {"format": export_format, "columns": list(columns or SENSOR_FIELDS)}
+
+
+def _ndjson(rows: list[dict]) -> str:
+    return "".join(json.dumps(row, default=str) + "\n" for row in rows)
+
+
+def _csv(rows: list[dict], columns: list[str], header: bool = False) -> str:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, lineterminator="\n")
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def export_chunks(
+    period: tuple[int, int],
+    user_ids: list[str] | None = None,
+    columns: list[str] | None = None,
+    export_format: str = "ndjson",
+    chunk_size: int = 5000,
+):
+    """
+    Yield the export of the (start, end) range as text chunks, one per cursor chunk.
+    The generator opens its own Session: a StreamingResponse keeps consuming it after the request's session is gone.
+    """
+    columns = list(columns or SENSOR_FIELDS)
+    if export_format == "csv":
+        yield _csv([], columns, header=True)
+    with Session() as db:
+        for rows in iter_sensor_data(period, user_ids, chunk_size, columns, db=db):
+            if "timestamp" in columns:
+                for row in rows:
+                    row["timestamp"] = format_ms(row["timestamp"])
+            yield _csv(rows, columns) if export_format == "csv" else _ndjson(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export stored sensor data as NDJSON or CSV")
+    parser.add_argument("--from", dest="start_date", type=to_ms, required=True, help="YYYY-MM-DD HH:MM:SS")
+    parser.add_argument("--to", dest="end_date", type=to_ms, required=True, help="YYYY-MM-DD HH:MM:SS")
+    parser.add_argument("--user", dest="user_ids", action="append", help="Export only this user (repeatable)")
+    parser.add_argument("--columns", help=f"Comma separated subset of: {','.join(SENSOR_FIELDS)}")
+    parser.add_argument("--format", dest="export_format", default="ndjson", choices=list(EXPORT_FORMATS))
+    parser.add_argument(
+        "--output", type=argparse.FileType("w", encoding="utf-8"), default=sys.stdout, help="Default stdout"
+    )
+    parser.add_argument("--chunk-size", type=int, default=5000, help="Rows fetched from the cursor at a time")
+    args = parser.parse_args()
+
+    columns = [name.strip() for name in args.columns.split(",") if name.strip()] if args.columns else None
+    checked = check_export(args.export_format, columns)
+    if "error" in checked:
+        parser.error(checked["error"])
+
+    period = (args.start_date, args.end_date)
+    chunks = export_chunks(period, args.user_ids, checked["columns"], args.export_format, args.chunk_size)
+    with args.output as output:
+        for chunk in chunks:
+            output.write(chunk)
+
+
+if __name__ == "__main__":
+    main()
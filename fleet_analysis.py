@@ -0,0 +1,190 @@
+import threading
+
+import numpy as np
+
+from alerts import alert_tracker
+from config import settings
+from metrics import DETECTOR_SECONDS, timed
+from model import get_fleet_sensor_rows, session_scope
+from shared import LEASE_INTERVALS, holds_lease
+from timestamps import MINUTE, now_ms
+
+# הכללים של Situation_analysis.py (מכת חום, התייבשות, היפותרמיה) על מערכי NumPy:
+# שאילתה אחת לכל הצי, וכל כלל מחושב לכל המשתמשים יחד במקום חיבור + שאילתות + לולאות לכל משתמש
+
+WINDOW = 5 * MINUTE
+COLUMNS = ["heart_rate", "temperature", "sweat_level", "movement_x", "movement_y", "movement_z"]
+MIN_SAMPLES = 2  # פחות מזה אי אפשר להעריך מגמה
+SEVERE_SCORE = 4
+EARLY_SCORE = 2
+TREMOR_THRESHOLD = settings.rule_tremor_movement  # עוצמת תנועה שנחשבת רעד
+
+
+class FleetWindow:
+    """
+    The readings of many users as column arrays. Rows come sorted by user then time,
+    so every user is one contiguous segment and per-user aggregates are numpy `reduceat` calls.
+    """
+
+    def __init__(self, rows: list[tuple]):
+        user_ids = np.array([row[0] for row in rows])
+        values = np.array([row[1:] for row in rows], dtype=float)  # NULL -> nan
+        self.columns = dict(zip(COLUMNS, values.T, strict=True))
+        self.columns["movement"] = np.sqrt(
+            self.columns["movement_x"] ** 2 + self.columns["movement_y"] ** 2 + self.columns["movement_z"] ** 2
+        )
+        self.starts = np.r_[0, np.flatnonzero(user_ids[1:] != user_ids[:-1]) + 1]
+        self.ends = np.r_[self.starts[1:], len(user_ids)] - 1
+        self.users = user_ids[self.starts]
+        self.sizes = self.ends - self.starts + 1
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    def any(self, mask: np.ndarray) -> np.ndarray:
+        return np.logical_or.reduceat(mask, self.starts)
+
+    def count(self, mask: np.ndarray) -> np.ndarray:
+        return np.add.reduceat(mask.astype(int), self.starts)
+
+    def min(self, column: np.ndarray) -> np.ndarray:
+        return np.fmin.reduceat(column, self.starts)
+
+    def max(self, column: np.ndarray) -> np.ndarray:
+        return np.fmax.reduceat(column, self.starts)
+
+    def mean(self, column: np.ndarray) -> np.ndarray:
+        """NULL readings are skipped, a user without any value gets nan (every comparison with it is False)."""
+        valid = ~np.isnan(column)
+        with np.errstate(invalid="ignore"):
+            return np.add.reduceat(np.where(valid, column, 0.0), self.starts) / self.count(valid)
+
+    def first(self, column: np.ndarray) -> np.ndarray:
+        return column[self.starts]
+
+    def last(self, column: np.ndarray) -> np.ndarray:
+        return column[self.ends]
+
+
+def heat_stroke_scores(window: FleetWindow) -> np.ndarray:
+    temps, heart_rates, sweats = window["temperature"], window["heart_rate"], window["sweat_level"]
+    fever = window.any(temps >= settings.fleet_hot_temperature)
+    # כמו ב-Situation_analysis.py: עור יבש בנקודה כלשהי בחלון לסימן הקריטי, ויבש בסוף החלון להזיע והתייבש
+    dried = window.min(sweats) <= settings.fleet_dry_sweat_level
+    dry = window.last(sweats) <= settings.fleet_dry_sweat_level
+    # Critical signs
+    score = 2.0 * fever
+    score += 1.5 * (window.count(heart_rates >= 130) >= 2)
+    score += 2.0 * (dried & fever)
+    # Early warning signs
+    score += 1.0 * window.any((temps >= settings.fleet_warm_temperature) & (temps < settings.fleet_hot_temperature))
+    score += 1.0 * window.any((heart_rates >= 110) & (heart_rates < 130))
+    score += 1.0 * ((window.max(sweats) > settings.fleet_sweating_level) & dry)
+    return score
+
+
+def dehydration_scores(window: FleetWindow) -> np.ndarray:
+    temps, heart_rates, sweats = window["temperature"], window["heart_rate"], window["sweat_level"]
+    score = 1.0 * (window.last(heart_rates) - window.first(heart_rates) > 10)
+    warming = window.first(temps) <= settings.fleet_normal_temperature
+    score += 1.5 * (warming & (window.max(temps) >= settings.fleet_warm_temperature))
+    # הזיע בתחילת החלון והתייבש: ממוצע ולא מינימום, כדי שמדידה רועשת אחת לא תהפוך עור מזיע ליבש
+    drying = window.first(sweats) > settings.fleet_dry_sweat_level
+    score += 2.0 * (drying & (window.mean(sweats) <= settings.fleet_dry_sweat_level))
+    # אין חיישן חמצן בטבלת sensor_data, לכן התנאי על רמת החמצן לא הועבר
+    return score
+
+
+def hypothermia_scores(window: FleetWindow) -> np.ndarray:
+    score = 2.0 * window.any(window["temperature"] < settings.fleet_cold_temperature)
+    score += 1.5 * (window.count(window["movement"] > TREMOR_THRESHOLD) >= 2)
+    score += 1.0 * (window.mean(window["sweat_level"]) <= settings.fleet_dry_sweat_level)
+    return score
+
+
+# name: (scorer, exception_type, severe message, early message)
+RULES = {
+    "heat_stroke": (heat_stroke_scores, "heatstroke", "Severe heat stroke risk", "Early heat stroke warning"),
+    "dehydration": (dehydration_scores, "dehydration", "Severe dehydration risk", "Early dehydration warning"),
+    "hypothermia": (hypothermia_scores, "coldshock", "Severe hypothermia risk", "Early hypothermia warning"),
+}
+
+
+def fleet_scores(window: FleetWindow) -> dict[str, np.ndarray]:
+    return {name: scorer(window) for name, (scorer, *_) in RULES.items()}
+
+
+def fleet_alerts(window: FleetWindow, timestamp: int) -> list[dict]:
+    enough = window.sizes >= MIN_SAMPLES
+    alerts = []
+    for name, scores in fleet_scores(window).items():
+        _, exception_type, severe_message, early_message = RULES[name]
+        severe = enough & (scores >= SEVERE_SCORE)
+        early = enough & (scores >= EARLY_SCORE) & ~severe
+        for level, message, mask in (("red", severe_message, severe), ("yellow", early_message, early)):
+            alerts.extend(
+                {
+                    "user_id": str(user_id),
+                    "exception_type": exception_type,
+                    "exception_level": level,
+                    "details": f"{message} (score {score:g})",
+                    "timestamp": timestamp,
+                }
+                for user_id, score in zip(window.users[mask], scores[mask], strict=True)
+            )
+    return alerts
+
+
+@timed(DETECTOR_SECONDS)
+def score_fleet(now: int | None = None, write: bool = True) -> list[dict]:
+    """One batched pass over the last 5 minutes (before `now`, epoch ms) of every user's readings."""
+    timestamp = now or now_ms()
+    rows = get_fleet_sensor_rows(timestamp - WINDOW, timestamp, COLUMNS)
+    if not rows:
+        return []
+    alerts = fleet_alerts(FleetWindow(rows), timestamp)
+    if write:
+        # סריקה כל interval מזהה שוב את אותם משתמשים, רק אפיזודה חדשה או הסלמה נכתבות
+        for alert in alerts:
+            alert_tracker.fire(**alert)
+    return alerts
+
+
+class FleetAnalyzer:
+    """Runs score_fleet every `interval` seconds on a background thread."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="fleet-analysis", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(self.interval)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not holds_lease("fleet-analysis", LEASE_INTERVALS * self.interval):
+                continue  # worker אחר מריץ את הניתוח
+            with session_scope() as db:
+                try:
+                    alerts = score_fleet()
+                except Exception as error:  # a bad tick must not kill the loop
+                    db.rollback()
+                    print(f"❌ Fleet analysis failed: {error}")
+                    continue
+            if alerts:
+                print(f"ALERT: fleet analysis raised {len(alerts)} alerts")
+
+
+fleet_analyzer = FleetAnalyzer(settings.fleet_analysis_interval_seconds)
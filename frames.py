@@ -0,0 +1,67 @@
+import numpy as np
+
+from timestamps import SECOND, now_ms
+
+# פורמט קליטה בינארי למכשירים קטנים: רצף של frames בגודל קבוע, little-endian, בלי JSON ובלי pydantic.
+# כל frame הוא 26 בתים (לעומת כ-150 בתים של מדידה ב-JSON):
+#   uint32 timestamp (שניות unix, 0 = זמן הקבלה בשרת), uint16 heart_rate,
+#   float32 temperature, movement_x, movement_y, movement_z, sweat_level
+# השרת קורא את הגוף כ-view של NumPy (frombuffer, בלי העתקה) ובודק את כל העמודות בבת אחת.
+
+FRAME_MEDIA_TYPE = "application/vnd.hm.sensor-frames"
+FRAME = np.dtype(
+    [
+        ("timestamp", "<u4"),
+        ("heart_rate", "<u2"),
+        ("temperature", "<f4"),
+        ("movement_x", "<f4"),
+        ("movement_y", "<f4"),
+        ("movement_z", "<f4"),
+        ("sweat_level", "<f4"),
+    ]
+)
+FLOAT_FIELDS = ("temperature", "movement_x", "movement_y", "movement_z", "sweat_level")
+FLOAT_DECIMALS = 4  # float32 מחזיק ~7 ספרות, 36.6 נשמר כ-36.6 ולא 36.599998
+
+
+def frame_count(body: bytes) -> int | None:
+    """Number of frames in the body, None when its length is not a whole number of frames."""
+    count, rest = divmod(len(body), FRAME.itemsize)
+    return None if rest else count
+
+
+def _timestamps(seconds: np.ndarray, now: int) -> np.ndarray:
+    """Unix seconds as the epoch ms the readings are stored with."""
+    return np.where(seconds == 0, now, seconds.astype(np.int64) * SECOND)
+
+
+def decode_frames(body: bytes, now: int | None = None) -> dict:
+    """The frames as reading dicts for add_sensor_data_batch ({"records": [...]}), or {"error": ...}."""
+    if frame_count(body) is None:
+        return {"error": f"Body length {len(body)} is not a multiple of the {FRAME.itemsize}-byte frame"}
+    frames = np.frombuffer(body, dtype=FRAME)
+    invalid = np.zeros(len(frames), dtype=bool)
+    for name in FLOAT_FIELDS:
+        invalid |= ~np.isfinite(frames[name])
+    if invalid.any():
+        return {"error": f"Frame {int(np.argmax(invalid))} has a NaN or infinite value"}
+
+    columns = {
+        "timestamp": _timestamps(frames["timestamp"], now or now_ms()).tolist(),
+        "heart_rate": frames["heart_rate"].tolist(),
+        **{name: frames[name].astype(float).round(FLOAT_DECIMALS).tolist() for name in FLOAT_FIELDS},
+    }
+    return {"records": [dict(zip(columns, values, strict=True)) for values in zip(*columns.values(), strict=True)]}
+
+
+def encode_frames(readings: list[dict]) -> bytes:
+    """The device side: readings (dicts with a datetime or missing "timestamp") packed as frames."""
+    frames = np.zeros(len(readings), dtype=FRAME)
+    for index, reading in enumerate(readings):
+        timestamp = reading.get("timestamp")
+        frames[index] = (
+            int(timestamp.timestamp()) if timestamp else 0,
+            reading["heart_rate"],
+            *(reading[name] for name in FLOAT_FIELDS),
+        )
+    return frames.tobytes()
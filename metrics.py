@@ -0,0 +1,215 @@
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+from contextlib import contextmanager
+from functools import wraps
+
+from fastapi.routing import APIRoute
+
+# מדדי ביצועים בזיכרון של התהליך (מונים והיסטוגרמות), מוצגים ב-/internal/metrics בפורמט הטקסט של Prometheus.
+# כל רישום הוא נעילה + חיפוש בינארי, כך שאפשר להשאיר אותם דולקים ב-production.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value).replace(chr(34), chr(39))}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *values):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_labels(self.labels, key)} {value}" for key, value in sorted(values.items()))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}  # labels -> [counts per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *values)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts, strict=True):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Read when the metrics are scraped, so nothing is recorded on the hot path."""
+
+    def __init__(self, name: str, description: str, read: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self.read = read
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.register(
+    Counter("hm_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+)
+HTTP_REQUEST_SECONDS = registry.register(
+    Histogram("hm_http_request_seconds", "Whole request, validation and serialization included", ("method", "route"))
+)
+HTTP_HANDLER_SECONDS = registry.register(
+    Histogram("hm_http_handler_seconds", "Endpoint function only, the rest of the request is the framework", ("route",))
+)
+DB_SECONDS = registry.register(Histogram("hm_db_operation_seconds", "model.py CRUD operations", ("operation",)))
+DETECTOR_SECONDS = registry.register(
+    Histogram("hm_detector_seconds", "One rule, a user's rules (run_rules) or the fleet scoring", ("detector",))
+)
+READINGS_INGESTED = registry.register(Counter("hm_readings_ingested_total", "Sensor readings stored"))
+ALERTS_RAISED = registry.register(Counter("hm_alerts_raised_total", "Exceptions stored", ("type", "level")))
+ALERT_DETECTIONS = registry.register(
+    Counter("hm_alert_detections_total", "Detector firings by what they did to the episode", ("type", "action"))
+)
+
+
+def timed(histogram: Histogram):
+    """Decorator: observe every call of the function, labeled with the function's name."""
+
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, function.__name__)
+
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, function.__name__)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (no BaseHTTPMiddleware task per request) counting requests and timing them per route.
+    Unmatched paths share one label so random URLs cannot blow up the number of series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, scope["method"], route)
+            HTTP_REQUESTS.inc(1, scope["method"], route, status)
+
+
+def _timed_endpoint(route: str, endpoint):
+    if asyncio.iscoroutinefunction(endpoint):
+
+        @wraps(endpoint)
+        async def timed_endpoint(*args, **kwargs):
+            with HTTP_HANDLER_SECONDS.time(route):
+                return await endpoint(*args, **kwargs)
+
+    else:
+
+        @wraps(endpoint)
+        def timed_endpoint(*args, **kwargs):
+            with HTTP_HANDLER_SECONDS.time(route):
+                return endpoint(*args, **kwargs)
+
+    return timed_endpoint
+
+
+class TimedRoute(APIRoute):
+    """
+    Times the endpoint function alone. hm_http_request_seconds minus this is the time spent
+    in pydantic validation, dependencies and response serialization.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _timed_endpoint(path, endpoint), **kwargs)
@@ -1,7 +1,24 @@
-from sqlalchemy import create_engine, Column, String, Integer, Float, ForeignKey, CheckConstraint
+from sqlalchemy import and_, case, create_engine, delete, event, func, insert, inspect, select, text, update, make_url
+from sqlalchemy import literal_column, or_, tuple_
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, CheckConstraint, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.orm import aliased, sessionmaker, relationship, scoped_session
+from contextlib import contextmanager
+from contextvars import ContextVar
+import argparse
+import heapq
+import json
+import math
+import threading
+import time
+
+from cache import MISSING, latest_cache
+from config import settings
+from events import bus
+from metrics import ALERTS_RAISED, DB_SECONDS, READINGS_INGESTED, timed
+from storage import SensorStore, rebuild_table
+from timestamps import MINUTE, SECOND, day_start_ms, local_day, local_offset_ms, now_ms, text_to_ms_sql, to_ms
 
 # הגדרת בסיס
 Base = declarative_base()
@@ -15,6 +32,7 @@ class User(Base):
     last_name = Column(String)
     sensor_data = relationship("SensorData", back_populates="user", cascade="all, delete-orphan")
     exceptions = relationship("ExceptionLog", back_populates="user", cascade="all, delete-orphan")
+    rollups = relationship("SensorRollup", cascade="all, delete-orphan")
 
 
 # טבלת מדדים
@@ -22,7 +40,7 @@ class SensorData(Base):
     __tablename__ = "sensor_data"
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
-    timestamp = Column(String, default=datetime.now, nullable=False)
+    timestamp = Column(Integer, default=now_ms, nullable=False)  # מילישניות מ-1970 (timestamps.py)
     heart_rate = Column(Integer)
     temperature = Column(Float)
     movement_x = Column(Float)
@@ -32,17 +50,26 @@ class SensorData(Base):
 
     user = relationship("User", back_populates="sensor_data")
 
+    __table_args__ = (
+        Index("ix_sensor_data_user_timestamp", "user_id", "timestamp"),
+        Index("ix_sensor_data_timestamp", "timestamp"),
+    )
+
 
 # טבלת חריגות
 class ExceptionLog(Base):
     __tablename__ = "exception"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    timestamp = Column(String, default=datetime.now, nullable=False)
+    timestamp = Column(Integer, default=now_ms, nullable=False)
     details = Column(String, nullable=False)
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
     exception_type = Column(String, nullable=False)
     exception_level = Column(String, nullable=False)
+    # כל שורה היא אפיזודה: timestamp = הפתיחה, זיהויים חוזרים רק מעדכנים את last_seen ו-occurrences
+    last_seen = Column(Integer)
+    occurrences = Column(Integer, nullable=False, default=1)
+    resolved_at = Column(Integer)  # None = האפיזודה עדיין פתוחה
 
     user = relationship("User", back_populates="exceptions")
 
@@ -52,19 +79,265 @@ class ExceptionLog(Base):
             name="valid_exception_type",
         ),
         CheckConstraint("exception_level IN ('green', 'yellow', 'red')", name="valid_exception_level"),
+        Index("ix_exception_timestamp", "timestamp"),
+        Index("ix_exception_user_timestamp", "user_id", "timestamp"),
+        Index("ix_exception_last_seen", "last_seen"),
+        Index("ix_exception_user_last_seen", "user_id", "last_seen"),
     )
 
 
-engine = create_engine("sqlite:///health_monitor.db")
+# טבלת סיכומים לפי דקה / שעה, מתעדכנת בכל קליטה של מדידות
+ROLLUP_METRICS = ("heart_rate", "temperature", "sweat_level", "movement")
+# bucket -> גודל ה-bucket במילישניות, bucket_start = timestamp - timestamp % גודל
+ROLLUP_BUCKETS = {"1m": MINUTE, "1h": 60 * MINUTE}
+
+
+class SensorRollup(Base):
+    __tablename__ = "sensor_rollup"
+
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    bucket = Column(String, primary_key=True)
+    bucket_start = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+    heart_rate_min = Column(Float)
+    heart_rate_max = Column(Float)
+    heart_rate_sum = Column(Float)
+    temperature_min = Column(Float)
+    temperature_max = Column(Float)
+    temperature_sum = Column(Float)
+    sweat_level_min = Column(Float)
+    sweat_level_max = Column(Float)
+    sweat_level_sum = Column(Float)
+    movement_min = Column(Float)
+    movement_max = Column(Float)
+    movement_sum = Column(Float)
+
+    __table_args__ = (Index("ix_sensor_rollup_bucket_start", "bucket", "bucket_start"),)
+
+
+# מצב משותף לכל תהליכי ה-worker (shared.py): ערכים בודדים כמו מצב החירום, ו-leases של משימות הרקע
+class SharedState(Base):
+    __tablename__ = "shared_state"
+
+    key = Column(String, primary_key=True)
+    value = Column(Integer)  # ב-lease: מתי הוא פג
+    owner = Column(String)  # ב-lease: ה-worker שמחזיק בו
+    updated_at = Column(Integer, nullable=False, default=now_ms)
+
+
+# האירועים שכל worker שולח לשאר ה-workers, שורה לכל שליחה עם רשימת האירועים ב-JSON
+class SharedEvent(Base):
+    __tablename__ = "shared_event"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    origin = Column(String, nullable=False)
+    created_at = Column(Integer, nullable=False, default=now_ms)
+    events = Column(String, nullable=False)
+
+    # AUTOINCREMENT: id לא חוזר על עצמו גם כשכל השורות נמחקו, ה-workers קוראים לפי id > האחרון שראו
+    __table_args__ = (Index("ix_shared_event_created_at", "created_at"), {"sqlite_autoincrement": True})
+
+
+# ==================== חיבור ל-DB ====================
+
+_is_sqlite = make_url(settings.database_url).get_backend_name() == "sqlite"
+
+engine = create_engine(
+    settings.database_url,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_pre_ping=True,
+    connect_args={"check_same_thread": False, "timeout": settings.sqlite_busy_timeout_ms / 1000} if _is_sqlite else {},
+)
+
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite(dbapi_connection, _connection_record):
+    """WAL lets the dashboard readers and the ingest writer work in parallel."""
+    if not _is_sqlite:
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")  # חל רק על DB חדש, DB קיים: --enable-incremental-vacuum
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}")
+    cursor.close()
+
+
+# המדידות: בטבלת sensor_data של ה-DB הראשי, או בקבצי מחיצות לפי יום / shard (storage.py)
+store = SensorStore(
+    SensorData.__table__,
+    settings.sensor_partition_by,
+    settings.sensor_shards,
+    settings.sensor_partition_dir,
+    {
+        "journal_mode": "WAL",
+        "synchronous": settings.sqlite_synchronous,
+        "busy_timeout": settings.sqlite_busy_timeout_ms,
+    },
+)
+
 Session = sessionmaker(bind=engine)
-session = Session()
-Base.metadata.create_all(engine)
+
+# session הוא proxy: כל בקשה (או thread מחוץ לבקשה) מקבלת Session משלה
+_session_scope: ContextVar[object | None] = ContextVar("session_scope", default=None)
+session = scoped_session(Session, scopefunc=lambda: _session_scope.get() or threading.get_ident())
+
+
+@contextmanager
+def session_scope():
+    """Run the enclosed code on its own session, closed (and rolled back if unfinished) on exit."""
+    token = _session_scope.set(object())
+    try:
+        yield session()
+    finally:
+        session.remove()
+        _session_scope.reset(token)
+
+
+async def db_session():
+    """
+    FastAPI dependency: one session per request.
+    It is async so the scope is set on the request's context, which the threadpool running the sync handlers inherits.
+    """
+    _session_scope.set(object())
+    try:
+        yield session()
+    finally:
+        session.remove()
+
+
+# ==================== מיגרציות ====================
+# כל שלב רץ פעם אחת, הגרסה הנוכחית נשמרת ב-PRAGMA user_version
+
+
+def _create_index(conn, table, name: str):
+    next(index for index in table.indexes if index.name == name).create(conn, checkfirst=True)
+
+
+def _add_hot_path_indexes(conn):
+    # רק האינדקסים של השלב הזה: אינדקס שנוסף למודל אחר כך יכול להיות על עמודה ששלב מאוחר יותר מוסיף
+    _create_index(conn, SensorData.__table__, "ix_sensor_data_user_timestamp")
+    _create_index(conn, ExceptionLog.__table__, "ix_exception_timestamp")
+    _create_index(conn, ExceptionLog.__table__, "ix_exception_user_timestamp")
+
+
+def _add_sensor_data_timestamp_index(conn):
+    _create_index(conn, SensorData.__table__, "ix_sensor_data_timestamp")
+
+
+def _backfill_rollups(conn):
+    movement = "sqrt(movement_x * movement_x + movement_y * movement_y + movement_z * movement_z)"
+    aggregates = ", ".join(
+        f"min({column}), max({column}), sum({column})"
+        for column in ("heart_rate", "temperature", "sweat_level", movement)
+    )
+    # ה-timestamps היו אז מחרוזות: bucket = תחילית המחרוזת
+    for bucket, (length, suffix) in {"1m": (16, ":00"), "1h": (13, ":00:00")}.items():
+        conn.exec_driver_sql(
+            f"INSERT OR REPLACE INTO sensor_rollup "
+            f"SELECT user_id, '{bucket}', substr(timestamp, 1, {length}) || '{suffix}', count(*), {aggregates} "
+            f"FROM sensor_data GROUP BY user_id, substr(timestamp, 1, {length})"
+        )
+
+
+def _add_rollup_retention_index(conn):
+    _create_index(conn, SensorRollup.__table__, "ix_sensor_rollup_bucket_start")
+
+
+def _add_exception_episodes(conn):
+    conn.exec_driver_sql("ALTER TABLE exception ADD COLUMN last_seen VARCHAR")
+    conn.exec_driver_sql("ALTER TABLE exception ADD COLUMN occurrences INTEGER NOT NULL DEFAULT 1")
+    conn.exec_driver_sql("ALTER TABLE exception ADD COLUMN resolved_at VARCHAR")
+    # השורות הישנות נכתבו אחת לכל זיהוי, כל אחת היא אפיזודה שנסגרה מיד
+    conn.exec_driver_sql("UPDATE exception SET last_seen = timestamp, resolved_at = timestamp")
+    _create_index(conn, ExceptionLog.__table__, "ix_exception_last_seen")
+
+
+def _timestamps_to_epoch_ms(conn):
+    # המחרוזות בשעון מקומי הופכות למילישניות מ-1970. SQLite לא משנה טיפוס של עמודה, לכן הטבלאות נבנות מחדש
+    rebuild_table(conn, SensorData.__table__, {"timestamp": text_to_ms_sql("timestamp")})
+    rebuild_table(
+        conn,
+        ExceptionLog.__table__,
+        {column: text_to_ms_sql(column) for column in ("timestamp", "last_seen", "resolved_at")},
+    )
+    rebuild_table(conn, SensorRollup.__table__, {"bucket_start": text_to_ms_sql("bucket_start")})
+
+
+def _add_exception_user_last_seen_index(conn):
+    _create_index(conn, ExceptionLog.__table__, "ix_exception_user_last_seen")
+
+
+MIGRATIONS = [
+    _add_hot_path_indexes,
+    _add_sensor_data_timestamp_index,
+    _backfill_rollups,
+    _add_rollup_retention_index,
+    _add_exception_episodes,
+    _timestamps_to_epoch_ms,
+    _add_exception_user_last_seen_index,
+]
+
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def _check_incremental_vacuum(bind):
+    # ההמרה היא VACUUM מלא שכותב את כל הקובץ מחדש ונועל אותו, לכן היא לא רצה לבד בעליית השרת
+    with bind.connect() as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != AUTO_VACUUM_INCREMENTAL:
+            print(
+                "ℹ The database is not in auto_vacuum=INCREMENTAL mode: retention frees pages for reuse but the file "
+                "does not shrink. Convert it once, with the server stopped: python model.py --enable-incremental-vacuum"
+            )
+
+
+def enable_incremental_vacuum(bind=engine) -> dict:
+    """
+    Switch an existing database file to auto_vacuum=INCREMENTAL. That takes one full VACUUM, which rewrites the whole
+    file and holds its write lock until done (it cannot run inside a transaction), so it is a one-off offline step.
+    """
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == AUTO_VACUUM_INCREMENTAL:
+            return {"converted": False, "auto_vacuum": "incremental"}
+        pages = conn.exec_driver_sql("PRAGMA page_count").scalar()
+        started = time.monotonic()
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+        return {
+            "converted": True,
+            "pages_before": pages,
+            "pages_after": conn.exec_driver_sql("PRAGMA page_count").scalar(),
+            "seconds": round(time.monotonic() - started, 3),
+        }
+
+
+def migrate(bind=engine):
+    """Create missing tables and run the pending migration steps, one worker process at a time."""
+    with bind.begin() as conn:
+        if _is_sqlite:
+            # נעילת הכתיבה מההתחלה: worker שמגיע במקביל מחכה, ואחר כך רואה את הטבלאות ואת הגרסה המעודכנת
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        fresh = not inspect(conn).has_table(SensorData.__tablename__)
+        Base.metadata.create_all(conn)
+        version = len(MIGRATIONS) if fresh else conn.exec_driver_sql("PRAGMA user_version").scalar()
+        for step in MIGRATIONS[version:]:
+            step(conn)
+        conn.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+    if _is_sqlite:
+        _check_incremental_vacuum(bind)
+
+
+migrate()
 
 # ==================== פונקציות CRUD ====================
 
 # --- User CRUD ---
 
 
+@timed(DB_SECONDS)
 def add_user(user_id: str, first_name: str, last_name: str):
     if session.query(User).filter_by(id=user_id).first():
         return {"error": "User already exists"}
@@ -74,29 +347,77 @@ def add_user(user_id: str, first_name: str, last_name: str):
     return {"message": "User added successfully"}
 
 
-def get_user(user_id: str):
-    return session.query(User).filter_by(id=user_id).first()
+@timed(DB_SECONDS)
+def add_users_bulk(users: list[tuple[str, str, str]]) -> int:
+    """Create the (id, first_name, last_name) users that do not exist yet, returns how many were created."""
+    if not users:
+        return 0
+    rows = [{"id": user_id, "first_name": first, "last_name": last} for user_id, first, last in users]
+    created = session.connection().execute(sqlite_insert(User).on_conflict_do_nothing(), rows).rowcount
+    session.commit()
+    return created
 
 
-def get_all_users():
-    users = session.query(User).all()
-    return [
-        {
-            "id": user.id,
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "sensor_data_count": len(user.sensor_data),
-            "exceptions_count": len(user.exceptions),
-        }
-        for user in users
-    ]
+def users_page_statement(cursor: str | None, limit: int):
+    """One page of users ordered by id, with their exception counts from GROUP BY queries limited to the page."""
+    page_query = select(User.id, User.first_name, User.last_name).order_by(User.id).limit(limit)
+    if cursor is not None:
+        page_query = page_query.where(User.id > cursor)
+    page = page_query.subquery()
 
+    open_since = now_ms() - settings.open_alert_seconds * SECOND
+    exception_counts = (
+        select(
+            ExceptionLog.user_id,
+            func.count().label("exceptions_count"),
+            func.count()
+            .filter(
+                ExceptionLog.exception_level == "red",
+                ExceptionLog.resolved_at.is_(None),
+                ExceptionLog.last_seen >= open_since,
+            )
+            .label("open_red_alerts"),
+        )
+        .where(ExceptionLog.user_id.in_(select(page.c.id)))
+        .group_by(ExceptionLog.user_id)
+        .subquery()
+    )
+    return (
+        select(
+            page,
+            func.coalesce(exception_counts.c.exceptions_count, 0).label("exceptions_count"),
+            func.coalesce(exception_counts.c.open_red_alerts, 0).label("open_red_alerts"),
+        )
+        .outerjoin(exception_counts, exception_counts.c.user_id == page.c.id)
+        .order_by(page.c.id)
+    )
+
+
+def users_page(rows: list, sensor_counts: dict[str, tuple[int, int]], limit: int, include: set[str]) -> dict:
+    fields = ["id", "first_name", "last_name", "sensor_data_count", "exceptions_count"]
+    fields += [field for field in ("last_seen", "open_red_alerts") if field in include]
+    users = []
+    for row in rows:
+        sensor_data_count, last_seen = sensor_counts.get(row["id"], (0, None))
+        user = {**row, "sensor_data_count": sensor_data_count, "last_seen": last_seen}
+        users.append({field: user[field] for field in fields})
+    return {
+        "users": users,
+        "next_cursor": users[-1]["id"] if len(users) == limit else None,
+    }
 
+
+@timed(DB_SECONDS)
 def delete_user(user_id: str):
     user = session.query(User).filter_by(id=user_id).first()
     if user:
         session.delete(user)
         session.commit()
+        if store.partitioned:
+            for partition in store.partitions(user_ids=[user_id]):
+                partition.write(delete(SensorData).where(SensorData.user_id == user_id))
+        latest_cache.drop_user(user_id)
+        bus.share("user_deleted", {}, user_id)
         return {"message": "User deleted"}
     return {"error": "User not found"}
 
@@ -104,177 +425,1046 @@ def delete_user(user_id: str):
 # --- SensorData CRUD ---
 
 
+@timed(DB_SECONDS)
 def add_sensor_data(user_id: str, data: dict):
-    if not session.query(User).filter_by(id=user_id.strip()).first():
+    with DB_SECONDS.time("add_sensor_data.user_exists"):
+        exists = session.query(User).filter_by(id=user_id.strip()).first()
+    if not exists:
+        return {"error": "User does not exist"}
+    data = {**data, "timestamp": data.get("timestamp") or now_ms()}
+    with DB_SECONDS.time("add_sensor_data.insert_commit"):
+        (record_id,) = _insert_sensor_rows([{**data, "user_id": user_id}])
+        _update_rollups([{**data, "user_id": user_id}])
+        session.commit()
+    READINGS_INGESTED.inc()
+    latest_cache.put_reading({"id": record_id, "user_id": user_id, **data})
+    bus.publish("metric", {"id": record_id, "user_id": user_id, **data}, user_id)
+    return {"message": "Sensor data added", "record_id": record_id, "timestamp": data["timestamp"]}
+
+
+def _insert_sensor_rows(rows: list[dict]) -> list[int]:
+    """
+    Insert readings, the ids come back in the order of `rows`. On the main table the insert joins
+    the session's transaction; a partition commits on its own, before the rollups are committed.
+    """
+    if not store.partitioned:
+        return session.scalars(insert(SensorData).returning(SensorData.id, sort_by_parameter_order=True), rows).all()
+    return store.insert(rows)
+
+
+def _sensor_results(statement, period: tuple[int | None, int | None] | None = None, user_ids=None, db=None) -> list:
+    """
+    Run a sensor_data read on every partition that can hold rows of the period / users:
+    one list of rows per partition, in (day, shard) order. Unpartitioned, it is one list from the session (or `db`).
+    """
+    if not store.partitioned:
+        return [(db or session).execute(statement).all()]
+    return [partition.read(statement) for partition in store.partitions(period, user_ids)]
+
+
+def sensor_counts_statement(user_ids: list[str]):
+    return (
+        select(SensorData.user_id, func.count(), func.max(SensorData.timestamp))
+        .where(SensorData.user_id.in_(user_ids))
+        .group_by(SensorData.user_id)
+    )
+
+
+def merge_sensor_counts(results: list) -> dict[str, tuple[int, int]]:
+    counts = {}
+    for rows in results:
+        for user_id, count, last_seen in rows:
+            total, newest = counts.get(user_id, (0, last_seen))
+            counts[user_id] = (total + count, max(newest, last_seen))
+    return counts
+
+
+def _sensor_rows(user_id: str, records: list[dict]) -> list[dict]:
+    now = now_ms()
+    return [{**record, "user_id": user_id, "timestamp": record.get("timestamp") or now} for record in records]
+
+
+@timed(DB_SECONDS)
+def add_sensor_data_batch(user_id: str, records: list[dict]):
+    """
+    Insert many readings of one user in a single transaction.
+    The user is validated once and the rows go through one executemany INSERT.
+    """
+    user_id = user_id.strip()
+    if not session.query(User).filter_by(id=user_id).first():
         return {"error": "User does not exist"}
-    record = SensorData(user_id=user_id, **data)
-    session.add(record)
+    if not records:
+        return {"message": "No sensor data to add", "count": 0, "last_timestamp": None, "records": []}
+
+    rows = _sensor_rows(user_id, records)
+    ids = _insert_sensor_rows(rows)
+    _update_rollups(rows)
     session.commit()
-    return {"message": "Sensor data added", "record_id": record.id}
+    READINGS_INGESTED.inc(len(rows))
+    records = [{**row, "id": record_id} for row, record_id in zip(rows, ids, strict=True)]
+    latest_cache.put_reading(max(records, key=lambda record: (record["timestamp"], record["id"])))
+    for record in records:
+        bus.publish("metric", record, user_id)
+    return {
+        "message": "Sensor data added",
+        "count": len(rows),
+        "last_timestamp": max(row["timestamp"] for row in rows),
+        "records": records,
+    }
 
 
-def get_sensor_data_from_date(start_date: str):
-    sensor_data = session.query(SensorData).filter(SensorData.timestamp >= start_date).all()
-    return [
-        {
-            "id": d.id,
-            "user_id": d.user_id,
-            "timestamp": d.timestamp,
-            "heart_rate": d.heart_rate,
-            "temperature": d.temperature,
-            "movement_x": d.movement_x,
-            "movement_y": d.movement_y,
-            "movement_z": d.movement_z,
-            "sweat_level": d.sweat_level,
-        }
-        for d in sensor_data
-    ]
+@timed(DB_SECONDS)
+def add_sensor_data_bulk(batches: dict[str, list[dict]]):
+    """
+    Insert readings of several users in a single transaction.
+    Readings of unknown users are skipped and reported back under "missing_users".
+    """
+    user_ids = [user_id.strip() for user_id in batches]
+    existing = {user_id for (user_id,) in session.query(User.id).filter(User.id.in_(user_ids))}
 
+    rows = []
+    for raw_user_id, records in batches.items():
+        user_id = raw_user_id.strip()
+        if user_id in existing:
+            rows.extend(_sensor_rows(user_id, records))
 
-def get_last_sensor_data_by_user(user_id: str) -> dict:
-    record = (
-        session.query(SensorData)
-        .filter_by(user_id=user_id)
-        .order_by(SensorData.timestamp.desc())
-        .first()
+    inserted: dict[str, list[dict]] = {}
+    if rows:
+        ids = _insert_sensor_rows(rows)
+        _update_rollups(rows)
+        session.commit()
+        READINGS_INGESTED.inc(len(rows))
+        for row, record_id in zip(rows, ids, strict=True):
+            record = {**row, "id": record_id}
+            inserted.setdefault(row["user_id"], []).append(record)
+            bus.publish("metric", record, row["user_id"])
+        for records in inserted.values():
+            latest_cache.put_reading(max(records, key=lambda record: (record["timestamp"], record["id"])))
+    return {
+        "message": "Sensor data added",
+        "count": len(rows),
+        "records": inserted,
+        "missing_users": sorted(set(user_ids) - existing),
+    }
+
+
+SENSOR_ROW_COLUMNS = (
+    "user_id",
+    "timestamp",
+    "heart_rate",
+    "temperature",
+    "movement_x",
+    "movement_y",
+    "movement_z",
+    "sweat_level",
+)
+
+
+@timed(DB_SECONDS)
+def add_sensor_rows_bulk(rows: list[tuple], rollups: list[dict]) -> int:
+    """
+    Seeding fast path: insert tuples in SENSOR_ROW_COLUMNS order with the driver's executemany,
+    merging the given pre-aggregated rollups in the same transaction. Skips the ORM, RETURNING and events.
+    """
+    if not rows:
+        return 0
+    if store.partitioned:
+        store.insert_tuples(rows, SENSOR_ROW_COLUMNS)
+    else:
+        columns = ", ".join(SENSOR_ROW_COLUMNS)
+        placeholders = ", ".join("?" * len(SENSOR_ROW_COLUMNS))
+        session.connection().exec_driver_sql(f"INSERT INTO sensor_data ({columns}) VALUES ({placeholders})", rows)
+    merge_rollups(rollups)
+    session.commit()
+    READINGS_INGESTED.inc(len(rows))
+    for user_id in {row[0] for row in rows}:
+        latest_cache.invalidate_reading(user_id)
+    return len(rows)
+
+
+# --- Rollups ---
+
+
+def _rollup_values(record: dict) -> dict:
+    movement = math.sqrt(record["movement_x"] ** 2 + record["movement_y"] ** 2 + record["movement_z"] ** 2)
+    return {
+        "heart_rate": record["heart_rate"],
+        "temperature": record["temperature"],
+        "sweat_level": record["sweat_level"],
+        "movement": movement,
+    }
+
+
+def _update_rollups(records: list[dict]):
+    """
+    Fold the new readings into their 1-minute and 1-hour buckets, in the caller's transaction.
+    The readings are pre-aggregated per bucket, then merged with merge_rollups.
+    """
+    buckets: dict[tuple[str, str, int], dict] = {}
+    for record in records:
+        values = _rollup_values(record)
+        timestamp = record["timestamp"]
+        for bucket, size in ROLLUP_BUCKETS.items():
+            key = (record["user_id"], bucket, timestamp - timestamp % size)
+            aggregate = buckets.get(key)
+            if aggregate is None:
+                aggregate = buckets[key] = {"count": 0}
+                for metric, value in values.items():
+                    aggregate.update({f"{metric}_min": value, f"{metric}_max": value, f"{metric}_sum": 0.0})
+            aggregate["count"] += 1
+            for metric, value in values.items():
+                aggregate[f"{metric}_min"] = min(aggregate[f"{metric}_min"], value)
+                aggregate[f"{metric}_max"] = max(aggregate[f"{metric}_max"], value)
+                aggregate[f"{metric}_sum"] += value
+    merge_rollups(
+        [
+            {"user_id": user_id, "bucket": bucket, "bucket_start": bucket_start, **aggregate}
+            for (user_id, bucket, bucket_start), aggregate in buckets.items()
+        ]
+    )
+
+
+@timed(DB_SECONDS)
+def merge_rollups(rollups: list[dict]):
+    """Merge pre-aggregated rollup rows into the stored ones with one executemany UPSERT (caller's transaction)."""
+    if not rollups:
+        return
+    statement = sqlite_insert(SensorRollup)
+    new = statement.excluded
+    updates = {"count": SensorRollup.count + new.count}
+    for metric in ROLLUP_METRICS:
+        column = f"{metric}_min"
+        updates[column] = func.min(getattr(SensorRollup, column), getattr(new, column))
+        column = f"{metric}_max"
+        updates[column] = func.max(getattr(SensorRollup, column), getattr(new, column))
+        column = f"{metric}_sum"
+        updates[column] = getattr(SensorRollup, column) + getattr(new, column)
+    statement = statement.on_conflict_do_update(index_elements=list(SensorRollup.__table__.primary_key), set_=updates)
+    session.execute(statement, rollups)
+
+
+def _parse_bucket(bucket: str) -> tuple[str, int] | None:
+    """'15m' -> ('1m', 900000): the stored rollup to read and the requested bucket size in ms."""
+    units = {"m": MINUTE, "h": ROLLUP_BUCKETS["1h"], "d": 24 * ROLLUP_BUCKETS["1h"]}
+    if len(bucket) < 2 or bucket[-1] not in units or not bucket[:-1].isdigit() or int(bucket[:-1]) == 0:
+        return None
+    size = int(bucket[:-1]) * units[bucket[-1]]
+    return ("1h" if size % ROLLUP_BUCKETS["1h"] == 0 else "1m"), size
+
+
+@timed(DB_SECONDS)
+def get_sensor_aggregates(user_id: str, bucket: str, start_date: int, end_date: int):
+    """
+    min/max/avg/count per bucket, read from the rollup table instead of the raw readings.
+    Buckets that are multiples of a minute or an hour (5m, 6h, 1d...) are merged from the stored ones.
+    """
+    parsed = _parse_bucket(bucket)
+    if parsed is None:
+        return {"error": "Invalid bucket, use e.g. 1m, 15m, 1h, 1d"}
+    source, size = parsed
+    rows = (
+        session.query(SensorRollup)
+        .filter(SensorRollup.user_id == user_id)
+        .filter(SensorRollup.bucket == source)
+        .filter(SensorRollup.bucket_start >= start_date - start_date % ROLLUP_BUCKETS[source])
+        .filter(SensorRollup.bucket_start <= end_date)
+        .order_by(SensorRollup.bucket_start)
     )
+
+    merged: dict[int, dict] = {}
+    for row in rows:
+        # יישור לפי שעון מקומי, כך ש-1d מתחיל בחצות של השרת ולא בחצות UTC
+        local = row.bucket_start + local_offset_ms(row.bucket_start)
+        key = row.bucket_start - local % size
+        current = merged.get(key)
+        if current is None:
+            merged[key] = current = {"bucket_start": key, "count": 0}
+            for metric in ROLLUP_METRICS:
+                current[metric] = {
+                    "min": getattr(row, f"{metric}_min"),
+                    "max": getattr(row, f"{metric}_max"),
+                    "sum": 0.0,
+                }
+        current["count"] += row.count
+        for metric in ROLLUP_METRICS:
+            current[metric]["min"] = min(current[metric]["min"], getattr(row, f"{metric}_min"))
+            current[metric]["max"] = max(current[metric]["max"], getattr(row, f"{metric}_max"))
+            current[metric]["sum"] += getattr(row, f"{metric}_sum")
+
+    buckets = list(merged.values())
+    for current in buckets:
+        for metric in ROLLUP_METRICS:
+            current[metric]["avg"] = current[metric].pop("sum") / current["count"]
+    return {"user_id": user_id, "bucket": bucket, "buckets": buckets}
+
+
+@timed(DB_SECONDS)
+def get_sensor_data_from_date(start_date: int):
+    statement = select(SensorData.__table__).where(SensorData.timestamp >= start_date)
+    return [dict(row._mapping) for rows in _sensor_results(statement, (start_date, None)) for row in rows]
+
+
+def last_sensor_data_query(user_id: str):
+    # באותו timestamp ה-id הגבוה הוא החדש, כמו ב-LatestCache
+    return (
+        select(SensorData.__table__)
+        .where(SensorData.user_id == user_id)
+        .order_by(SensorData.timestamp.desc(), SensorData.id.desc())
+    )
+
+
+def _last_sensor_row(user_id: str):
+    statement = last_sensor_data_query(user_id).limit(1)
+    if not store.partitioned:
+        return session.execute(statement).first()
+    for partition in reversed(store.partitions(user_ids=[user_id])):  # היום החדש ביותר קודם
+        rows = partition.read(statement)
+        if rows:
+            return rows[0]
+    return None
+
+
+@timed(DB_SECONDS)
+def get_last_sensor_data_by_user(user_id: str) -> dict:
+    cached = latest_cache.get_reading(user_id)
+    if cached:
+        return cached
+    record = _last_sensor_row(user_id)
     if not record:
         return {}
-    return {
-        "id": record.id,
-        "user_id": record.user_id,
-        "timestamp": record.timestamp,
-        "heart_rate": record.heart_rate,
-        "temperature": record.temperature,
-        "movement_x": record.movement_x,
-        "movement_y": record.movement_y,
-        "movement_z": record.movement_z,
-        "sweat_level": record.sweat_level,
-    }
+    latest = dict(record._mapping)
+    latest_cache.put_reading(latest)
+    return latest
 
 
-def get_sensor_data_between_dates(start_date: str, end_date: str):
-    sensor_data = (
-        session.query(SensorData)
-        .filter(SensorData.timestamp >= start_date)
-        .filter(SensorData.timestamp <= end_date)
-        .all()
+@timed(DB_SECONDS)
+def get_fleet_sensor_rows(start_date: int, end_date: int, columns: list[str]) -> list[tuple]:
+    """
+    Raw tuples of every user's readings in the range, ordered by user and time.
+    Used by the batch analyzers, which work on column arrays instead of dicts.
+    """
+    statement = (
+        select(SensorData.user_id, *(getattr(SensorData, column) for column in columns))
+        .where(SensorData.timestamp >= start_date)
+        .where(SensorData.timestamp <= end_date)
+        .order_by(SensorData.user_id, SensorData.timestamp)
     )
+    # כל מחיצה ממוינת לפי משתמש, ו-merge יציב שומר בין מחיצות את סדר הימים
+    results = _sensor_results(statement, (start_date, end_date))
+    return [tuple(row) for row in heapq.merge(*results, key=lambda row: row[0])]
 
-    return [
-        {
-            "id": d.id,
-            "user_id": d.user_id,
-            "timestamp": d.timestamp,
-            "heart_rate": d.heart_rate,
-            "temperature": d.temperature,
-            "movement_x": d.movement_x,
-            "movement_y": d.movement_y,
-            "movement_z": d.movement_z,
-            "sweat_level": d.sweat_level,
-        }
-        for d in sensor_data
-    ]
+
+def _sensor_data_between_dates_query(start_date: int, end_date: int, user_id: str | None = None):
+    statement = (
+        select(SensorData.__table__).where(SensorData.timestamp >= start_date).where(SensorData.timestamp <= end_date)
+    )
+    if user_id is not None:
+        statement = statement.where(SensorData.user_id == user_id)
+    return statement
+
+
+@timed(DB_SECONDS)
+def get_sensor_data_between_dates(start_date: int, end_date: int, user_id: str | None = None):
+    statement = _sensor_data_between_dates_query(start_date, end_date, user_id)
+    results = _sensor_results(statement, (start_date, end_date), [user_id] if user_id is not None else None)
+    return [dict(row._mapping) for rows in results for row in rows]
 
 
+@timed(DB_SECONDS)
+def get_users_with_sensor_data(start_date: int, end_date: int) -> list[str]:
+    statement = (
+        select(SensorData.user_id)
+        .where(SensorData.timestamp >= start_date)
+        .where(SensorData.timestamp <= end_date)
+        .distinct()
+    )
+    return sorted({user_id for rows in _sensor_results(statement, (start_date, end_date)) for (user_id,) in rows})
+
 
+def iter_sensor_data(
+    period: tuple[int, int],
+    user_ids: list[str] | None = None,
+    chunk_size: int = 5000,
+    columns: list[str] | None = None,
+    db=None,
+):
+    """
+    Yield the readings of the (start, end) range as lists of dicts, one chunk at a time,
+    ordered by time (so every user's readings come in order).
+    Rows are streamed from the cursor (yield_per), so memory stays bounded whatever the range size.
+    `columns` limits the selected columns, `db` runs the query on a given Session instead of the scoped one
+    (partitions always use their own connections).
+    """
+    start_date, end_date = period
+    table = SensorData.__table__
+    columns = list(columns or table.c.keys())
+    # המיון בין מחיצות צריך את timestamp ו-id גם כשהם לא בעמודות המבוקשות
+    selected = columns + [name for name in ("timestamp", "id") if name not in columns and store.partitioned]
+    statement = (
+        select(*(table.c[name] for name in selected))
+        .where(SensorData.timestamp >= start_date)
+        .where(SensorData.timestamp <= end_date)
+        .order_by(SensorData.timestamp, SensorData.id)
+    )
+    if user_ids:
+        statement = statement.where(SensorData.user_id.in_(user_ids))
+    if not store.partitioned:
+        result = (db or session).execute(statement.execution_options(yield_per=chunk_size)).mappings()
+        for partition in result.partitions():
+            yield [dict(row) for row in partition]
+        return
+    # ימים לא חופפים בזמן, לכן עוברים עליהם לפי הסדר, ורק ה-shards של אותו יום ממוזגים
+    by_day: dict[str | None, list] = {}
+    for partition in store.partitions(period, user_ids):
+        by_day.setdefault(partition.day, []).append(partition)
+    for partitions in by_day.values():
+        streams = [partition.stream(statement, chunk_size) for partition in partitions]
+        chunk = []
+        for row in heapq.merge(*streams, key=lambda row: (row["timestamp"], row["id"])):
+            chunk.append({name: row[name] for name in columns})
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
+
+@timed(DB_SECONDS)
 def delete_sensor_record(record_id: int):
-    record = session.query(SensorData).filter_by(id=record_id).first()
-    if record:
-        session.delete(record)
+    statement = delete(SensorData).where(SensorData.id == record_id).returning(SensorData.user_id)
+    if store.partitioned:
+        partition = store.partition_of_id(record_id)  # ה-id מקודד את המחיצה
+        deleted = partition.write(statement) if partition else []
+    else:
+        deleted = session.execute(statement).all()
         session.commit()
+    if deleted:
+        latest_cache.invalidate_reading(deleted[0].user_id, record_id)
+        bus.share("reading_deleted", {"id": record_id}, deleted[0].user_id)
         return {"message": "Record deleted"}
     return {"error": "Record not found"}
 
 
+# --- Retention ---
+
+
+def _expired_sensor_data_query(
+    raw_cutoff: int, alert_cutoff: int | None, window_minutes: int, after: tuple[int, int] | None, limit: int
+):
+    statement = select(SensorData.id, SensorData.user_id, SensorData.timestamp).where(SensorData.timestamp < raw_cutoff)
+    if after is not None:
+        statement = statement.where(tuple_(SensorData.timestamp, SensorData.id) > tuple_(*after))
+    if window_minutes > 0:
+        near_alert = (
+            select(ExceptionLog.id)
+            .where(ExceptionLog.user_id == SensorData.user_id)
+            .where(ExceptionLog.timestamp <= SensorData.timestamp + window_minutes * MINUTE)
+            .where(ExceptionLog.last_seen >= SensorData.timestamp - window_minutes * MINUTE)
+            .exists()
+        )
+        statement = statement.where(
+            ~near_alert if alert_cutoff is None else or_(SensorData.timestamp < alert_cutoff, ~near_alert)
+        )
+    return statement.order_by(SensorData.timestamp, SensorData.id).limit(limit)
+
+
+@timed(DB_SECONDS)
+def find_expired_sensor_data(
+    raw_cutoff: int, alert_cutoff: int | None, window_minutes: int, after: tuple[int, int] | None, limit: int
+) -> list[tuple]:
+    """
+    Up to `limit` readings older than raw_cutoff, as (id, user_id, timestamp) in (timestamp, id) order after `after`.
+    Readings within window_minutes of an exception episode of their user (from its opening to its last detection)
+    are kept until alert_cutoff (None = forever).
+    Only reads, so the candidates are collected without holding the write lock.
+    """
+    return session.execute(_expired_sensor_data_query(raw_cutoff, alert_cutoff, window_minutes, after, limit)).all()
+
+
+@timed(DB_SECONDS)
+def find_old_partition_readings(partition, raw_cutoff: int, after: tuple[int, int] | None, limit: int) -> list[tuple]:
+    """
+    Shard partitions (no day file to drop): up to `limit` readings of one partition older than raw_cutoff,
+    as (id, user_id, timestamp) in (timestamp, id) order after `after`. The exceptions live in the main DB,
+    so keeping the readings near them is left to readings_near_exceptions.
+    """
+    statement = select(SensorData.id, SensorData.user_id, SensorData.timestamp).where(SensorData.timestamp < raw_cutoff)
+    if after is not None:
+        statement = statement.where(tuple_(SensorData.timestamp, SensorData.id) > tuple_(*after))
+    return partition.read(statement.order_by(SensorData.timestamp, SensorData.id).limit(limit))
+
+
+@timed(DB_SECONDS)
+def readings_near_exceptions(records: list[tuple], alert_cutoff: int | None, window_minutes: int) -> set[int]:
+    """
+    The ids of the (id, user_id, timestamp) readings that are within window_minutes of an exception episode
+    of their user and not older than alert_cutoff (None = kept forever), the same rule as find_expired_sensor_data.
+    """
+    protected = [record for record in records if alert_cutoff is None or record[2] >= alert_cutoff]
+    if window_minutes <= 0 or not protected:
+        return set()
+    window = window_minutes * MINUTE
+    episodes: dict[str, list[tuple[int, int]]] = {}
+    statement = select(ExceptionLog.user_id, ExceptionLog.timestamp, ExceptionLog.last_seen).where(
+        ExceptionLog.user_id.in_({record[1] for record in protected}),
+        ExceptionLog.timestamp <= max(record[2] for record in protected) + window,
+        ExceptionLog.last_seen >= min(record[2] for record in protected) - window,
+    )
+    for user_id, opened, last_seen in session.execute(statement):
+        episodes.setdefault(user_id, []).append((opened - window, last_seen + window))  # הטווח שנשמר סביב האפיזודה
+    return {
+        record_id
+        for record_id, user_id, timestamp in protected
+        if any(start <= timestamp <= end for start, end in episodes.get(user_id, ()))
+    }
+
+
+@timed(DB_SECONDS)
+def delete_sensor_records(records: list[tuple]) -> int:
+    """Delete the (id, user_id, ...) readings in one short write transaction (per partition, when partitioned)."""
+    if not records:
+        return 0
+    if store.partitioned:
+        ids: dict[object, list[int]] = {}
+        for record in records:
+            partition = store.partition_of_id(record[0])  # ה-id מקודד את המחיצה
+            if partition:
+                ids.setdefault(partition, []).append(record[0])
+        deleted = 0
+        for partition, group in ids.items():
+            deleted += len(partition.write(delete(SensorData).where(SensorData.id.in_(group)).returning(SensorData.id)))
+    else:
+        result = session.execute(
+            delete(SensorData).where(SensorData.id.in_([record[0] for record in records])),
+            execution_options={"synchronize_session": False},
+        )
+        session.commit()
+        deleted = result.rowcount
+    for record_id, user_id, *_ in records:
+        latest_cache.invalidate_reading(user_id, record_id)
+    return deleted
+
+
+@timed(DB_SECONDS)
+def find_expired_sensor_partitions(raw_cutoff: int, alert_cutoff: int | None, window_minutes: int) -> list:
+    """
+    Partitioned storage: the day partitions that end before raw_cutoff. A partition holding readings
+    within window_minutes of an exception episode of one of its shard's users is kept until alert_cutoff.
+    """
+    expired = []
+    for partition in store.partitions((None, raw_cutoff)):
+        if partition.day is None:
+            continue
+        day_start, day_end = day_start_ms(partition.day), _next_day_start(partition.day) - 1
+        if day_end >= raw_cutoff:
+            continue
+        if window_minutes > 0 and (alert_cutoff is None or day_end >= alert_cutoff):
+            near = (
+                select(ExceptionLog.user_id)
+                .where(ExceptionLog.timestamp <= day_end + window_minutes * MINUTE)
+                .where(ExceptionLog.last_seen >= day_start - window_minutes * MINUTE)
+                .distinct()
+            )
+            if any(store.shard_of(user_id) == partition.shard for user_id in session.scalars(near)):
+                continue
+        expired.append(partition)
+    return expired
+
+
+@timed(DB_SECONDS)
+def drop_sensor_partition(partition) -> int:
+    """Delete a whole partition (its files), returns how many readings it held."""
+    (count,) = partition.read(select(func.count()).select_from(SensorData.__table__))[0]
+    store.drop(partition)
+    latest_cache.drop_readings_before(_next_day_start(partition.day))
+    bus.share("readings_dropped", {"before": _next_day_start(partition.day)})
+    return count
+
+
+def _next_day_start(day: str) -> int:
+    # יום מקומי הוא לא תמיד 24 שעות (מעבר שעון), לכן קופצים ליום הבא דרך 36 שעות ועיגול לחצות
+    return day_start_ms(local_day(day_start_ms(day) + 36 * 60 * MINUTE))
+
+
+@timed(DB_SECONDS)
+def purge_rollups(bucket: str, cutoff: int, limit: int) -> int:
+    """Delete up to `limit` rollups of the bucket size that start before cutoff."""
+    table = SensorRollup.__table__
+    expired = (
+        select(literal_column("rowid"))
+        .select_from(table)
+        .where(table.c.bucket == bucket, table.c.bucket_start < cutoff)
+        .limit(limit)
+    )
+    result = session.execute(delete(table).where(literal_column("rowid").in_(expired.scalar_subquery())))
+    session.commit()
+    return result.rowcount
+
+
+@timed(DB_SECONDS)
+def incremental_vacuum(max_pages: int) -> int:
+    """Give up to max_pages free pages back to the filesystem, returns how many were freed."""
+    if not _is_sqlite:
+        return 0
+    session.commit()
+    with engine.connect() as conn:
+        before = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        # כל צעד של ה-PRAGMA משחרר עמוד אחד ו-execute של sqlite3 מבצע צעד אחד בלבד, executescript מריץ עד הסוף
+        conn.connection.dbapi_connection.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+        return before - conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+
+
 # --- Excepetion CRUD ---
 
 
-def add_exception(user_id: str, exception_type: str, exception_level: str, details: str, timestamp: str | None = None):
+@timed(DB_SECONDS)
+def add_exception(user_id: str, exception_type: str, exception_level: str, details: str, timestamp: int | None = None):
     if not session.query(User).filter_by(id=user_id).first():
         return {"error": "User does not exist"}
 
     if timestamp is None:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    exception = ExceptionLog(
-        user_id=user_id,
-        exception_type=exception_type,
-        exception_level=exception_level,
-        details=details,
-        timestamp=timestamp,
+        timestamp = now_ms()
+
+    row = session.execute(
+        insert(ExceptionLog).returning(*ExceptionLog.__table__.c),
+        {
+            "user_id": user_id,
+            "exception_type": exception_type,
+            "exception_level": exception_level,
+            "details": details,
+            "timestamp": timestamp,
+            "last_seen": timestamp,
+            "occurrences": 1,
+        },
+    ).one()
+    session.commit()
+    ALERTS_RAISED.inc(1, exception_type, exception_level)
+    record = dict(row._mapping)
+    latest_cache.put_exception(record)
+    bus.publish("exception", record, user_id)
+    return {"message": "Exception added", "exception_id": record["id"]}
+
+
+@timed(DB_SECONDS)
+def add_exceptions_bulk(exceptions: list[dict]):
+    """
+    Insert many exceptions (dicts with the ExceptionLog columns) in one transaction.
+    Missing episode fields describe a single detection: last_seen = timestamp, one occurrence, still open.
+    """
+    if not exceptions:
+        return {"message": "No exceptions to add", "count": 0}
+    now = now_ms()
+    rows = []
+    for exception in exceptions:
+        timestamp = exception.get("timestamp") or now
+        last_seen = exception.get("last_seen") or timestamp
+        defaults = {"occurrences": 1, "resolved_at": None}
+        rows.append({**defaults, **exception, "timestamp": timestamp, "last_seen": last_seen})
+    ids = session.scalars(insert(ExceptionLog).returning(ExceptionLog.id, sort_by_parameter_order=True), rows).all()
+    session.commit()
+    for row, exception_id in zip(rows, ids, strict=True):
+        ALERTS_RAISED.inc(1, row["exception_type"], row["exception_level"])
+        latest_cache.put_exception({**row, "id": exception_id})
+        bus.publish("exception", {**row, "id": exception_id}, row["user_id"])
+    return {"message": "Exceptions added", "count": len(rows)}
+
+
+# השדות שמשתנים באפיזודה פתוחה
+EPISODE_FIELDS = ("exception_level", "details", "last_seen", "occurrences", "resolved_at")
+
+
+@timed(DB_SECONDS)
+def update_exception_episode(record: dict, event: str | None = "exception"):
+    """Write an episode's new state (a record from alerts.py) over its row and publish it as `event` (None = quiet)."""
+    session.execute(
+        update(ExceptionLog)
+        .where(ExceptionLog.id == record["id"])
+        .values({field: record[field] for field in EPISODE_FIELDS})
     )
-    session.add(exception)
     session.commit()
-    return {"message": "Exception added", "exception_id": exception.id}
+    latest_cache.put_exception(record)
+    if event:
+        bus.publish(event, record, record["user_id"])
+    else:
+        bus.share("exception_seen", record, record["user_id"])
 
 
+@timed(DB_SECONDS)
+def get_open_exception_episodes(active_since: int) -> list[dict]:
+    """Unresolved episodes detected since `active_since`, oldest first, to restore the alert state after a restart."""
+    statement = (
+        select(ExceptionLog.__table__)
+        .where(ExceptionLog.last_seen >= active_since, ExceptionLog.resolved_at.is_(None))
+        .order_by(ExceptionLog.id)
+    )
+    return _exception_records(statement)
+
+
+def _exception_records(statement) -> list[dict]:
+    return [dict(row) for row in session.execute(statement).mappings()]
+
+
+def _exceptions_between_dates(start_date: int, end_date: int, user_id: str, exception_types: list[str]) -> tuple:
+    return (
+        ExceptionLog.user_id == user_id,
+        ExceptionLog.timestamp >= start_date,
+        ExceptionLog.timestamp <= end_date,
+        ExceptionLog.exception_type.in_(exception_types),
+    )
+
+
+@timed(DB_SECONDS)
+def get_exceptions_between_dates(start_date: int, end_date: int, user_id: str, exception_types: list[str]):
+    conditions = _exceptions_between_dates(start_date, end_date, user_id, exception_types)
+    return _exception_records(select(ExceptionLog.__table__).where(*conditions).order_by(ExceptionLog.timestamp))
+
+
+@timed(DB_SECONDS)
+def delete_exceptions_between_dates(start_date: int, end_date: int, user_id: str, exception_types: list[str]) -> int:
+    conditions = _exceptions_between_dates(start_date, end_date, user_id, exception_types)
+    deleted = session.execute(delete(ExceptionLog).where(*conditions)).rowcount
+    session.commit()
+    latest_cache.invalidate_exceptions()
+    bus.share("exceptions_deleted", {}, user_id)
+    return deleted
+
+
+@timed(DB_SECONDS)
 def get_all_exceptions():
-    exceptions = session.query(ExceptionLog).all()
-    return [
-        {
-            "id": e.id,
-            "user_id": e.user_id,
-            "timestamp": e.timestamp,
-            "exception_type": e.exception_type,
-            "exception_level": e.exception_level,
-            "details": e.details,
-        }
-        for e in exceptions
-    ]
+    return _exception_records(select(ExceptionLog.__table__))
 
 
+@timed(DB_SECONDS)
 def delete_exception(exception_id: int):
     exception = session.query(ExceptionLog).filter_by(id=exception_id).first()
     if exception:
         session.delete(exception)
         session.commit()
+        latest_cache.invalidate_exceptions()
+        bus.share("exceptions_deleted", {}, exception.user_id)
         return {"message": "Exception deleted"}
     return {"error": "Exception not found"}
 
 
-def get_latest_exception_timestamp() -> datetime | None:
-    latest = session.query(ExceptionLog).order_by(ExceptionLog.timestamp.desc()).first()
-    if latest:
-        return datetime.strptime(latest.timestamp, "%Y-%m-%d %H:%M:%S")
-    return None
+def latest_exception_query():
+    # הפעילות האחרונה: אפיזודה פתוחה ותיקה שזוהתה שוב עכשיו קודמת לאפיזודה חדשה יותר שכבר שקטה
+    return select(ExceptionLog.__table__).order_by(ExceptionLog.last_seen.desc(), ExceptionLog.id.desc()).limit(1)
+
+
+def _latest_exception() -> dict | None:
+    latest = latest_cache.get_latest_exception()
+    if latest is MISSING:
+        record = session.execute(latest_exception_query()).first()
+        latest = dict(record._mapping) if record else None
+        latest_cache.load_latest_exception(latest)
+    return latest
+
+
+@timed(DB_SECONDS)
+def move_sensor_data_to_partitions(chunk_size: int = 5000) -> int:
+    """
+    Move the readings of the main table into the partitions, after switching HM_SENSOR_PARTITION_BY on.
+    The readings get new (partition) ids. A chunk is copied before it is deleted, so an interrupted move
+    can leave one chunk in both places.
+    """
+    if not store.partitioned:
+        return 0
+    table = SensorData.__table__
+    moved = 0
+    while rows := session.execute(select(table).order_by(table.c.id).limit(chunk_size)).mappings().all():
+        store.insert([{name: value for name, value in row.items() if name != "id"} for row in rows])
+        session.execute(delete(table).where(table.c.id <= rows[-1]["id"]))
+        session.commit()
+        moved += len(rows)
+    latest_cache.clear()
+    return moved
+
+
+# --- Shared state (shared.py) ---
+
 
+@timed(DB_SECONDS)
+def get_shared_value(key: str) -> int | None:
+    return session.execute(select(SharedState.value).where(SharedState.key == key)).scalar()
 
-# def get_exceptions_from_date(start_date: str):
-#     exceptions = session.query(ExceptionLog).filter(ExceptionLog.timestamp >= start_date).all()
-#     return [
-#         {
-#             "id": e.id,
-#             "user_id": e.user_id,
-#             "timestamp": e.timestamp,
-#             "exception_type": e.exception_type,
-#             "exception_level": e.exception_level,
-#             "details": e.details,
-#         }
-#         for e in exceptions
-#     ]
-
-
-def get_last_exception_from_date(start_date: str):
-    exception = (
-        session.query(ExceptionLog)
-        .filter(ExceptionLog.timestamp >= start_date)
-        .order_by(ExceptionLog.timestamp.desc())
-        .first()
+
+@timed(DB_SECONDS)
+def set_shared_value(key: str, value: int | None):
+    statement = sqlite_insert(SharedState).values(key=key, value=value, owner=None, updated_at=now_ms())
+    new = statement.excluded
+    session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[SharedState.key], set_={"value": new.value, "updated_at": new.updated_at}
+        )
     )
+    session.commit()
 
-    if exception is None:
-        return None
 
-    return {
-        "id": exception.id,
-        "user_id": exception.user_id,
-        "timestamp": exception.timestamp,
-        "exception_type": exception.exception_type,
-        "exception_level": exception.exception_level,
-        "details": exception.details,
-    }
+@timed(DB_SECONDS)
+def claim_lease(name: str, owner: str, expires_at: int) -> bool:
+    """Take or renew the lease `name` until `expires_at`; False while another owner holds one that has not expired."""
+    now = now_ms()
+    statement = sqlite_insert(SharedState).values(key=name, value=expires_at, owner=owner, updated_at=now)
+    new = statement.excluded
+    claimed = session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[SharedState.key],
+            set_={"value": new.value, "owner": new.owner, "updated_at": new.updated_at},
+            where=or_(SharedState.owner == owner, SharedState.value < now),
+        ).returning(SharedState.key)
+    ).all()
+    session.commit()
+    return bool(claimed)
+
+
+@timed(DB_SECONDS)
+def add_shared_events(origin: str, events: list) -> int:
+    shared = SharedEvent(origin=origin, created_at=now_ms(), events=json.dumps(events, default=str))
+    session.add(shared)
+    session.commit()
+    return shared.id
+
+
+@timed(DB_SECONDS)
+def get_shared_events(after_id: int, origin: str, limit: int) -> list[tuple[int, list]]:
+    """The (id, events) sent by the other workers after `after_id`, in the order they were written."""
+    rows = session.execute(
+        select(SharedEvent.id, SharedEvent.events)
+        .where(SharedEvent.id > after_id, SharedEvent.origin != origin)
+        .order_by(SharedEvent.id)
+        .limit(limit)
+    )
+    return [(shared_id, json.loads(events)) for shared_id, events in rows]
+
+
+@timed(DB_SECONDS)
+def get_last_shared_event_id() -> int:
+    return session.execute(select(func.max(SharedEvent.id))).scalar() or 0
+
+
+@timed(DB_SECONDS)
+def purge_shared_events(before: int) -> int:
+    deleted = session.execute(delete(SharedEvent).where(SharedEvent.created_at < before)).rowcount
+    session.commit()
+    return deleted
+
+
+# --- Fleet snapshot ---
+
+ALERT_LEVELS = ("green", "yellow", "red")  # לפי חומרה, רמת ההתראה של משתמש היא החמורה מבין האפיזודות הפתוחות
+
+
+def _latest_id(table, order_column: str):
+    """The id of the user's newest row by `order_column`, as a scalar subquery correlated to User (an index seek)."""
+    inner = table.alias()
+    return (
+        select(inner.c.id)
+        .where(inner.c.user_id == User.id)
+        .order_by(inner.c[order_column].desc(), inner.c.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+def fleet_snapshot_statement(as_of: int, since: int | None = None, with_readings: bool = True, changed_users=()):
+    """
+    Every user with their latest reading, most recently detected exception and open alert level, in one query.
+    With `since`, only the users with a reading, a detection or a resolution from then on, an open alert that
+    expired since then, or one of `changed_users` (readings found in the partitions).
+    """
+    window = settings.open_alert_seconds * SECOND
+    reading = SensorData.__table__.alias("reading")
+    exception = ExceptionLog.__table__.alias("last_exception")
+    rank = case({level: rank for rank, level in enumerate(ALERT_LEVELS)}, value=ExceptionLog.exception_level)
+    alert_rank = (
+        select(func.max(rank))
+        .where(
+            ExceptionLog.user_id == User.id,
+            ExceptionLog.last_seen >= as_of - window,
+            ExceptionLog.resolved_at.is_(None),
+        )
+        .scalar_subquery()
+    )
+    statement = (
+        select(User.id.label("user_id"), alert_rank.label("alert_rank"))
+        .add_columns(*(column.label(f"exception_{column.name}") for column in exception.c))
+        .select_from(User)
+        .outerjoin(exception, exception.c.id == _latest_id(ExceptionLog.__table__, "last_seen"))
+        .order_by(User.id)
+    )
+    if with_readings:
+        statement = statement.add_columns(*(column.label(f"reading_{column.name}") for column in reading.c)).outerjoin(
+            reading, reading.c.id == _latest_id(SensorData.__table__, "timestamp")
+        )
+    if since is None:
+        return statement
+    # אפיזודה פתוחה שחלון ההתראה שלה נגמר מאז משנה את הרמה בלי שום כתיבה
+    changed_exceptions = select(ExceptionLog.user_id).where(
+        or_(
+            ExceptionLog.last_seen >= since,
+            ExceptionLog.resolved_at >= since,
+            and_(ExceptionLog.resolved_at.is_(None), ExceptionLog.last_seen.between(since - window, as_of - window)),
+        )
+    )
+    changed = [User.id.in_(changed_exceptions)]
+    if with_readings:
+        changed.append(reading.c.timestamp >= since)
+    if changed_users:
+        changed.append(User.id.in_(changed_users))
+    return statement.where(or_(*changed))
+
+
+def newest_readings_statement(since: int | None = None):
+    """
+    Partitioned storage: the newest reading of every user in a partition, by (timestamp, id) like
+    last_sensor_data_query, so readings with the same timestamp resolve to the same row everywhere.
+    """
+    newest_first = (SensorData.timestamp.desc(), SensorData.id.desc())
+    rank = func.row_number().over(partition_by=SensorData.user_id, order_by=newest_first).label("rank")
+    ranked = select(SensorData.__table__, rank)
+    if since is not None:
+        ranked = ranked.where(SensorData.timestamp >= since)
+    ranked = ranked.subquery()
+    return select(*(ranked.c[column.name] for column in SensorData.__table__.c)).where(ranked.c.rank == 1)
+
+
+def merge_newest_readings(results: list) -> dict[str, dict]:
+    newest = {}
+    for rows in results:
+        for row in rows:
+            reading = {column.name: row._mapping[column.name] for column in SensorData.__table__.c}
+            current = newest.get(reading["user_id"])
+            if current is None or (reading["timestamp"], reading["id"]) > (current["timestamp"], current["id"]):
+                newest[reading["user_id"]] = reading
+    return newest
+
+
+def fleet_snapshot(rows: list, readings: dict[str, dict] | None, as_of: int) -> dict:
+    """The snapshot response from the statement's rows; `readings` by user when they come from the partitions."""
+    users = []
+    for row in rows:
+        exception = {column.name: row[f"exception_{column.name}"] for column in ExceptionLog.__table__.c}
+        if readings is None:
+            reading = {column.name: row[f"reading_{column.name}"] for column in SensorData.__table__.c}
+            reading = reading if reading["id"] is not None else None
+        else:
+            reading = readings.get(row["user_id"])
+        users.append(
+            {
+                "user_id": row["user_id"],
+                "alert_level": ALERT_LEVELS[row["alert_rank"]] if row["alert_rank"] is not None else None,
+                "reading": reading,
+                "last_exception": exception if exception["id"] is not None else None,
+            }
+        )
+    return {"as_of": as_of, "users": users}
+
+
+# --- Cache warm-up ---
+
+
+def _latest_readings_statement():
+    """The newest reading of every user, as one query doing an index seek per user."""
+    inner = aliased(SensorData)
+    latest_id = (
+        select(inner.id)
+        .where(inner.user_id == User.id)
+        .order_by(inner.timestamp.desc(), inner.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    return select(SensorData.__table__).where(SensorData.id.in_(select(latest_id).select_from(User)))
+
+
+@timed(DB_SECONDS)
+def warm_cache():
+    latest_cache.clear()
+    if store.partitioned:
+        # המדידה החדשה של כל משתמש ביום האחרון, השאר נטענים כשמבקשים אותם
+        days = store.days()
+        since = day_start_ms(days[-1]) if days else None
+        for reading in merge_newest_readings(_sensor_results(newest_readings_statement(since), (since, None))).values():
+            latest_cache.put_reading(reading)
+    else:
+        for row in session.execute(_latest_readings_statement()).mappings():
+            latest_cache.put_reading(dict(row))
+    _latest_exception()  # מהחריגות נשמרת בזיכרון רק האחרונה, שאילתה אחת
+
 
-if not session.query(User).filter_by(id="1").first():
-    add_user(user_id="1", first_name="Demo", last_name="User")
+# ==================== בדיקת תוכניות שאילתה ====================
+
+# השאילתות שרצות על כל מדידה או על כל polling, אסור שיסרקו טבלה שלמה
+HOT_QUERIES = {
+    "get_last_sensor_data_by_user": lambda: last_sensor_data_query("1").limit(1),
+    "get_sensor_data_between_dates": lambda: _sensor_data_between_dates_query(
+        to_ms("2025-01-01 00:00:00"), to_ms("2025-01-01 00:01:00"), user_id="1"
+    ),
+    "get_latest_exception_timestamp": latest_exception_query,
+    "warm_cache": _latest_readings_statement,
+    "get_fleet_snapshot": lambda: fleet_snapshot_statement(to_ms("2025-01-01 00:00:00")),
+    "find_expired_sensor_data": lambda: _expired_sensor_data_query(
+        to_ms("2025-01-01 00:00:00"), to_ms("2024-01-01 00:00:00"), 10, (to_ms("2024-06-01 00:00:00"), 1), 1000
+    ),
+}
+
+
+# מותר SCAN רק על users (ה-snapshot ו-warm_cache עוברים על כל המשתמשים במכוון), ובשאילתות שקוראות
+# רק את השורה הראשונה לפי סדר של אינדקס (ORDER BY ... LIMIT 1) גם מעבר על האינדקס הזה
+SCANNABLE_TABLES = {"users"}
+INDEX_ORDER_QUERIES = {"get_latest_exception_timestamp"}
+
+
+def explain_hot_queries() -> dict[str, list[str]]:
+    plans = {}
+    for name, build in HOT_QUERIES.items():
+        query = build()
+        sql = getattr(query, "statement", query).compile(engine, compile_kwargs={"literal_binds": True})
+        plans[name] = [row[-1] for row in session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+    return plans
+
+
+def plan_problems(name: str, plan: list[str]) -> list[str]:
+    """The steps of a hot query's plan that read a whole table (or a whole index of it) or sort in a temp b-tree."""
+    return [
+        step
+        for step in plan
+        if "TEMP B-TREE" in step
+        or (
+            step.startswith("SCAN ")
+            and step.split()[1] not in SCANNABLE_TABLES
+            and not (name in INDEX_ORDER_QUERIES and "USING" in step)
+        )
+    ]
+
+
+def check_query_plans():
+    """Raise if a hot query falls back to a table scan or to sorting in a temp b-tree."""
+    bad = {name: problems for name, plan in explain_hot_queries().items() if (problems := plan_problems(name, plan))}
+    if bad:
+        raise RuntimeError(f"Hot queries without a usable index: {bad}")
+
+
+add_users_bulk([("1", "Demo", "User")])  # לא נכשל כשכמה workers עולים יחד
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the hot query plans, or maintain the database files")
+    parser.add_argument("--partitions", action="store_true", help="List the sensor data partitions")
+    parser.add_argument(
+        "--move-to-partitions", action="store_true", help="Move the main table's readings into the partitions"
+    )
+    parser.add_argument(
+        "--enable-incremental-vacuum", action="store_true", help="One full VACUUM of an existing DB, server stopped"
+    )
+    args = parser.parse_args()
+    if args.enable_incremental_vacuum:
+        print(json.dumps(enable_incremental_vacuum()))
+    elif args.partitions or args.move_to_partitions:
+        if args.move_to_partitions:
+            print(json.dumps({"moved": move_sensor_data_to_partitions()}))
+        print(json.dumps(store.describe(), indent=2))
+    else:
+        for name, plan in explain_hot_queries().items():
+            print(f"{name}: {' | '.join(plan)}")
+        check_query_plans()
+        print("All hot queries use an index")
@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+import zlib
+
+from check import check_all_conditions
+from config import settings
+from model import session_scope
+
+# תור זיהוי חריגות ברקע: ה-POST מחזיר תשובה מיד אחרי שהמדידה נשמרה,
+# והזיהוי רץ ב-worker threads. כל משתמש ממופה תמיד לאותו worker כדי לשמור על הסדר.
+
+_STOP = object()
+
+
+class DetectionPipeline:
+    def __init__(self, workers: int, capacity: int, latency_budget_ms: int, max_batch: int = 100):
+        self.queues = [queue.Queue(maxsize=capacity) for _ in range(workers)]
+        self.latency_budget = latency_budget_ms / 1000
+        self.max_batch = max_batch
+        self._threads: list[threading.Thread] = []
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "enqueued": 0,
+            "processed": 0,
+            "detector_runs": 0,
+            "failed": 0,
+            "over_budget": 0,
+            "blocked_enqueues": 0,
+            "blocked_seconds": 0.0,
+            "max_latency_ms": 0.0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    def start(self):
+        if self.running:
+            return
+        for index, jobs in enumerate(self.queues):
+            thread = threading.Thread(target=self._work, args=(jobs,), name=f"detection-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        """Let the workers finish the queued jobs, then stop them."""
+        if not self.running:
+            return
+        for jobs in self.queues:
+            jobs.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, user_id: str, timestamp: int, readings: list[dict]):
+        """
+        Queue a detection job for the user. When the user's queue is full the caller waits for room,
+        which pushes the backpressure back to the ingesting device instead of dropping the job.
+        """
+        if not self.running:
+            check_all_conditions(user_id, timestamp, readings)
+            return
+        jobs = self.queues[zlib.crc32(user_id.encode()) % len(self.queues)]
+        job = (time.monotonic(), user_id, timestamp, readings)
+        try:
+            jobs.put_nowait(job)
+        except queue.Full:
+            started = time.monotonic()
+            jobs.put(job)
+            self._count("blocked_enqueues", 1, blocked_seconds=time.monotonic() - started)
+        self._count("enqueued", 1)
+
+    def depth(self) -> int:
+        return sum(jobs.qsize() for jobs in self.queues)
+
+    def metrics(self) -> dict:
+        with self._stats_lock:
+            return {
+                **self.stats,
+                "queue_depth": self.depth(),
+                "queue_capacity": sum(jobs.maxsize for jobs in self.queues),
+                "latency_budget_ms": self.latency_budget * 1000,
+            }
+
+    def _count(self, name: str, value, **extra):
+        with self._stats_lock:
+            self.stats[name] += value
+            for key, amount in extra.items():
+                self.stats[key] += amount
+
+    def _drain(self, jobs: queue.Queue, first) -> tuple[list, bool]:
+        """Take the first job and whatever else is already waiting, up to max_batch."""
+        batch = [first]
+        while len(batch) < self.max_batch:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is _STOP:
+                return batch, True
+            batch.append(job)
+        return batch, False
+
+    def _work(self, jobs: queue.Queue):
+        stopping = False
+        while not stopping:
+            first = jobs.get()
+            if first is _STOP:
+                break
+            batch, stopping = self._drain(jobs, first)
+
+            # כמה jobs של אותו משתמש מתאחדים להרצה אחת על החלון המעודכן
+            per_user: dict[str, tuple[int, list[dict]]] = {}
+            for _, user_id, timestamp, readings in batch:
+                last_timestamp, merged = per_user.get(user_id, (timestamp, []))
+                per_user[user_id] = (max(last_timestamp, timestamp), merged + readings)
+
+            with session_scope() as db:
+                for user_id, (timestamp, readings) in per_user.items():
+                    try:
+                        check_all_conditions(user_id, timestamp, readings)
+                    except Exception as error:  # a bad job must not kill the worker
+                        db.rollback()
+                        self._count("failed", 1)
+                        print(f"❌ Detection failed for user {user_id}: {error}")
+
+            self._record_latency(batch, len(per_user))
+
+    def _record_latency(self, batch: list, detector_runs: int):
+        now = time.monotonic()
+        latencies = [now - enqueued_at for enqueued_at, *_ in batch]
+        over_budget = sum(1 for latency in latencies if latency > self.latency_budget)
+        with self._stats_lock:
+            self.stats["processed"] += len(batch)
+            self.stats["detector_runs"] += detector_runs
+            self.stats["over_budget"] += over_budget
+            self.stats["max_latency_ms"] = max(self.stats["max_latency_ms"], max(latencies) * 1000)
+        if over_budget:
+            print(f"⚠ {over_budget} detection jobs exceeded the {self.latency_budget * 1000:.0f}ms latency budget")
+
+
+pipeline = DetectionPipeline(
+    workers=settings.detection_workers,
+    capacity=settings.detection_queue_capacity,
+    latency_budget_ms=settings.detection_latency_budget_ms,
+)
@@ -0,0 +1,165 @@
+import argparse
+import json
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+
+from alerts import Episode, fold, resolve, superseded
+from check import detect_alerts
+from config import settings
+from model import (
+    add_exceptions_bulk,
+    delete_exceptions_between_dates,
+    engine,
+    get_exceptions_between_dates,
+    get_users_with_sensor_data,
+    iter_sensor_data,
+    session_scope,
+    store,
+)
+from rules import RULES
+from stream import LONGEST_WINDOW, UserStream
+from timestamps import formatted, to_ms
+
+# הרצה חוזרת של הגלאים על מדידות שמורות, למשל אחרי שינוי סף ב-config.py:
+#   python replay.py --from "2025-06-01 00:00:00" --to "2025-07-01 00:00:00" --dry-run
+
+# סוגי החריגות שהכללים ב-rules.py מייצרים, רק הם מושווים/נמחקים
+REPLAY_EXCEPTION_TYPES = [rule.exception_type for rule in RULES]
+
+
+def replay_user(user_id: str, start_date: int, end_date: int, chunk_size: int = 5000) -> list[dict]:
+    """
+    Feed one user's stored readings, in time order, through the windowed detectors,
+    folding the detections into episodes the same way alerts.AlertTracker does live.
+    The windows are warmed up with the readings just before `start_date`, which raise no alerts.
+    """
+    warmup_date = start_date - LONGEST_WINDOW
+    stream = UserStream(user_id)
+    current: dict[str, Episode] = {}
+    finished: list[Episode] = []
+    for chunk in iter_sensor_data((warmup_date, end_date), [user_id], chunk_size):
+        for reading in chunk:
+            stream.push(reading)
+            timestamp = reading["timestamp"]
+            if timestamp < start_date:
+                continue
+            for exception_type, alert in detect_alerts(stream).items():
+                previous = current.get(exception_type)
+                if alert is None:
+                    current[exception_type] = resolve(previous, timestamp) or previous
+                    continue
+                detection = Episode(user_id, exception_type, *alert, timestamp, timestamp)
+                episode, action = fold(previous, detection, settings.alert_cooldown_seconds)
+                if action == "open" and previous is not None:
+                    finished.append(superseded(previous) or previous)
+                current[exception_type] = episode
+    episodes = finished + [episode for episode in current.values() if episode is not None]
+    return [{field: value for field, value in episode.record().items() if field != "id"} for episode in episodes]
+
+
+def _span(alert: dict) -> tuple[int, int]:
+    """The time an episode covers: from its opening to its resolution, or to its last detection while open."""
+    return alert["timestamp"], alert["resolved_at"] or alert["last_seen"]
+
+
+def _unmatched(alerts: list[dict], others: list[dict]) -> list[dict]:
+    """The alerts whose span no episode of `others` of the same user and type overlaps."""
+    spans: dict[tuple[str, str], tuple[list[int], list[int]]] = {}
+    for other in sorted(others, key=lambda alert: alert["timestamp"]):
+        starts, ends = spans.setdefault((other["user_id"], other["exception_type"]), ([], []))
+        start, end = _span(other)
+        starts.append(start)
+        ends.append(max(end, ends[-1]) if ends else end)  # הסוף המאוחר ביותר עד כאן
+    unmatched = []
+    for alert in alerts:
+        starts, ends = spans.get((alert["user_id"], alert["exception_type"]), ([], []))
+        start, end = _span(alert)
+        before = bisect_right(starts, end)  # האפיזודות שנפתחו עד סוף הטווח
+        if not before or ends[before - 1] < start:
+            unmatched.append(alert)
+    return unmatched
+
+
+def diff_alerts(replayed: list[dict], existing: list[dict]) -> dict[str, list[dict]]:
+    """
+    Alerts the replay would add, and stored alerts it would no longer raise.
+    Episodes are matched by overlapping spans of the same user and type, not by their exact opening time:
+    the live detection opens an episode at the newest reading of a batch, the replay at the reading that triggered it.
+    """
+    return {"added": _unmatched(replayed, existing), "removed": _unmatched(existing, replayed)}
+
+
+def replay_and_store(user_id: str, start_date: int, end_date: int, chunk_size: int, mode: str) -> dict:
+    """
+    mode: "dry-run" only reports the diff, "write" adds the missing alerts,
+    "replace" deletes the stored alerts of the replayed types in the range and writes the replayed ones.
+    """
+    with session_scope():
+        replayed = replay_user(user_id, start_date, end_date, chunk_size)
+        existing = get_exceptions_between_dates(start_date, end_date, user_id, REPLAY_EXCEPTION_TYPES)
+        diff = diff_alerts(replayed, existing)
+        summary = {
+            "user_id": user_id,
+            "replayed": len(replayed),
+            "existing": len(existing),
+            "added": len(diff["added"]),
+            "removed": len(diff["removed"]),
+        }
+        if mode == "dry-run":
+            return {**summary, "diff": diff}
+        if mode == "replace":
+            summary["deleted"] = delete_exceptions_between_dates(start_date, end_date, user_id, REPLAY_EXCEPTION_TYPES)
+            summary["written"] = add_exceptions_bulk(replayed)["count"]
+        else:
+            summary["written"] = add_exceptions_bulk(diff["added"])["count"]
+        return summary
+
+
+def _init_worker():
+    # חיבורים שעברו מתהליך האב ב-fork לא משותפים עם תהליך הבן
+    engine.dispose(close=False)
+    store.dispose()
+
+
+def replay(period: tuple[int, int], user_ids: list[str] | None, workers: int, chunk_size: int, mode: str):
+    start_date, end_date = period
+    with session_scope():
+        user_ids = user_ids or get_users_with_sensor_data(start_date, end_date)
+    if workers <= 1:
+        for user_id in user_ids:
+            yield replay_and_store(user_id, start_date, end_date, chunk_size, mode)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        yield from pool.map(
+            replay_and_store,
+            user_ids,
+            *([value] * len(user_ids) for value in (start_date, end_date, chunk_size, mode)),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-run the detectors over stored sensor data")
+    parser.add_argument("--from", dest="start_date", type=to_ms, required=True, help="YYYY-MM-DD HH:MM:SS")
+    parser.add_argument("--to", dest="end_date", type=to_ms, required=True, help="YYYY-MM-DD HH:MM:SS")
+    parser.add_argument("--user", dest="user_ids", action="append", help="Replay only this user (repeatable)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of processes, users are spread across them")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="Rows fetched from the cursor at a time")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--dry-run", action="store_const", dest="mode", const="dry-run", help="Only print the diff")
+    mode.add_argument("--replace", action="store_const", dest="mode", const="replace", help="Replace stored alerts")
+    args = parser.parse_args()
+
+    totals = {"users": 0, "replayed": 0, "added": 0, "removed": 0}
+    period = (args.start_date, args.end_date)
+    for summary in replay(period, args.user_ids, args.workers, args.chunk_size, args.mode or "write"):
+        if "diff" in summary:
+            summary["diff"] = {key: [formatted(alert) for alert in alerts] for key, alerts in summary["diff"].items()}
+        print(json.dumps(summary, ensure_ascii=False))
+        totals["users"] += 1
+        for key in ("replayed", "added", "removed"):
+            totals[key] += summary[key]
+    print(json.dumps({"total": totals}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import json
+import threading
+import time
+
+from config import settings
+from model import (
+    delete_sensor_records,
+    drop_sensor_partition,
+    find_expired_sensor_data,
+    find_expired_sensor_partitions,
+    find_old_partition_readings,
+    incremental_vacuum,
+    purge_rollups,
+    readings_near_exceptions,
+    session_scope,
+    store,
+)
+from shared import LEASE_INTERVALS, holds_lease
+from timestamps import DAY, format_ms, now_ms
+
+# מדיניות שמירה: מדידות גולמיות נמחקות אחרי retention_raw_days, מדידות סביב חריגות ו-rollups נשמרים יותר זמן.
+# המחיקה רצה ב-batches קטנים עם הפסקה ביניהם כדי שנעילת הכתיבה של SQLite לא תיתפס לאורך זמן,
+# ובסוף incremental vacuum מחזיר את העמודים שהתפנו למערכת הקבצים. כשהמדידות מחולקות למחיצות לפי יום,
+# יום שפג תוקפו נמחק כקובץ שלם במקום שורה אחרי שורה; במחיצות לפי shard בלבד המחיקה היא ב-batches בתוך כל קובץ.
+# הרצה ידנית:
+#   python retention.py
+
+
+def _cutoff(now: int, days: float) -> int | None:
+    return now - round(days * DAY) if days > 0 else None
+
+
+class Retention:
+    """Applies the retention settings once (run_once) or every `interval` seconds on a background thread."""
+
+    def __init__(self, interval: float, batch_size: int, batch_pause_ms: int, vacuum_pages: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause_ms / 1000
+        self.vacuum_pages = vacuum_pages
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "runs": 0,
+            "readings_deleted": 0,
+            "rollups_deleted": 0,
+            "batches": 0,
+            "pages_freed": 0,
+            "partitions_dropped": 0,
+            "lock_seconds": 0.0,
+            "max_lock_ms": 0.0,
+            "last_run": None,
+        }
+
+    def run_once(self, now: int | None = None) -> dict:
+        now = now or now_ms()
+        started = time.monotonic()
+        run = {
+            "readings_deleted": 0,
+            "rollups_deleted": 0,
+            "batches": 0,
+            "lock_seconds": 0.0,
+            "max_lock_ms": 0.0,
+            "pages_freed": 0,
+            "partitions_dropped": 0,
+        }
+        with session_scope():
+            raw_cutoff = _cutoff(now, settings.retention_raw_days)
+            if raw_cutoff:
+                purge = self._purge_readings
+                if store.partitioned:
+                    purge = self._drop_partitions if store.by_day else self._purge_shards
+                purge(run, raw_cutoff, _cutoff(now, settings.retention_alert_days))
+            for bucket, days in (("1m", settings.retention_rollup_1m_days), ("1h", settings.retention_rollup_1h_days)):
+                cutoff = _cutoff(now, days)
+                if cutoff:
+                    self._purge_rollups(run, bucket, cutoff)
+            run["pages_freed"] = incremental_vacuum(self.vacuum_pages)
+        run["seconds"] = time.monotonic() - started
+        run["readings_per_second"] = run["readings_deleted"] / run["seconds"] if run["seconds"] else 0.0
+        self._record(run, now)
+        return run
+
+    def _batch(self, run: dict, delete, *args) -> int:
+        """Run one delete batch (a single write transaction) and account for how long it held the write lock."""
+        started = time.monotonic()
+        deleted = delete(*args)
+        held = time.monotonic() - started
+        run["batches"] += 1
+        run["lock_seconds"] += held
+        run["max_lock_ms"] = max(run["max_lock_ms"], held * 1000)
+        return deleted
+
+    def _purge_readings(self, run: dict, raw_cutoff: int, alert_cutoff: int | None):
+        after = None
+        while not self._stop.is_set():
+            expired = find_expired_sensor_data(
+                raw_cutoff, alert_cutoff, settings.retention_alert_window_minutes, after, self.batch_size
+            )
+            run["readings_deleted"] += self._batch(run, delete_sensor_records, expired)
+            if len(expired) < self.batch_size:
+                return
+            # המדידות שנשמרו (סביב חריגות) לא נסרקות שוב ב-batch הבא
+            after = (expired[-1][2], expired[-1][0])
+            time.sleep(self.batch_pause)
+
+    def _purge_shards(self, run: dict, raw_cutoff: int, alert_cutoff: int | None):
+        """Partitions by shard only have no day file to drop: their old readings are deleted in batches."""
+        window = settings.retention_alert_window_minutes
+        for partition in store.partitions():
+            after = None
+            while not self._stop.is_set():
+                old = find_old_partition_readings(partition, raw_cutoff, after, self.batch_size)
+                kept = readings_near_exceptions(old, alert_cutoff, window)
+                expired = [record for record in old if record[0] not in kept]
+                run["readings_deleted"] += self._batch(run, delete_sensor_records, expired)
+                if len(old) < self.batch_size:
+                    break
+                after = (old[-1][2], old[-1][0])
+                time.sleep(self.batch_pause)
+
+    def _drop_partitions(self, run: dict, raw_cutoff: int, alert_cutoff: int | None):
+        """Whole expired days, one file delete each."""
+        window = settings.retention_alert_window_minutes
+        for partition in find_expired_sensor_partitions(raw_cutoff, alert_cutoff, window):
+            if self._stop.is_set():
+                return
+            run["readings_deleted"] += drop_sensor_partition(partition)
+            run["partitions_dropped"] += 1
+
+    def _purge_rollups(self, run: dict, bucket: str, cutoff: int):
+        while not self._stop.is_set():
+            deleted = self._batch(run, purge_rollups, bucket, cutoff, self.batch_size)
+            run["rollups_deleted"] += deleted
+            if deleted < self.batch_size:
+                return
+            time.sleep(self.batch_pause)
+
+    def _record(self, run: dict, now: int):
+        with self._stats_lock:
+            self.stats["runs"] += 1
+            for key in ("readings_deleted", "rollups_deleted", "batches", "pages_freed", "partitions_dropped"):
+                self.stats[key] += run[key]
+            self.stats["lock_seconds"] += run["lock_seconds"]
+            self.stats["max_lock_ms"] = max(self.stats["max_lock_ms"], run["max_lock_ms"])
+            self.stats["last_run"] = {"at": format_ms(now), **run}
+
+    def metrics(self) -> dict:
+        with self._stats_lock:
+            return {**self.stats, "interval_seconds": self.interval}
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(self.interval)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not holds_lease("retention", LEASE_INTERVALS * self.interval):
+                    continue  # worker אחר מריץ את ה-retention
+                run = self.run_once()
+            except Exception as error:  # a failed run must not kill the loop
+                print(f"❌ Retention failed: {error}")
+                continue
+            if run["readings_deleted"] or run["rollups_deleted"]:
+                print(
+                    f"Retention deleted {run['readings_deleted']} readings and {run['rollups_deleted']} rollups "
+                    f"in {run['seconds']:.1f}s, longest lock {run['max_lock_ms']:.0f}ms"
+                )
+
+
+retention = Retention(
+    interval=settings.retention_interval_seconds,
+    batch_size=settings.retention_batch_size,
+    batch_pause_ms=settings.retention_batch_pause_ms,
+    vacuum_pages=settings.retention_vacuum_pages,
+)
+
+
+if __name__ == "__main__":
+    print(json.dumps(retention.run_once(), indent=2))
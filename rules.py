@@ -0,0 +1,118 @@
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+from config import settings
+
+# כללי הזיהוי: כל כלל מצהיר על אורך החלון שלו, השדות שהוא קורא והטווחים שנספרים בהם; הספים ב-config.py.
+# stream.py מחזיק לכל משתמש חלון אחד לכל אורך, רק עם השדות של הכללים שמשתמשים בו,
+# וממלא אותם מה-DB בשאילתה אחת לחלון הארוך ביותר של אותו משתמש. check.py מריץ את כל הכללים על אותם חלונות.
+
+INF = float("inf")
+
+
+@dataclass(frozen=True)
+class Rule:
+    exception_type: str
+    window_seconds: int
+    fields: tuple[str, ...]
+    evaluate: Callable  # (window) -> (exception_level, details), or None when the condition does not hold
+    min_samples: int = 3  # פחות מדידות בחלון = הכלל לא רץ (וגם לא סוגר אפיזודה)
+    ranges: dict[str, dict[str, tuple[float, float]]] = field(default_factory=dict)  # field -> name -> (low, high)
+
+    @property
+    def window(self) -> str:
+        return window_name(self.window_seconds)
+
+
+def window_name(seconds: int) -> str:
+    return f"{seconds // 60}m" if seconds % 60 == 0 else f"{seconds}s"
+
+
+# --- הכללים, כל אחד מקבל את ה-SlidingWindow של האורך שהצהיר עליו ---
+
+
+def heatstroke(window) -> tuple[str, str] | None:
+    """Every temperature of the last minute at or above the heatstroke threshold."""
+    temperature = window.stats["temperature"]
+    if temperature.count and temperature.in_range["heatstroke"] == temperature.count:
+        return "red", f"Abnormally consistent temperature ({temperature.mean:.1f}°C) detected for 1 minute"
+    return None
+
+
+def coldshock(window) -> tuple[str, str] | None:
+    """Temperature averaging below the hypothermia threshold for five minutes, red when also shivering."""
+    temperature = window.stats["temperature"]
+    if not temperature.count or temperature.mean >= settings.rule_coldshock_temperature:
+        return None
+    tremors = window.stats["movement"].in_range["tremor"]
+    details = f"Temperature averaging {temperature.mean:.1f}°C for 5 minutes"
+    if tremors >= settings.rule_coldshock_tremors:
+        return "red", f"{details} with {tremors} shivering movements"
+    return "yellow", details
+
+
+def fall(window) -> tuple[str, str] | None:
+    """An impact in the last 30 seconds and no movement since."""
+    movement = window.stats["movement"]
+    last = window.last("movement")
+    if not movement.count or last is None:
+        return None
+    if movement.max >= settings.rule_fall_impact_movement and last <= settings.rule_fall_still_movement:
+        return "red", f"Impact (movement {movement.max:.1f}) followed by lying still"
+    return None
+
+
+def dehydration(window) -> tuple[str, str] | None:
+    """Little sweat while the heart works hard, over five minutes."""
+    sweat, heart_rate = window.stats["sweat_level"], window.stats["heart_rate"]
+    if not sweat.count or not heart_rate.count:
+        return None
+    if sweat.mean <= settings.rule_dehydration_sweat_level and heart_rate.mean >= settings.rule_dehydration_heart_rate:
+        return "yellow", f"Low sweat level ({sweat.mean:.2f}) with heart rate {heart_rate.mean:.0f} for 5 minutes"
+    return None
+
+
+def pre_syncope(window) -> tuple[str, str] | None:
+    """Heart rate averaging below the fainting threshold over the last minute."""
+    heart_rate = window.stats["heart_rate"]
+    if heart_rate.count and heart_rate.mean <= settings.rule_presyncope_heart_rate:
+        return "red", f"Heart rate averaging {heart_rate.mean:.0f} bpm for 1 minute"
+    return None
+
+
+ALL_RULES = {
+    rule.exception_type: rule
+    for rule in (
+        Rule(
+            "heatstroke",
+            60,
+            ("temperature",),
+            heatstroke,
+            ranges={"temperature": {"heatstroke": (settings.rule_heatstroke_temperature, INF)}},
+        ),
+        Rule(
+            "coldshock",
+            300,
+            ("temperature", "movement"),
+            coldshock,
+            min_samples=10,
+            ranges={"movement": {"tremor": (settings.rule_tremor_movement, INF)}},
+        ),
+        Rule("fall", 30, ("movement",), fall, min_samples=2),
+        Rule("dehydration", 300, ("sweat_level", "heart_rate"), dehydration, min_samples=10),
+        Rule("pre_syncope", 60, ("heart_rate",), pre_syncope),
+    )
+}
+
+
+def enabled_rules(names: str) -> list[Rule]:
+    """The rules named in HM_DETECTION_RULES (comma separated), in that order."""
+    rules = []
+    for name in filter(None, (name.strip() for name in names.split(","))):
+        if name not in ALL_RULES:
+            raise ValueError(f"Unknown rule '{name}' in HM_DETECTION_RULES, use: {', '.join(ALL_RULES)}")
+        rules.append(ALL_RULES[name])
+    return rules
+
+
+RULES = enabled_rules(settings.detection_rules)
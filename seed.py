@@ -0,0 +1,241 @@
+import argparse
+import json
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+
+from model import (
+    ROLLUP_BUCKETS,
+    ROLLUP_METRICS,
+    SENSOR_ROW_COLUMNS,
+    add_sensor_rows_bulk,
+    add_users_bulk,
+    session_scope,
+)
+from replay import replay
+from stream import drop_stream
+from timestamps import SECOND, formatted, now_ms, to_ms
+
+# יצירת נתוני בדיקה: מדידות לתרחישים שונים מחושבות במערכי NumPy לכל קבוצת משתמשים,
+# ונכנסות ב-executemany אחד לכל טרנזקציה גדולה. למשל מיליון מדידות:
+#   python seed.py --users 1000 --samples 1000 --scenario mix --detect
+
+
+# כל תרחיש מקבל (משתמשים, מדידות) ומחזיר מערך בצורה הזו לכל שדה
+def normal_scenario(rng: np.random.Generator, shape: tuple[int, int]) -> dict[str, np.ndarray]:
+    """Resting wearer, skin temperature kept under the 34°C heatstroke threshold."""
+    return {
+        "heart_rate": rng.normal(75, 8, shape).clip(45, 120),
+        "temperature": rng.normal(32.5, 0.4, shape).clip(30.0, 33.9),
+        "movement_x": rng.normal(0.3, 0.15, shape).clip(0, 1),
+        "movement_y": rng.normal(0.3, 0.15, shape).clip(0, 1),
+        "movement_z": rng.normal(0.3, 0.15, shape).clip(0, 1),
+        "sweat_level": rng.normal(0.3, 0.1, shape).clip(0, 1),
+    }
+
+
+def heat_ramp_scenario(rng: np.random.Generator, shape: tuple[int, int]) -> dict[str, np.ndarray]:
+    """Temperature climbs from 30 to 42°C (the old /demo data), heart rate follows, sweat rises then dries up."""
+    progress = np.linspace(0, 1, shape[1])
+    columns = normal_scenario(rng, shape)
+    columns["temperature"] = 30 + 12 * progress + rng.normal(0, 0.2, shape)
+    columns["heart_rate"] = (80 + 60 * progress + rng.normal(0, 8, shape)).clip(25, 190)
+    columns["sweat_level"] = (0.3 + 0.5 * np.sin(np.pi * progress) + rng.normal(0, 0.05, shape)).clip(0, 1)
+    return columns
+
+
+def hypothermia_scenario(rng: np.random.Generator, shape: tuple[int, int]) -> dict[str, np.ndarray]:
+    """Temperature drops by 4°C, heart rate slows and shivering grows stronger."""
+    progress = np.linspace(0, 1, shape[1])
+    columns = normal_scenario(rng, shape)
+    columns["temperature"] = 33 - 4 * progress + rng.normal(0, 0.2, shape)
+    columns["heart_rate"] = (75 - 20 * progress + rng.normal(0, 5, shape)).clip(35, 120)
+    for axis in ("movement_x", "movement_y", "movement_z"):
+        columns[axis] = np.abs(rng.normal(0, 0.2 + 1.3 * progress, shape))
+    columns["sweat_level"] = rng.normal(0.05, 0.02, shape).clip(0, 1)
+    return columns
+
+
+def dehydration_scenario(rng: np.random.Generator, shape: tuple[int, int]) -> dict[str, np.ndarray]:
+    """Sweat dries up, heart rate climbs and the skin warms a little (still under the heatstroke threshold)."""
+    progress = np.linspace(0, 1, shape[1])
+    columns = normal_scenario(rng, shape)
+    columns["sweat_level"] = (0.3 * np.exp(-5 * progress) + rng.normal(0, 0.01, shape)).clip(0, 1)
+    columns["heart_rate"] = (75 + 35 * progress + rng.normal(0, 5, shape)).clip(45, 160)
+    columns["temperature"] = (32.5 + progress + rng.normal(0, 0.2, shape)).clip(30.0, 33.9)
+    return columns
+
+
+def fall_scenario(rng: np.random.Generator, shape: tuple[int, int]) -> dict[str, np.ndarray]:
+    """Normal readings, one impact at a random moment, then lying still with a raised heart rate."""
+    users, samples = shape
+    columns = normal_scenario(rng, shape)
+    impact = rng.integers(samples // 4, max(samples // 4 + 1, 3 * samples // 4), size=users)[:, None]
+    index = np.arange(samples)[None, :]
+    after = index > impact
+    for axis in ("movement_x", "movement_y", "movement_z"):
+        columns[axis] = np.where(index == impact, rng.uniform(2.5, 4.0, shape), columns[axis])
+        columns[axis] = np.where(after, rng.normal(0.02, 0.01, shape).clip(0, 1), columns[axis])
+    recovery = 30 * np.exp(-(index - impact) / 60)
+    columns["heart_rate"] = np.where(after, columns["heart_rate"] + recovery, columns["heart_rate"])
+    return columns
+
+
+SCENARIOS = {
+    "normal": normal_scenario,
+    "heat_ramp": heat_ramp_scenario,
+    "hypothermia": hypothermia_scenario,
+    "dehydration": dehydration_scenario,
+    "fall": fall_scenario,
+}
+
+
+@dataclass
+class SeedPlan:
+    user_ids: list[str]
+    scenario: str = "mix"  # "mix" = התרחישים מחולקים בין המשתמשים לפי הסדר
+    samples: int = 1000  # מדידות לכל משתמש
+    interval_seconds: float = 1.0
+    start: datetime | None = None  # ברירת מחדל: כך שהמדידה האחרונה היא עכשיו
+    random_seed: int | None = None
+    chunk_rows: int = 200_000  # מדידות לטרנזקציה
+
+    def scenarios(self) -> dict[str, list[str]]:
+        names = list(SCENARIOS) if self.scenario == "mix" else [self.scenario]
+        assigned: dict[str, list[str]] = {}
+        for index, user_id in enumerate(self.user_ids):
+            assigned.setdefault(names[index % len(names)], []).append(user_id)
+        return assigned
+
+
+def _timestamps(start: int, samples: int, interval_seconds: float) -> np.ndarray:
+    """Epoch ms of every sample, starting at a whole second."""
+    return start - start % SECOND + (np.arange(samples) * interval_seconds * SECOND).round().astype(np.int64)
+
+
+def _rounded(columns: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """The values as they are stored, plus the movement magnitude the rollups keep."""
+    rounded = {
+        "heart_rate": columns["heart_rate"].round().astype(int),
+        "temperature": columns["temperature"].round(1),
+        **{name: columns[name].round(2) for name in ("movement_x", "movement_y", "movement_z", "sweat_level")},
+    }
+    rounded["movement"] = np.sqrt(rounded["movement_x"] ** 2 + rounded["movement_y"] ** 2 + rounded["movement_z"] ** 2)
+    return rounded
+
+
+def _rows(user_ids: list[str], timestamps: np.ndarray, columns: dict[str, np.ndarray]) -> list[tuple]:
+    return list(
+        zip(
+            np.repeat(np.array(user_ids), len(timestamps)).tolist(),
+            np.tile(timestamps, len(user_ids)).tolist(),
+            *(columns[name].ravel().tolist() for name in SENSOR_ROW_COLUMNS[2:]),
+            strict=True,
+        )
+    )
+
+
+def _rollups(user_ids: list[str], timestamps: np.ndarray, columns: dict[str, np.ndarray]) -> list[dict]:
+    """
+    The group's minute/hour rollups computed on the arrays: timestamps are increasing and shared by all users,
+    so every bucket is one contiguous run of samples and each aggregate is a `reduceat` along the time axis.
+    """
+    rollups = []
+    for bucket, size in ROLLUP_BUCKETS.items():
+        keys = timestamps - timestamps % size
+        starts = np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1]
+        counts = np.diff(np.r_[starts, len(keys)]).tolist()
+        aggregates = {}
+        for metric in ROLLUP_METRICS:
+            values = columns[metric].astype(float)
+            aggregates[f"{metric}_min"] = np.minimum.reduceat(values, starts, axis=1).tolist()
+            aggregates[f"{metric}_max"] = np.maximum.reduceat(values, starts, axis=1).tolist()
+            aggregates[f"{metric}_sum"] = np.add.reduceat(values, starts, axis=1).tolist()
+        bucket_starts = keys[starts].tolist()
+        for row, user_id in enumerate(user_ids):
+            for index, bucket_start in enumerate(bucket_starts):
+                rollup = {"user_id": user_id, "bucket": bucket, "bucket_start": bucket_start, "count": counts[index]}
+                for name, values in aggregates.items():
+                    rollup[name] = values[row][index]
+                rollups.append(rollup)
+    return rollups
+
+
+def seed(plan: SeedPlan) -> dict:
+    """Create the plan's users (if missing) and their readings with their rollups, one transaction per chunk."""
+    if plan.scenario != "mix" and plan.scenario not in SCENARIOS:
+        return {"error": f"Unknown scenario '{plan.scenario}', use one of: mix, {', '.join(SCENARIOS)}"}
+    if plan.samples < 1 or plan.interval_seconds <= 0:
+        return {"error": "samples and interval_seconds must be positive"}
+    started = time.monotonic()
+    rng = np.random.default_rng(plan.random_seed)
+    start = to_ms(plan.start) if plan.start else now_ms() - round(plan.samples * plan.interval_seconds * SECOND)
+    timestamps = _timestamps(start, plan.samples, plan.interval_seconds)
+
+    created = add_users_bulk([(user_id, "Seed", f"User {user_id}") for user_id in plan.user_ids])
+    inserted = 0
+    users_per_chunk = max(1, plan.chunk_rows // plan.samples)
+    assigned = plan.scenarios()
+    for name, user_ids in assigned.items():
+        for first in range(0, len(user_ids), users_per_chunk):
+            group = user_ids[first : first + users_per_chunk]
+            columns = _rounded(SCENARIOS[name](rng, (len(group), plan.samples)))
+            inserted += add_sensor_rows_bulk(_rows(group, timestamps, columns), _rollups(group, timestamps, columns))
+
+    start_date, end_date = int(timestamps[0]), int(timestamps[-1])
+    for user_id in plan.user_ids:
+        drop_stream(user_id)  # חלון שכבר בזיכרון לא כולל את המדידות החדשות
+    return {
+        "users": len(plan.user_ids),
+        "users_created": created,
+        "readings": inserted,
+        "scenarios": {name: len(user_ids) for name, user_ids in assigned.items()},
+        "from": start_date,
+        "to": end_date,
+        "seconds": round(time.monotonic() - started, 2),
+    }
+
+
+def detect_seeded(result: dict, user_ids: list[str], workers: int = 1) -> dict:
+    """One batched replay of the windowed detectors over the seeded range, writing the alerts it raises."""
+    started = time.monotonic()
+    summaries = list(replay((result["from"], result["to"]), user_ids, workers, 5000, "write"))
+    return {
+        "alerts_written": sum(summary["written"] for summary in summaries),
+        "seconds": round(time.monotonic() - started, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed synthetic sensor data")
+    parser.add_argument("--users", type=int, default=10, help="Number of users, named <prefix>-<n>")
+    parser.add_argument("--user", dest="user_ids", action="append", help="Seed this user (repeatable)")
+    parser.add_argument("--prefix", default="seed", help="User id prefix for --users")
+    parser.add_argument("--scenario", default="mix", choices=["mix", *SCENARIOS])
+    parser.add_argument("--samples", type=int, default=1000, help="Readings per user")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between readings")
+    parser.add_argument("--start", help="YYYY-MM-DD HH:MM:SS of the first reading, default so the last one is now")
+    parser.add_argument("--seed", type=int, help="Random seed, for reproducible data")
+    parser.add_argument("--detect", action="store_true", help="Replay the detectors over the seeded data")
+    parser.add_argument("--workers", type=int, default=4, help="Processes for --detect")
+    args = parser.parse_args()
+
+    plan = SeedPlan(
+        user_ids=args.user_ids or [f"{args.prefix}-{index}" for index in range(args.users)],
+        scenario=args.scenario,
+        samples=args.samples,
+        interval_seconds=args.interval,
+        start=datetime.fromisoformat(args.start) if args.start else None,
+        random_seed=args.seed,
+    )
+    with session_scope():
+        result = seed(plan)
+    if args.detect and "error" not in result:
+        result["detection"] = detect_seeded(result, plan.user_ids, args.workers)
+    print(json.dumps(formatted(result), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import multiprocessing
+import os
+import socket
+import threading
+
+from alerts import alert_tracker
+from cache import latest_cache
+from config import settings
+from events import bus
+from model import (
+    add_shared_events,
+    claim_lease,
+    get_last_shared_event_id,
+    get_shared_events,
+    purge_shared_events,
+    session_scope,
+    store,
+)
+from stream import drop_stream
+from timestamps import SECOND, now_ms
+
+# כמה תהליכי worker על אותה מכונה (uvicorn --workers N) חולקים את ה-DB הראשי, וכל מה שחייב להיות אחיד ביניהם עובר דרכו:
+#   shared_state: מצב לחצן המצוקה, ו-leases שמבטיחים שמשימות הרקע (retention, fleet analysis) רצות ב-worker אחד
+#   shared_event: האירועים של ה-bus ושינויי ה-LatestCache. ה-relay של כל worker כותב את שלו פעם ב-interval
+#   וקורא את של האחרים, כך שלקוחות /stream מקבלים אירועים מכל ה-workers, ו-/metrics/last, /buzz ו-/test
+#   רואים כתיבות שנעשו ב-worker אחר.
+# מצב הזיהוי (חלונות ואפיזודות פתוחות) נשאר לכל תהליך: מכשיר צריך לשלוח לאותו worker (חיבור keep-alive).
+# בלי HM_EVENT_RELAY_INTERVAL_MS ה-relay נדלק לבד כשהתהליך הוא אחד מכמה workers, אחרת ה-workers לא רואים זה את זה
+
+AUTO_INTERVAL_MS = 200  # ה-interval כשה-relay נדלק לבד
+OUTBOX_SIZE = 100_000  # אירועים שמחכים לשליחה, מעבר לזה הם נזרקים ונספרים
+READ_LIMIT = 100  # שורות (שליחות) בקריאה אחת
+LEASE_INTERVALS = 3  # lease של משימה שרצה כל interval פג אחרי 3 סבבים בלי חידוש, ו-worker אחר לוקח אותה
+# אירועים שלא מגיעים ללקוחות /stream, רק מעדכנים את המצב בזיכרון של שאר ה-workers
+SHARE_ONLY = frozenset({"exception_seen", "user_deleted", "reading_deleted", "exceptions_deleted", "readings_dropped"})
+
+
+def worker_id() -> str:
+    """The id of the current process, as lease owner and origin of relayed events (computed after a fork)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def several_workers() -> bool:
+    """Whether this process is one of several workers: spawned by the uvicorn supervisor, or WEB_CONCURRENCY > 1."""
+    return multiprocessing.parent_process() is not None or int(os.environ.get("WEB_CONCURRENCY") or 1) > 1
+
+
+def holds_lease(job: str, seconds: float) -> bool:
+    """Take or renew the lease of a background job; only the worker holding it runs the job."""
+    with session_scope():
+        return claim_lease(f"lease:{job}", worker_id(), now_ms() + round(seconds * SECOND))
+
+
+def apply(event_type: str, data: dict, user_id: str | None):
+    """An event from another worker: update this process's state, then hand it to the local /stream clients."""
+    if event_type == "metric":
+        latest_cache.put_reading(data)
+    elif event_type in ("exception", "exception_resolved", "exception_seen"):
+        latest_cache.put_exception(data)
+    elif event_type == "reading_deleted":
+        latest_cache.invalidate_reading(user_id, data["id"])
+    elif event_type == "exceptions_deleted":
+        latest_cache.invalidate_exceptions()
+    elif event_type == "readings_dropped":
+        store.refresh()
+        latest_cache.drop_readings_before(data["before"])
+    elif event_type == "user_deleted":
+        latest_cache.drop_user(user_id)
+        drop_stream(user_id)
+        alert_tracker.drop_user(user_id)
+    if event_type not in SHARE_ONLY:
+        bus.deliver(event_type, data, user_id)
+
+
+class EventRelay:
+    """Sends this worker's bus events to the others through the shared_event table, and applies theirs."""
+
+    def __init__(self, interval_ms: int, keep_seconds: float):
+        self.interval = interval_ms / 1000
+        self.keep_seconds = keep_seconds
+        self._outbox: list[list] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._last_id = 0
+        self._last_purge = 0
+        self.stats = {"sent": 0, "received": 0, "dropped": 0, "errors": 0}
+
+    def send(self, event_type: str, data: dict, user_id: str | None):
+        """The bus relay: queue the event for the next write, without touching the DB on the caller's thread."""
+        with self._lock:
+            if len(self._outbox) >= OUTBOX_SIZE:
+                self.stats["dropped"] += 1
+                return
+            self._outbox.append([event_type, data, user_id])
+
+    def start(self):
+        if self.interval <= 0 and several_workers():
+            self.interval = AUTO_INTERVAL_MS / 1000
+            print(f"🔁 Several workers: relaying events every {AUTO_INTERVAL_MS} ms (HM_EVENT_RELAY_INTERVAL_MS is 0)")
+        if self.interval <= 0 or self._thread is not None:
+            return
+        with session_scope():
+            self._last_id = get_last_shared_event_id()  # מה שנכתב לפני ההפעלה כבר ב-DB, וה-cache נטען ממנו
+        bus.relay = self.send
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="event-relay", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        bus.relay = None
+        self._stop.set()
+        self._thread.join(self.interval + 5)
+        self._thread = None
+        self.tick()  # מה שנשאר בתור
+
+    def tick(self):
+        """One round: write the queued events, apply the other workers' new ones, and purge the old rows."""
+        with self._lock:
+            outbox, self._outbox = self._outbox, []
+        with session_scope():
+            if outbox:
+                add_shared_events(worker_id(), outbox)
+                self.stats["sent"] += len(outbox)
+            store.refresh()  # מחיצות שנוצרו ב-worker אחר
+            while rows := get_shared_events(self._last_id, worker_id(), READ_LIMIT):
+                for shared_id, events in rows:
+                    for event_type, data, user_id in events:
+                        apply(event_type, data, user_id)
+                    self._last_id = shared_id
+                    self.stats["received"] += len(events)
+                if len(rows) < READ_LIMIT:
+                    break
+            now = now_ms()
+            if now - self._last_purge > self.keep_seconds * SECOND:
+                purge_shared_events(now - round(self.keep_seconds * SECOND))
+                self._last_purge = now
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as error:  # a failed round must not kill the loop, its events are lost
+                self.stats["errors"] += 1
+                print(f"❌ Event relay failed: {error}")
+
+    def metrics(self) -> dict:
+        with self._lock:
+            queued = len(self._outbox)
+        return {
+            "worker": worker_id(),
+            "interval_ms": round(self.interval * 1000),
+            "running": self._thread is not None,
+            "last_id": self._last_id,
+            "queued": queued,
+            **self.stats,
+        }
+
+
+relay = EventRelay(settings.event_relay_interval_ms, settings.event_relay_keep_seconds)
@@ -0,0 +1,286 @@
+import contextlib
+import os
+import re
+import threading
+import zlib
+from datetime import date, timedelta
+
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, event, insert
+from sqlalchemy.exc import OperationalError
+
+from timestamps import local_day, text_to_ms_sql
+
+# אחסון המדידות: ברירת המחדל היא טבלת sensor_data של ה-DB הראשי. אפשר לפצל אותה לקבצי SQLite
+# לפי יום ו/או לפי shard של המשתמש (crc32 של ה-id); לכל קובץ נעילת כתיבה משלו, ויום ישן נמחק במחיקת הקובץ.
+# model.py מנתב כל פעולה רק למחיצות שיכולות להכיל את טווח הזמנים / המשתמשים שלה. מצב המחיצות:
+#   python model.py --partitions
+#   python model.py --move-to-partitions   # העברת המדידות מהטבלה הראשית, אחרי הפעלת HM_SENSOR_PARTITION_BY
+
+PARTITION_MODES = ("none", "day", "shard", "day+shard")
+# id של מדידה = (מספר המחיצה << ID_BITS) + מספר השורה בתוכה, כך שה-id לבדו מוביל למחיצה.
+# מספר המחיצה = ימים מ-1970 * shards + shard, נשאר מתחת ל-2^53 (מספר שלם בטוח ב-JavaScript)
+ID_BITS = 32
+EPOCH = date(1970, 1, 1)
+FILE_PATTERN = re.compile(r"^sensor(?:-(\d{4}-\d{2}-\d{2}))?(?:-s(\d+))?\.db$")
+
+
+def rebuild_table(conn, table: Table, expressions: dict[str, str]):
+    """
+    Recreate an existing SQLite table with the column types declared in `table`, copying the rows through
+    the SQL `expressions` of the converted columns. SQLite cannot change a column's type, and a VARCHAR column
+    would store integers as text. The AUTOINCREMENT sequence, if any, is carried over.
+    """
+    name, old = table.name, f"{table.name}_old"
+    for index in table.indexes:
+        conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+    conn.exec_driver_sql(f"ALTER TABLE {name} RENAME TO {old}")
+    table.create(conn)
+    columns = [column.name for column in table.columns]
+    selected = ", ".join(expressions.get(column, column) for column in columns)
+    conn.exec_driver_sql(f"INSERT INTO {name} ({', '.join(columns)}) SELECT {selected} FROM {old}")
+    sequence = None
+    if conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").first():
+        sequence = conn.exec_driver_sql("SELECT seq FROM sqlite_sequence WHERE name = ?", (old,)).scalar()
+    conn.exec_driver_sql(f"DROP TABLE {old}")
+    if sequence is None:
+        return
+    # טבלה ריקה לא מקבלת שורה ב-sqlite_sequence מה-INSERT, וה-id של מחיצה חייב להמשיך מתחילת הטווח שלה
+    updated = conn.exec_driver_sql("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = ?", (sequence, name))
+    if not updated.rowcount:
+        conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (name, sequence))
+
+
+class Partition:
+    """One partition file with its own engine, holding a sensor_data table like the main one."""
+
+    def __init__(self, path: str, day: str | None, shard: int, engine):
+        self.path = path
+        self.day = day
+        self.shard = shard
+        self.engine = engine
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)[: -len(".db")]
+
+    def read(self, statement) -> list:
+        with self.engine.connect() as conn:
+            return conn.execute(statement).all()
+
+    def stream(self, statement, chunk_size: int):
+        """Yield the rows (mappings) from a server side cursor, `chunk_size` at a time."""
+        with self.engine.connect() as conn:
+            yield from conn.execution_options(yield_per=chunk_size).execute(statement).mappings()
+
+    def write(self, statement, params=None) -> list:
+        """Run a write in its own transaction; returns the RETURNING rows, if any."""
+        with self.engine.begin() as conn:
+            result = conn.execute(statement, params)
+            return result.all() if result.returns_rows else []
+
+
+class SensorStore:
+    """
+    Routes sensor_data to partitions. `partitioned` is False in the default "none" mode,
+    where model.py keeps using the main table on its session and this class is not involved.
+    """
+
+    def __init__(self, table: Table, partition_by: str, shards: int, directory: str, pragmas: dict[str, object]):
+        if partition_by not in PARTITION_MODES:
+            modes = ", ".join(PARTITION_MODES)
+            raise ValueError(f"Unknown HM_SENSOR_PARTITION_BY '{partition_by}', use one of: {modes}")
+        self.partition_by = partition_by
+        self.partitioned = partition_by != "none"
+        self.by_day = "day" in partition_by
+        self.shards = max(1, shards) if "shard" in partition_by else 1
+        self.directory = directory
+        self.pragmas = pragmas
+        # אותן עמודות ואינדקסים כמו בטבלה הראשית, בלי ה-foreign key לטבלת המשתמשים שלא קיימת בקובץ
+        self.table = Table(
+            table.name,
+            MetaData(),
+            *(Column(column.name, column.type, primary_key=column.primary_key) for column in table.columns),
+            *(Index(index.name, *(column.name for column in index.columns)) for index in table.indexes),
+            sqlite_autoincrement=True,
+        )
+        self._partitions: dict[tuple[str | None, int], Partition] = {}
+        self._lock = threading.Lock()
+        if self.partitioned:
+            self._open_existing()
+
+    # --- routing ---
+
+    def shard_of(self, user_id: str) -> int:
+        return zlib.crc32(user_id.encode()) % self.shards
+
+    def _key(self, user_id: str, timestamp: int) -> tuple[str | None, int]:
+        return (local_day(timestamp) if self.by_day else None, self.shard_of(user_id))
+
+    def partitions(self, period: tuple[int | None, int | None] | None = None, user_ids=None) -> list[Partition]:
+        """The existing partitions that can hold readings of the (start, end) epoch-ms period and users."""
+        start_day, end_day = (local_day(value) if value is not None else None for value in period or (None, None))
+        shards = {self.shard_of(user_id) for user_id in user_ids} if user_ids else None
+        with self._lock:
+            items = sorted(self._partitions.items(), key=lambda item: (item[0][0] or "", item[0][1]))
+        return [
+            partition
+            for (day, shard), partition in items
+            if (shards is None or shard in shards)
+            and (day is None or ((start_day is None or day >= start_day) and (end_day is None or day <= end_day)))
+        ]
+
+    def partition_of_id(self, record_id: int) -> Partition | None:
+        days, shard = divmod(record_id >> ID_BITS, self.shards)
+        day = (EPOCH + timedelta(days=days)).isoformat() if self.by_day else None
+        with self._lock:
+            return self._partitions.get((day, shard))
+
+    def days(self) -> list[str]:
+        with self._lock:
+            return sorted({day for day, _ in self._partitions if day is not None})
+
+    # --- writes ---
+
+    def insert(self, rows: list[dict]) -> list[int]:
+        """Insert readings where they belong, one transaction per partition; ids come back in the order of `rows`."""
+        groups: dict[tuple[str | None, int], list[int]] = {}
+        for index, row in enumerate(rows):
+            groups.setdefault(self._key(row["user_id"], row["timestamp"]), []).append(index)
+        ids = [0] * len(rows)
+        statement = insert(self.table).returning(self.table.c.id, sort_by_parameter_order=True)
+        for key, indexes in groups.items():
+            returned = self._partition(key).write(statement, [rows[index] for index in indexes])
+            for index, (record_id,) in zip(indexes, returned, strict=True):
+                ids[index] = record_id
+        return ids
+
+    def insert_tuples(self, rows: list[tuple], columns: tuple[str, ...]):
+        """Seeding fast path: tuples starting with (user_id, timestamp), one driver executemany per partition."""
+        groups: dict[tuple[str | None, int], list[tuple]] = {}
+        for row in rows:
+            groups.setdefault(self._key(row[0], row[1]), []).append(row)
+        sql = f"INSERT INTO {self.table.name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        for key, group in groups.items():
+            with self._partition(key).engine.begin() as conn:
+                conn.exec_driver_sql(sql, group)
+
+    def drop(self, partition: Partition):
+        """Remove a partition with its files: instant, whatever its size."""
+        with self._lock:
+            self._partitions.pop((partition.day, partition.shard), None)
+        partition.engine.dispose()
+        for suffix in ("", "-wal", "-shm"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partition.path + suffix)
+
+    def dispose(self):
+        """After a fork: the child opens its own connections instead of sharing the parent's."""
+        with self._lock:
+            for partition in self._partitions.values():
+                partition.engine.dispose(close=False)
+
+    # --- files ---
+
+    def _file_name(self, day: str | None, shard: int) -> str:
+        parts = ["sensor"]
+        if day is not None:
+            parts.append(day)
+        if "shard" in self.partition_by:
+            parts.append(f"s{shard}")
+        return "-".join(parts) + ".db"
+
+    def _id_base(self, day: str | None, shard: int) -> int:
+        days = (date.fromisoformat(day) - EPOCH).days if day else 0
+        return (days * self.shards + shard) << ID_BITS
+
+    def _engine(self, path: str):
+        engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+        @event.listens_for(engine, "connect")
+        def _configure(dbapi_connection, _connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in self.pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+        return engine
+
+    def _partition(self, key: tuple[str | None, int]) -> Partition:
+        """The partition of the key, created (file, table, indexes and id range) on first use."""
+        with self._lock:
+            partition = self._partitions.get(key)
+            if partition is None:
+                day, shard = key
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, self._file_name(day, shard))
+                partition = Partition(path, day, shard, self._engine(path))
+                try:
+                    self._create(partition)
+                except OperationalError:
+                    # worker אחר יצר את אותה מחיצה באותו רגע, בניסיון השני הטבלה כבר קיימת
+                    self._create(partition)
+                self._partitions[key] = partition
+            return partition
+
+    def _create(self, partition: Partition):
+        with partition.engine.begin() as conn:
+            self.table.create(conn, checkfirst=True)
+            sequence = "SELECT seq FROM sqlite_sequence WHERE name = ?"
+            if conn.exec_driver_sql(sequence, (self.table.name,)).first() is None:
+                conn.exec_driver_sql(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                    (self.table.name, self._id_base(partition.day, partition.shard)),
+                )
+
+    def _open_existing(self):
+        if not os.path.isdir(self.directory):
+            return
+        for file_name in os.listdir(self.directory):
+            match = FILE_PATTERN.match(file_name)
+            if not match:
+                continue
+            day, shard = match.group(1), int(match.group(2) or 0)
+            if (day is not None) != self.by_day or (match.group(2) is not None) != ("shard" in self.partition_by):
+                raise RuntimeError(f"{file_name} does not match HM_SENSOR_PARTITION_BY={self.partition_by}")
+            if shard >= self.shards:
+                raise RuntimeError(f"{file_name} is outside HM_SENSOR_SHARDS={self.shards}")
+            with self._lock:
+                if (day, shard) in self._partitions:
+                    continue
+            path = os.path.join(self.directory, file_name)
+            partition = Partition(path, day, shard, self._engine(path))
+            self._upgrade(partition)
+            with self._lock:
+                self._partitions.setdefault((day, shard), partition)
+
+    def refresh(self):
+        """Pick up the partitions another worker process created in the directory, and forget the dropped ones."""
+        if not self.partitioned:
+            return
+        with self._lock:
+            dropped = [key for key, partition in self._partitions.items() if not os.path.exists(partition.path)]
+            for key in dropped:
+                self._partitions.pop(key).engine.dispose()
+        self._open_existing()
+
+    def _upgrade(self, partition: Partition):
+        """Files written while timestamps were "YYYY-MM-DD HH:MM:SS" strings get their table rebuilt, once."""
+        with partition.engine.begin() as conn:
+            info = conn.exec_driver_sql(f"PRAGMA table_info({self.table.name})").all()
+            if any(column[1] == "timestamp" and column[2].upper() != "INTEGER" for column in info):
+                rebuild_table(conn, self.table, {"timestamp": text_to_ms_sql("timestamp")})
+
+    def describe(self) -> dict:
+        return {
+            "partition_by": self.partition_by,
+            "shards": self.shards,
+            "partitions": [
+                {
+                    "name": partition.name,
+                    "day": partition.day,
+                    "shard": partition.shard,
+                    "bytes": os.path.getsize(partition.path),
+                }
+                for partition in self.partitions()
+            ],
+        }
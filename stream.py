@@ -0,0 +1,203 @@
+import math
+from collections import deque
+from threading import Lock
+
+from model import get_sensor_data_between_dates
+from rules import RULES
+from timestamps import SECOND, now_ms
+
+# חלונות זמן מתגלגלים לכל משתמש, מתעדכנים ב-O(1) לכל מדידה בלי לקרוא מה-DB. הזמנים במילישניות מ-1970
+
+MAX_SAMPLES_PER_SECOND = 10  # חסם על הזיכרון לכל משתמש
+AXES = ("movement_x", "movement_y", "movement_z")
+
+
+def _windows() -> dict[str, dict[str, dict[str, tuple[float, float]]]]:
+    """Window name -> the fields its rules read -> the ranges counted on them, from the declarations in rules.py."""
+    windows: dict[str, dict[str, dict[str, tuple[float, float]]]] = {}
+    for rule in sorted(RULES, key=lambda rule: rule.window_seconds):
+        fields = windows.setdefault(rule.window, {})
+        for name in rule.fields:
+            fields.setdefault(name, {}).update(rule.ranges.get(name, {}))
+    return windows
+
+
+# שדות שנשמרים בכל חלון וטווחים שסופרים כמה מדידות נמצאות בתוכם
+WINDOW_FIELDS = _windows()
+# אורך כל חלון (ms) ומספר המדידות המקסימלי שנשמר בו
+WINDOWS = {rule.window: (rule.window_seconds * SECOND, rule.window_seconds * MAX_SAMPLES_PER_SECOND) for rule in RULES}
+FIELDS = {name for fields in WINDOW_FIELDS.values() for name in fields}
+LONGEST_WINDOW = max((length for length, _ in WINDOWS.values()), default=0)
+
+
+def _values(reading: dict) -> dict:
+    """The fields the windows keep, "movement" being the magnitude of the three axes."""
+    values = {name: reading.get(name) for name in FIELDS if name != "movement"}
+    if "movement" in FIELDS:
+        axes = [reading.get(axis) for axis in AXES]
+        values["movement"] = math.sqrt(sum(axis * axis for axis in axes)) if None not in axes else None
+    return values
+
+
+class RunningStats:
+    """
+    Sliding min/max/sum/count over one field.
+    Min and max use monotonic deques, so push and pop are amortized O(1).
+    """
+
+    def __init__(self, ranges: dict[str, tuple[float, float]]):
+        self.ranges = ranges
+        self.count = 0
+        self.sum = 0.0
+        self.in_range = dict.fromkeys(ranges, 0)
+        self._min: deque[tuple[int, float]] = deque()
+        self._max: deque[tuple[int, float]] = deque()
+
+    def push(self, seq: int, value: float):
+        self.count += 1
+        self.sum += value
+        for name, (low, high) in self.ranges.items():
+            if low <= value <= high:
+                self.in_range[name] += 1
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((seq, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((seq, value))
+
+    def pop(self, seq: int, value: float):
+        self.count -= 1
+        self.sum -= value
+        for name, (low, high) in self.ranges.items():
+            if low <= value <= high:
+                self.in_range[name] -= 1
+        if self._min and self._min[0][0] == seq:
+            self._min.popleft()
+        if self._max and self._max[0][0] == seq:
+            self._max.popleft()
+
+    @property
+    def min(self) -> float | None:
+        return self._min[0][1] if self._min else None
+
+    @property
+    def max(self) -> float | None:
+        return self._max[0][1] if self._max else None
+
+    @property
+    def mean(self) -> float | None:
+        return self.sum / self.count if self.count else None
+
+
+class SlidingWindow:
+    """
+    Bounded ring buffer of the samples of the last `length`, with running stats per field.
+    Samples are expected in (roughly) increasing time order.
+    """
+
+    def __init__(self, length: int, max_samples: int, fields: dict[str, dict[str, tuple[float, float]]]):
+        self.length = length
+        self.max_samples = max_samples
+        self.samples: deque[tuple[int, int, dict]] = deque()
+        self.stats = {field: RunningStats(ranges) for field, ranges in fields.items()}
+
+    @property
+    def count(self) -> int:
+        return len(self.samples)
+
+    @property
+    def last_timestamp(self) -> int | None:
+        return self.samples[-1][1] if self.samples else None
+
+    def last(self, field: str):
+        return self.samples[-1][2].get(field) if self.samples else None
+
+    def push(self, seq: int, timestamp: int, values: dict):
+        if len(self.samples) >= self.max_samples:
+            self._pop_oldest()
+        self.samples.append((seq, timestamp, values))
+        for field, stats in self.stats.items():
+            if values.get(field) is not None:
+                stats.push(seq, float(values[field]))
+        self.advance(timestamp)
+
+    def advance(self, now: int):
+        """Drop the samples that fell out of the window ending at `now`."""
+        oldest = now - self.length
+        while self.samples and self.samples[0][1] < oldest:
+            self._pop_oldest()
+
+    def _pop_oldest(self):
+        seq, _, values = self.samples.popleft()
+        for field, stats in self.stats.items():
+            if values.get(field) is not None:
+                stats.pop(seq, float(values[field]))
+
+
+class UserStream:
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.lock = Lock()
+        self.windows = {
+            name: SlidingWindow(length, max_samples, WINDOW_FIELDS[name])
+            for name, (length, max_samples) in WINDOWS.items()
+        }
+        self.last_record_id = 0
+        self._seq = 0
+
+    def add(self, reading: dict):
+        """Push one reading to every window; readings already loaded from the DB are skipped."""
+        record_id = reading.get("id")
+        if record_id is not None:
+            if record_id <= self.last_record_id:
+                return
+            self.last_record_id = record_id
+        self.push(reading)
+
+    def push(self, reading: dict):
+        """Push one reading to every window, without the duplicate check."""
+        self._seq += 1
+        values = _values(reading)
+        for window in self.windows.values():
+            window.push(self._seq, reading["timestamp"], values)
+
+    def advance(self, now: int):
+        for window in self.windows.values():
+            window.advance(now)
+
+    def rebuild(self, now: int):
+        """
+        Fill the windows from the DB (used on first access, e.g. after a restart): one query for the longest
+        window of the rules, scoped to this user, feeds every window.
+        """
+        if not self.windows:
+            return
+        rows = get_sensor_data_between_dates(now - LONGEST_WINDOW, now, user_id=self.user_id)
+        for row in sorted(rows, key=lambda r: (r["timestamp"], r["id"])):
+            self.push(row)
+        self.last_record_id = max((row["id"] for row in rows), default=self.last_record_id)
+
+
+_streams: dict[str, UserStream] = {}
+_streams_lock = Lock()
+
+
+def get_stream(user_id: str, now: int | None = None) -> UserStream:
+    with _streams_lock:
+        stream = _streams.get(user_id)
+        if stream is not None:
+            return stream
+        stream = UserStream(user_id)
+        stream.lock.acquire()
+        _streams[user_id] = stream
+    try:
+        stream.rebuild(now or now_ms())
+    finally:
+        stream.lock.release()
+    return stream
+
+
+def drop_stream(user_id: str):
+    with _streams_lock:
+        _streams.pop(user_id, None)
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# model.py יוצר וממגרר את ה-DB כבר ב-import: לטסטים יש קבצים משלהם, לא ה-health_monitor.db של השרת
+_DATA_DIR = tempfile.mkdtemp(prefix="hm-tests-")
+os.environ["HM_DATABASE_URL"] = f"sqlite:///{os.path.join(_DATA_DIR, 'health_monitor.db')}"
+os.environ["HM_SENSOR_PARTITION_DIR"] = os.path.join(_DATA_DIR, "sensor_partitions")
+os.environ["HM_DETECTION_ASYNC"] = "false"
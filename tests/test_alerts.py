@@ -0,0 +1,72 @@
+import threading
+
+import alerts
+from alerts import AlertTracker, Episode, fold, resolve, superseded
+from timestamps import SECOND
+
+COOLDOWN = 120
+
+
+def detection(last_seen: int, level: str = "yellow") -> Episode:
+    return Episode("u", "heatstroke", level, f"{level} heat", last_seen, last_seen)
+
+
+def test_repeated_detections_fold_into_one_episode():
+    episode, action = fold(None, detection(0), COOLDOWN)
+    assert action == "open"
+    episode, action = fold(episode, detection(30 * SECOND), COOLDOWN)
+    assert action == "repeat"
+    assert (episode.timestamp, episode.last_seen, episode.occurrences) == (0, 30 * SECOND, 2)
+
+
+def test_a_higher_level_escalates_and_a_lower_one_does_not_downgrade():
+    episode, _ = fold(None, detection(0), COOLDOWN)
+    episode, action = fold(episode, detection(SECOND, "red"), COOLDOWN)
+    assert (action, episode.exception_level, episode.details) == ("escalate", "red", "red heat")
+    episode, action = fold(episode, detection(2 * SECOND), COOLDOWN)
+    assert (action, episode.exception_level) == ("repeat", "red")
+
+
+def test_resolve_then_detect_within_the_cooldown_reopens():
+    episode, _ = fold(None, detection(0), COOLDOWN)
+    closed = resolve(episode, 10 * SECOND)
+    assert closed.resolved_at == 10 * SECOND
+    assert resolve(closed, 20 * SECOND) is None  # כבר סגורה
+
+    reopened, action = fold(closed, detection(100 * SECOND), COOLDOWN)
+    assert (action, reopened.timestamp, reopened.resolved_at) == ("reopen", 0, None)
+    fresh, action = fold(closed, detection(200 * SECOND), COOLDOWN)
+    assert (action, fresh.timestamp) == ("open", 200 * SECOND)
+
+
+def test_a_stale_open_episode_is_superseded_at_its_last_detection():
+    episode, _ = fold(None, detection(0), COOLDOWN)
+    episode, _ = fold(episode, detection(50 * SECOND), COOLDOWN)
+    _, action = fold(episode, detection(50 * SECOND + (COOLDOWN + 1) * SECOND), COOLDOWN)
+    assert action == "open"
+    assert superseded(episode).resolved_at == 50 * SECOND
+    assert superseded(resolve(episode, 60 * SECOND)) is None
+
+
+def test_a_slow_write_does_not_block_other_users(monkeypatch):
+    blocked, release = threading.Event(), threading.Event()
+    written = []
+
+    def add_exception(user_id, *_args):
+        if user_id == "slow":
+            blocked.set()
+            release.wait(5)
+        written.append(user_id)
+        return {"exception_id": len(written)}
+
+    monkeypatch.setattr(alerts, "add_exception", add_exception)
+    tracker = AlertTracker(cooldown_seconds=120, flush_seconds=10)
+    slow = threading.Thread(target=tracker.fire, args=("slow", "fall", "red", "Fall", 1000))
+    slow.start()
+    assert blocked.wait(5)
+
+    assert tracker.fire("fast", "fall", "red", "Fall", 1000) == "open"  # בזמן שה-INSERT של slow תקוע
+    release.set()
+    slow.join(5)
+    assert written == ["fast", "slow"]
+    assert tracker.metrics()["open_episodes"] == 2
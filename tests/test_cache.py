@@ -0,0 +1,21 @@
+from cache import latest_cache
+from model import add_exceptions_bulk, add_user, session_scope, warm_cache
+from timestamps import now_ms
+
+
+def test_warm_cache_loads_the_latest_exception():
+    now = now_ms()
+    with session_scope():
+        for user_id in ("cache-a", "cache-b"):
+            add_user(user_id, "Cache", user_id)
+        fall = {"exception_type": "fall", "exception_level": "red", "details": "Fall"}
+        add_exceptions_bulk(
+            [
+                {**fall, "user_id": "cache-a", "timestamp": now + 1000, "last_seen": now + 5000},
+                {**fall, "user_id": "cache-b", "timestamp": now + 3000},
+            ]
+        )
+        warm_cache()
+
+    latest = latest_cache.get_latest_exception()
+    assert (latest["user_id"], latest["last_seen"]) == ("cache-a", now + 5000)  # נפתחה קודם אבל זוהתה אחרונה
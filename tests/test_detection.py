@@ -0,0 +1,42 @@
+from check import check_all_conditions
+from metrics import DETECTOR_SECONDS
+from model import add_sensor_data_batch, add_user, get_exceptions_between_dates, session_scope
+from rules import RULES
+from timestamps import HOUR, SECOND, now_ms
+
+CALM = {"heart_rate": 80, "temperature": 32.0, "movement_x": 0.05, "movement_y": 0.0, "movement_z": 0.0}
+
+
+def readings(start: int, count: int, **values) -> list[dict]:
+    return [{**CALM, "sweat_level": 0.4, **values, "timestamp": start + index * SECOND} for index in range(count)]
+
+
+def detect(user_id: str, records: list[dict]) -> list[dict]:
+    """Store the readings and run the detection on them, as the ingest endpoints do."""
+    stored = add_sensor_data_batch(user_id, records)
+    check_all_conditions(user_id, stored["last_timestamp"], stored["records"])
+    return stored["records"]
+
+
+def test_episode_times_come_from_the_readings():
+    user_id = "detection-late"
+    start = now_ms() - HOUR  # מדידות שהגיעו באיחור של שעה
+    with session_scope():
+        add_user(user_id, "Late", "Readings")
+        hot = detect(user_id, readings(start, 5, temperature=35.0))
+        calm = detect(user_id, readings(start + 10 * SECOND, 5))
+        (episode,) = get_exceptions_between_dates(start, now_ms(), user_id, ["heatstroke"])
+
+    assert episode["timestamp"] == episode["last_seen"] == hot[-1]["timestamp"]
+    assert episode["resolved_at"] == calm[-1]["timestamp"]
+
+
+def test_each_rule_is_timed_under_its_own_name():
+    user_id = "detection-timed"
+    with session_scope():
+        add_user(user_id, "Timed", "Rules")
+        detect(user_id, readings(now_ms() - HOUR, 20))
+
+    rendered = "\n".join(DETECTOR_SECONDS.render())
+    for rule in RULES:
+        assert f'hm_detector_seconds_count{{detector="{rule.exception_type}"}}' in rendered
@@ -0,0 +1,41 @@
+import pytest
+
+from fleet_analysis import FleetWindow, heat_stroke_scores, score_fleet
+from model import session_scope
+from seed import SeedPlan, seed
+
+USERS = 20
+SAMPLES = 300  # חלון הניתוח: 5 הדקות האחרונות, מדידה לשנייה
+
+
+def fleet_alerts(scenario: str) -> dict[str, set[tuple[str, str]]]:
+    """The scenario's freshly seeded users (ending now) and the (type, level) alerts fleet analysis gives each."""
+    user_ids = [f"fleet-{scenario}-{index}" for index in range(USERS)]
+    with session_scope():
+        seed(SeedPlan(user_ids=user_ids, scenario=scenario, samples=SAMPLES, random_seed=42))
+        alerts = score_fleet(write=False)
+    found = {user_id: set() for user_id in user_ids}
+    for alert in alerts:
+        if alert["user_id"] in found:
+            found[alert["user_id"]].add((alert["exception_type"], alert["exception_level"]))
+    return found
+
+
+def test_normal_scenario_raises_no_alerts():
+    assert all(not alerts for alerts in fleet_alerts("normal").values())
+
+
+@pytest.mark.parametrize(
+    ("scenario", "exception_type"),
+    [("heat_ramp", "heatstroke"), ("hypothermia", "coldshock"), ("dehydration", "dehydration")],
+)
+def test_scenario_raises_its_alert(scenario, exception_type):
+    for alerts in fleet_alerts(scenario).values():
+        assert exception_type in {found_type for found_type, _ in alerts}
+
+
+def test_heat_stroke_counts_dry_skin_anywhere_in_the_window():
+    # כמו min(sweats) ב-Situation_analysis.py: העור התייבש באמצע החלון וחזר להזיע עד המדידה האחרונה
+    sweats = [0.3, 0.05, 0.3]
+    window = FleetWindow([("u", 80, 37.0, sweat, 0.0, 0.0, 0.0) for sweat in sweats])
+    assert heat_stroke_scores(window).tolist() == [4.0]  # חום קריטי (2) ועור יבש עם חום קריטי (2)
@@ -0,0 +1,40 @@
+import math
+import struct
+from datetime import UTC, datetime
+
+from frames import FRAME, decode_frames, encode_frames, frame_count
+
+READING = {
+    "heart_rate": 72,
+    "temperature": 36.6,
+    "movement_x": 0.1,
+    "movement_y": -0.2,
+    "movement_z": 9.81,
+    "sweat_level": 0.35,
+}
+
+
+def test_frames_decode_to_the_readings_they_encode():
+    taken = datetime(2026, 1, 1, 12, 0, 0, tzinfo=UTC)
+    body = encode_frames([{**READING, "timestamp": taken}, {**READING, "heart_rate": 140}])
+
+    decoded = decode_frames(body, now=5_000)
+
+    assert frame_count(body) == 2
+    assert decoded["records"] == [
+        {**READING, "timestamp": int(taken.timestamp()) * 1000},
+        {**READING, "heart_rate": 140, "timestamp": 5_000},  # בלי זמן מהמכשיר: זמן הקבלה
+    ]
+
+
+def test_a_partial_frame_is_rejected():
+    body = encode_frames([READING])[:-1]
+    assert frame_count(body) is None
+    assert f"{FRAME.itemsize}-byte frame" in decode_frames(body)["error"]
+
+
+def test_a_nan_value_is_rejected_with_its_frame_index():
+    body = bytearray(encode_frames([READING, READING]))
+    offset = FRAME.itemsize + FRAME.fields["sweat_level"][1]
+    struct.pack_into("<f", body, offset, math.nan)
+    assert decode_frames(bytes(body)) == {"error": "Frame 1 has a NaN or infinite value"}
@@ -0,0 +1,94 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+from conftest import ROOT
+
+# הסכמה של ה-baseline (user_version 0): timestamps כמחרוזות, בלי אינדקסים ובלי עמודות האפיזודה
+V0_SCHEMA = """
+CREATE TABLE users (id VARCHAR NOT NULL, first_name VARCHAR, last_name VARCHAR, PRIMARY KEY (id));
+CREATE TABLE sensor_data (
+    id INTEGER NOT NULL, user_id VARCHAR NOT NULL, timestamp VARCHAR NOT NULL, heart_rate INTEGER,
+    temperature FLOAT, movement_x FLOAT, movement_y FLOAT, movement_z FLOAT, sweat_level FLOAT,
+    PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES users (id)
+);
+CREATE TABLE exception (
+    id INTEGER NOT NULL, timestamp VARCHAR NOT NULL, details VARCHAR NOT NULL, user_id VARCHAR NOT NULL,
+    exception_type VARCHAR NOT NULL, exception_level VARCHAR NOT NULL,
+    PRIMARY KEY (id),
+    CONSTRAINT valid_exception_type CHECK (exception_type IN ('fall', 'heatstroke', 'coldshock', 'dehydration',
+        'pre_syncope', 'heart_attack', 'button_press')),
+    CONSTRAINT valid_exception_level CHECK (exception_level IN ('green', 'yellow', 'red')),
+    FOREIGN KEY(user_id) REFERENCES users (id)
+);
+INSERT INTO users VALUES ('7', 'Old', 'User');
+INSERT INTO sensor_data VALUES (1, '7', '2025-01-01 10:00:00.250000', 80, 36.5, 0.1, 0.1, 0.1, 0.5);
+INSERT INTO sensor_data VALUES (2, '7', '2025-01-01 10:00:01', 81, 36.6, 0.1, 0.1, 0.1, 0.5);
+INSERT INTO exception VALUES (1, '2025-01-01 10:00:01', 'Heat', '7', 'heatstroke', 'red');
+"""
+
+# רץ בתהליך נפרד: ה-import של model.py הוא מה שמריץ את המיגרציות
+INSPECT = """
+import json
+from sqlalchemy import text
+import model
+from timestamps import to_ms
+with model.engine.connect() as conn:
+    print(json.dumps({
+        "version": conn.exec_driver_sql("PRAGMA user_version").scalar(),
+        "migrations": len(model.MIGRATIONS),
+        "indexes": sorted(row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))),
+        "readings": [list(row) for row in conn.execute(text("SELECT id, timestamp FROM sensor_data ORDER BY id"))],
+        "exception": list(conn.execute(text("SELECT timestamp, last_seen, resolved_at FROM exception")).one()),
+        "rollups": conn.execute(text("SELECT count(*) FROM sensor_rollup")).scalar(),
+        "auto_vacuum": conn.exec_driver_sql("PRAGMA auto_vacuum").scalar(),
+        "expected": [to_ms("2025-01-01 10:00:00.250000"), to_ms("2025-01-01 10:00:01")],
+    }))
+"""
+
+
+def v0_database(tmp_path) -> dict[str, str]:
+    """A baseline database file, and the environment that points model.py at it."""
+    path = tmp_path / "health_monitor.db"
+    with sqlite3.connect(path) as conn:
+        conn.executescript(V0_SCHEMA)
+    return {**os.environ, "HM_DATABASE_URL": f"sqlite:///{path}", "HM_SENSOR_PARTITION_DIR": str(tmp_path / "p")}
+
+
+def run(env: dict[str, str], *args: str) -> list[str]:
+    result = subprocess.run([sys.executable, *args], cwd=ROOT, env=env, capture_output=True, text=True, check=False)
+    assert result.returncode == 0, result.stderr
+    return result.stdout.strip().splitlines()
+
+
+def test_v0_database_upgrades_on_import(tmp_path):
+    output = run(v0_database(tmp_path), "-c", INSPECT)
+    state = json.loads(output[-1])
+
+    assert state["version"] == state["migrations"]
+    for index in (
+        "ix_sensor_data_user_timestamp",
+        "ix_sensor_data_timestamp",
+        "ix_exception_timestamp",
+        "ix_exception_user_timestamp",
+        "ix_exception_last_seen",
+        "ix_exception_user_last_seen",
+    ):
+        assert index in state["indexes"]
+    assert [timestamp for _, timestamp in state["readings"]] == state["expected"]
+    # השורות הישנות הן אפיזודות שנסגרו מיד
+    assert state["exception"] == [state["expected"][1]] * 3
+    assert state["rollups"] == 2  # bucket של דקה ושל שעה
+    # בלי VACUUM מלא בעליית השרת, רק הודעה איך להמיר
+    assert state["auto_vacuum"] == 0
+    assert any("--enable-incremental-vacuum" in line for line in output)
+
+
+def test_incremental_vacuum_is_an_explicit_step(tmp_path):
+    env = v0_database(tmp_path)
+    converted = json.loads(run(env, "model.py", "--enable-incremental-vacuum")[-1])
+    assert converted["converted"] is True
+    again = json.loads(run(env, "model.py", "--enable-incremental-vacuum")[-1])
+    assert again == {"converted": False, "auto_vacuum": "incremental"}
@@ -0,0 +1,63 @@
+import asyncio
+
+import async_model
+from model import add_exceptions_bulk, add_sensor_data_batch, add_user, get_sensor_aggregates, session_scope
+from timestamps import HOUR, MINUTE, SECOND, now_ms
+
+CALM = {"temperature": 33.0, "sweat_level": 0.4, "movement_x": 0.0, "movement_y": 0.0, "movement_z": 0.0}
+
+
+def test_aggregates_merge_the_minute_rollups():
+    start = now_ms() - 2 * HOUR
+    start -= start % HOUR
+    heart_rates = {0: [70, 80], 1: [90], 6: [100, 120]}  # דקה -> הדופק של המדידות בה
+    readings = [
+        {**CALM, "heart_rate": heart_rate, "timestamp": start + minute * MINUTE + index * SECOND}
+        for minute, values in heart_rates.items()
+        for index, heart_rate in enumerate(values)
+    ]
+    with session_scope():
+        add_user("rollup", "Rollup", "User")
+        add_sensor_data_batch("rollup", readings)
+        minutes = get_sensor_aggregates("rollup", "1m", start, start + HOUR)["buckets"]
+        five_minutes = get_sensor_aggregates("rollup", "5m", start, start + HOUR)["buckets"]
+        invalid = get_sensor_aggregates("rollup", "5x", start, start + HOUR)
+
+    def summary(buckets):
+        return [
+            ((bucket["bucket_start"] - start) // MINUTE, bucket["count"], *bucket["heart_rate"].values())
+            for bucket in buckets
+        ]
+
+    assert summary(minutes) == [(0, 2, 70, 80, 75.0), (1, 1, 90, 90, 90.0), (6, 2, 100, 120, 110.0)]
+    assert summary(five_minutes) == [(0, 3, 70, 90, 80.0), (5, 2, 100, 120, 110.0)]
+    assert "error" in invalid
+
+
+def test_users_are_paged_by_cursor_with_their_counts():
+    now = now_ms()
+    with session_scope():
+        for index in range(7):
+            add_user(f"page-{index}", "Page", str(index))
+        add_sensor_data_batch("page-3", [{**CALM, "heart_rate": 80, "timestamp": now - index} for index in range(4)])
+        fall = {"user_id": "page-3", "exception_type": "fall", "details": "Fall", "timestamp": now}
+        add_exceptions_bulk([{**fall, "exception_level": "red"}, {**fall, "exception_level": "yellow"}])
+
+    async def all_pages() -> list[dict]:
+        pages, cursor = [], None
+        while True:
+            page = await async_model.get_all_users(cursor, limit=3, include={"open_red_alerts"})
+            pages.append(page)
+            if (cursor := page["next_cursor"]) is None:
+                await async_model.engine.dispose()
+                return pages
+
+    pages = asyncio.run(all_pages())
+    users = [user for page in pages for user in page["users"]]
+    ids = [user["id"] for user in users]
+
+    assert all(len(page["users"]) <= 3 for page in pages)
+    assert ids == sorted(set(ids))
+    assert {f"page-{index}" for index in range(7)} <= set(ids)
+    counts = next(user for user in users if user["id"] == "page-3")
+    assert (counts["sensor_data_count"], counts["exceptions_count"], counts["open_red_alerts"]) == (4, 2, 1)
@@ -0,0 +1,71 @@
+import threading
+
+import pipeline as pipeline_module
+from pipeline import DetectionPipeline
+
+
+def recording_checks(monkeypatch, check=None) -> list[tuple]:
+    """Replace the detectors with a recorder of (thread, user_id, timestamp, reading seqs) per run."""
+    runs = []
+
+    def check_all_conditions(user_id, timestamp, readings):
+        if check:
+            check(user_id)
+        runs.append((threading.current_thread().name, user_id, timestamp, [reading["seq"] for reading in readings]))
+
+    monkeypatch.setattr(pipeline_module, "check_all_conditions", check_all_conditions)
+    return runs
+
+
+def test_each_user_keeps_its_order_on_one_worker(monkeypatch):
+    runs = recording_checks(monkeypatch)
+    detection = DetectionPipeline(workers=4, capacity=1000, latency_budget_ms=1000)
+    detection.start()
+    for seq in range(200):
+        user_id = f"user-{seq % 10}"
+        detection.submit(user_id, 1000 + seq, [{"seq": seq}])
+    detection.stop()
+
+    for index in range(10):
+        user_runs = [run for run in runs if run[1] == f"user-{index}"]
+        assert len({thread for thread, *_ in user_runs}) == 1
+        assert [seq for *_, seqs in user_runs for seq in seqs] == list(range(index, 200, 10))
+    assert detection.metrics()["processed"] == 200
+
+
+def test_queued_jobs_of_a_user_are_merged_into_one_run(monkeypatch):
+    busy, release = threading.Event(), threading.Event()
+
+    def block_first(user_id):
+        if user_id == "first":
+            busy.set()
+            release.wait(5)
+
+    runs = recording_checks(monkeypatch, block_first)
+    detection = DetectionPipeline(workers=1, capacity=100, latency_budget_ms=1000)
+    detection.start()
+    detection.submit("first", 1000, [{"seq": 0}])
+    assert busy.wait(5)
+    for seq, user_id in enumerate(["a", "b", "a", "b", "a"], start=1):  # מחכים בתור מאחורי first
+        detection.submit(user_id, 1000 + seq, [{"seq": seq}])
+    release.set()
+    detection.stop()
+
+    assert [run[1:] for run in runs] == [("first", 1000, [0]), ("a", 1005, [1, 3, 5]), ("b", 1004, [2, 4])]
+    assert detection.metrics()["detector_runs"] == 3
+
+
+def test_a_failing_job_does_not_stop_the_worker(monkeypatch):
+    def fail_bad(user_id):
+        if user_id == "bad":
+            raise ValueError("broken reading")
+
+    runs = recording_checks(monkeypatch, fail_bad)
+    detection = DetectionPipeline(workers=1, capacity=100, latency_budget_ms=1000)
+    detection.start()
+    detection.submit("bad", 1000, [{"seq": 0}])
+    detection.submit("good", 1001, [{"seq": 1}])
+    detection.stop()
+
+    assert [run[1] for run in runs] == ["good"]
+    assert detection.metrics()["failed"] == 1
@@ -0,0 +1,24 @@
+import pytest
+
+from model import HOT_QUERIES, check_query_plans, explain_hot_queries, plan_problems, session_scope
+
+
+@pytest.fixture(scope="module")
+def plans() -> dict[str, list[str]]:
+    with session_scope():
+        return explain_hot_queries()
+
+
+@pytest.mark.parametrize("name", list(HOT_QUERIES))
+def test_hot_query_searches_the_hot_tables(plans, name):
+    assert plan_problems(name, plans[name]) == [], plans[name]
+
+
+def test_a_dropped_index_is_caught():
+    plan = ["SCAN sensor_data USING INDEX ix_sensor_data_timestamp"]  # בלי ix_sensor_data_user_timestamp
+    assert plan_problems("get_last_sensor_data_by_user", plan) == plan
+
+
+def test_check_query_plans_passes():
+    with session_scope():
+        check_query_plans()
@@ -0,0 +1,45 @@
+from check import check_all_conditions
+from model import add_sensor_data_batch, add_user, get_exceptions_between_dates, session_scope
+from replay import REPLAY_EXCEPTION_TYPES, diff_alerts, replay_and_store
+from timestamps import HOUR, SECOND, now_ms
+
+
+def episode(start: int, end: int | None, exception_type: str = "heatstroke", **fields) -> dict:
+    record = {"user_id": "u", "exception_type": exception_type, "exception_level": "red", "timestamp": start}
+    return {**record, "last_seen": end or start, "resolved_at": end, **fields}
+
+
+def test_diff_matches_overlapping_episodes_of_the_same_type():
+    live = [episode(1000, 5000), episode(9000, None, last_seen=9500), episode(20000, 21000, "fall")]
+    replayed = [episode(800, 4000), episode(9400, 9900), episode(20500, 22000), episode(30000, 31000)]
+
+    diff = diff_alerts(replayed, live)
+
+    assert diff["added"] == replayed[2:]  # החפיפה ב-20500 היא עם fall, לא עם heatstroke
+    assert diff["removed"] == live[2:]
+
+
+def test_replay_over_live_detections_writes_nothing_new():
+    user_id = "replay-live"
+    start = now_ms() - HOUR
+    temperatures = [35.0] * 120 + [32.0] * 90 + [35.0] * 90  # שתי אפיזודות, רחוקות יותר מה-cooldown
+    calm = {"heart_rate": 80, "sweat_level": 0.4, "movement_x": 0.05, "movement_y": 0.0, "movement_z": 0.0}
+    readings = [
+        {**calm, "timestamp": start + index * SECOND, "temperature": temperature}
+        for index, temperature in enumerate(temperatures)
+    ]
+    end = readings[-1]["timestamp"]
+    with session_scope():
+        add_user(user_id, "Replay", "Live")
+        for batch in range(0, len(readings), 10):  # הזיהוי החי רץ פעם לכל batch, לא לכל מדידה
+            stored = add_sensor_data_batch(user_id, readings[batch : batch + 10])
+            check_all_conditions(user_id, stored["last_timestamp"], stored["records"])
+        live = get_exceptions_between_dates(start, end, user_id, REPLAY_EXCEPTION_TYPES)
+
+    summary = replay_and_store(user_id, start, end, chunk_size=100, mode="write")
+
+    with session_scope():
+        after = get_exceptions_between_dates(start, end, user_id, REPLAY_EXCEPTION_TYPES)
+    assert len(live) == 2
+    assert summary["added"] == summary["removed"] == summary["written"] == 0
+    assert after == live
@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+# רץ בתהליך נפרד: מצב המחיצות נקבע ב-import של model.py
+PURGE = """
+import json
+from model import add_exceptions_bulk, add_sensor_data_batch, add_user, get_sensor_data_between_dates, session_scope
+from retention import retention
+from timestamps import DAY, MINUTE, now_ms
+
+now = now_ms()
+old = now - 40 * DAY
+reading = {"heart_rate": 80, "temperature": 32, "movement_x": 0.1, "movement_y": 0, "movement_z": 0, "sweat_level": 0.4}
+with session_scope():
+    for user_id in ("near", "far"):
+        add_user(user_id, "Retention", user_id)
+        timestamps = [old + index * 5 * MINUTE for index in range(10)] + [now - index * MINUTE for index in range(3)]
+        add_sensor_data_batch(user_id, [{**reading, "timestamp": at} for at in timestamps])
+    episode = {"exception_type": "fall", "exception_level": "red", "details": "Fall", "timestamp": old + 20 * MINUTE}
+    add_exceptions_bulk([{**episode, "user_id": "near"}])
+run = retention.run_once(now)
+with session_scope():
+    left = {
+        user_id: [
+            (timestamp - old) // MINUTE if timestamp < now - DAY else "recent"
+            for timestamp in sorted(row["timestamp"] for row in get_sensor_data_between_dates(0, now, user_id))
+        ]
+        for user_id in ("near", "far")
+    }
+print(json.dumps({"deleted": run["readings_deleted"], "batches": run["batches"], "left": left}))
+"""
+
+
+@pytest.mark.parametrize("partition_by", ["none", "shard"])
+def test_old_readings_are_purged_except_near_exceptions(tmp_path, partition_by):
+    env = {
+        **os.environ,
+        "HM_DATABASE_URL": f"sqlite:///{tmp_path / 'health_monitor.db'}",
+        "HM_SENSOR_PARTITION_DIR": str(tmp_path / "p"),
+        "HM_SENSOR_PARTITION_BY": partition_by,
+        "HM_RETENTION_BATCH_SIZE": "3",
+        "HM_RETENTION_BATCH_PAUSE_MS": "0",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", PURGE], cwd=ROOT, env=env, capture_output=True, text=True, check=False
+    )
+    assert result.returncode == 0, result.stderr
+    state = json.loads(result.stdout.strip().splitlines()[-1])
+
+    # חלון של 10 דקות סביב החריגה בדקה 20 שומר את המדידות של דקות 10 עד 30
+    assert state["left"] == {"near": [10, 15, 20, 25, 30, "recent", "recent", "recent"], "far": ["recent"] * 3}
+    assert state["deleted"] == 15
+    assert state["batches"] > 1
@@ -0,0 +1,31 @@
+import multiprocessing
+
+import shared
+from shared import EventRelay, several_workers
+
+
+def test_a_spawned_worker_counts_as_one_of_several(monkeypatch):
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    with multiprocessing.get_context("spawn").Pool(1) as pool:  # כמו ה-workers של uvicorn --workers N
+        assert pool.apply(several_workers)
+    assert not several_workers()
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    assert several_workers()
+
+
+def test_the_relay_turns_itself_on_with_several_workers(monkeypatch):
+    monkeypatch.setattr(shared, "several_workers", lambda: True)
+    relay = EventRelay(0, 60)
+    relay.start()
+    try:
+        assert relay.metrics()["running"]
+        assert relay.metrics()["interval_ms"] == shared.AUTO_INTERVAL_MS
+    finally:
+        relay.stop()
+
+
+def test_the_relay_stays_off_in_a_single_process(monkeypatch):
+    monkeypatch.setattr(shared, "several_workers", lambda: False)
+    relay = EventRelay(0, 60)
+    relay.start()
+    assert not relay.metrics()["running"]
@@ -0,0 +1,51 @@
+from stream import SlidingWindow, UserStream
+from timestamps import SECOND
+
+
+def window(length_seconds: int = 10, max_samples: int = 100) -> SlidingWindow:
+    return SlidingWindow(length_seconds * SECOND, max_samples, {"temperature": {"hot": (34.0, 100.0)}})
+
+
+def push_all(target: SlidingWindow, temperatures: list[float]):
+    for seq, temperature in enumerate(temperatures, start=1):
+        target.push(seq, seq * SECOND, {"temperature": temperature})
+
+
+def test_stats_follow_the_samples_inside_the_window():
+    temperatures = [33.0, 36.0, 31.0, 34.5, 32.0, 35.0, 33.5, 30.0, 34.0, 32.5, 33.0, 31.5, 35.5, 32.0, 33.0]
+    sliding = window()
+    push_all(sliding, temperatures)
+
+    inside = temperatures[-11:]  # השניות 5 עד 15: חלון של 10 שניות כולל את שני הקצוות
+    stats = sliding.stats["temperature"]
+    assert sliding.count == len(inside)
+    assert (stats.min, stats.max) == (min(inside), max(inside))
+    assert stats.mean == sum(inside) / len(inside)
+    assert stats.in_range["hot"] == sum(1 for temperature in inside if temperature >= 34.0)
+
+
+def test_the_window_keeps_at_most_max_samples():
+    sliding = window(max_samples=3)
+    push_all(sliding, [36.0, 30.0, 33.0, 34.0])
+    stats = sliding.stats["temperature"]
+    assert sliding.count == 3
+    assert (stats.min, stats.max, stats.in_range["hot"]) == (30.0, 34.0, 1)
+
+
+def test_advance_empties_a_window_without_new_readings():
+    sliding = window()
+    push_all(sliding, [35.0, 36.0])
+    sliding.advance(60 * SECOND)
+    stats = sliding.stats["temperature"]
+    assert sliding.count == 0
+    assert (stats.min, stats.max, stats.mean, stats.in_range["hot"]) == (None, None, None, 0)
+
+
+def test_a_reading_already_in_the_stream_is_skipped():
+    stream = UserStream("stream-user")
+    reading = {"id": 7, "timestamp": SECOND, "heart_rate": 80, "temperature": 33.0, "sweat_level": 0.4}
+    reading |= {"movement_x": 0.0, "movement_y": 0.0, "movement_z": 0.0}
+    stream.add(reading)
+    stream.add(reading)
+    stream.add({**reading, "id": 6})
+    assert {name: sliding.count for name, sliding in stream.windows.items()} == dict.fromkeys(stream.windows, 1)
@@ -0,0 +1,64 @@
+import time
+from datetime import datetime
+
+# זמנים נשמרים, מושווים ונשלחים בין המודולים כמספר שלם: מילישניות מ-1970 (UTC).
+# המרה ממחרוזת / datetime ואליהם קורית רק בקצוות: הקלט של ה-API וה-CLI, והפלט ב-JSON, CSV ו-SSE.
+
+DISPLAY_FORMAT = "%Y-%m-%d %H:%M:%S"  # שעון מקומי של השרת, כמו המחרוזות שנשמרו לפני המעבר
+SECOND = 1000
+MINUTE = 60 * SECOND
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+# השדות שמכילים זמן ברשומות של model.py
+TIMESTAMP_FIELDS = frozenset({"timestamp", "last_seen", "resolved_at", "bucket_start", "last_timestamp", "from", "to"})
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def to_ms(value: datetime | str) -> int:
+    """A datetime (naive = the server's local time) or a "YYYY-MM-DD HH:MM:SS" / ISO string as epoch ms."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return round(value.timestamp() * 1000)
+
+
+def to_datetime(ms: int) -> datetime:
+    """Naive local datetime, like datetime.now()."""
+    return datetime.fromtimestamp(ms / 1000)
+
+
+def format_ms(ms: int | None) -> str | None:
+    return None if ms is None else time.strftime(DISPLAY_FORMAT, time.localtime(ms // 1000))
+
+
+def formatted(record: dict) -> dict:
+    """The record with its time fields as display strings, for a response."""
+    return {
+        name: format_ms(value) if name in TIMESTAMP_FIELDS and isinstance(value, int) else value
+        for name, value in record.items()
+    }
+
+
+def local_day(ms: int) -> str:
+    """The server's local date of the instant, "YYYY-MM-DD"."""
+    return time.strftime("%Y-%m-%d", time.localtime(ms // 1000))
+
+
+def day_start_ms(day: str) -> int:
+    """Local midnight at the start of a "YYYY-MM-DD" day."""
+    return to_ms(datetime.fromisoformat(day))
+
+
+def local_offset_ms(ms: int) -> int:
+    """The server's UTC offset at that instant (DST included)."""
+    return time.localtime(ms // 1000).tm_gmtoff * 1000
+
+
+def text_to_ms_sql(column: str) -> str:
+    """SQL converting a column of the old local "YYYY-MM-DD HH:MM:SS[.ffffff]" strings to epoch ms (migrations)."""
+    return (
+        f"CASE WHEN typeof({column}) = 'text' "
+        f"THEN CAST(round((julianday({column}, 'utc') - 2440587.5) * 86400000) AS INTEGER) ELSE {column} END"
+    )